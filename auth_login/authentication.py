@@ -0,0 +1,77 @@
+"""
+authentication.py
+Stateless JWT authentication building the request user from the token claims.
+"""
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from driver.models import Driver
+from .models import User
+
+
+class ClaimsUser(TokenUser):
+    """
+    Request user read from the claims of a token, without a database query.
+
+    The User and Driver rows are only loaded when a view needs them, such as
+    to save a ride, and a row deleted after the token was issued fails the
+    authentication. Tokens issued before the claims existed fall back to a
+    query for the driver id.
+    """
+
+    @cached_property
+    def role(self):
+        return self.token.get('role')
+
+    @cached_property
+    def driver_id(self):
+        if self.role is None:
+            return Driver.objects.filter(user_id=self.id).values_list('id', flat=True).first()
+        return self.token.get('driver_id')
+
+    @cached_property
+    def user(self):
+        try:
+            return User.objects.get(id=self.id)
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+    @cached_property
+    def driver(self):
+        try:
+            return Driver.objects.get(id=self.driver_id)
+        except Driver.DoesNotExist:
+            raise AuthenticationFailed(_("Driver not found"), code="driver_not_found")
+
+
+class StatelessJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    JWT authentication returning a ClaimsUser instead of reading the User row.
+
+    A user deactivated after the token was issued keeps access until the access token expires.
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        return ClaimsUser(validated_token)
+
+
+def get_driver_id(user):
+    """
+    Id of the Driver of a request user, read from the token claims when the user is a ClaimsUser.
+
+    Args:
+    user -- The request user.
+
+    Returns:
+    int -- Id of the Driver, or None if the user is not a driver.
+    """
+    if isinstance(user, ClaimsUser):
+        return user.driver_id
+    return Driver.objects.filter(user=user).values_list('id', flat=True).first()
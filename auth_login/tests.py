@@ -1,6 +1,7 @@
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
 
 from auth_login.models import User
 
@@ -72,6 +73,8 @@ class LoginViewTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('refresh', response.data)
         self.assertIn('access', response.data)
+        token = AccessToken(response.data['access'])
+        self.assertEqual((token['role'], token['driver_id']), ('rider', None))
 
     def test_invalid_password(self):
         self.user_data['password'] = 'wrongpassword'
@@ -0,0 +1,41 @@
+"""
+tokens.py
+JWT tokens carrying the role of the user, read by auth_login.authentication.
+"""
+from rest_framework_simplejwt import tokens
+
+from driver.models import Driver
+
+ROLE_DRIVER = 'driver'
+ROLE_RIDER = 'rider'
+
+
+class RefreshToken(tokens.RefreshToken):
+    """
+    Refresh token whose claims include the role and the driver id of the user.
+
+    The claims are copied into the access tokens made from it, including the
+    ones issued by the token refresh endpoint.
+    """
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        driver_id = Driver.objects.filter(user=user).values_list('id', flat=True).first()
+        token['role'] = ROLE_DRIVER if driver_id is not None else ROLE_RIDER
+        token['driver_id'] = driver_id
+        return token
+
+
+def token_response(user):
+    """
+    Response body carrying a new token pair for a user.
+
+    Returns:
+    dict -- The refresh and access tokens.
+    """
+    token = RefreshToken.for_user(user)
+    return {
+        'refresh': str(token),
+        'access': str(token.access_token),
+    }
@@ -9,11 +9,11 @@ from rest_framework.parsers import FileUploadParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework_simplejwt.exceptions import TokenError
-from rest_framework_simplejwt.tokens import RefreshToken
 
 from base.permissions import IsOwner
 from .models import User
 from .serializers import UserSerializer, LoginSerializer, SignUpSerializer, TokenSerializer
+from .tokens import RefreshToken, token_response
 
 logger = logging.getLogger('auth')
 
@@ -137,12 +137,7 @@ class LoginView(generics.GenericAPIView):
                 user = User.objects.filter(email=email).first()
                 if user:
                     if user.check_password(password):
-                        token = RefreshToken.for_user(user)
-                        print(token.access_token)
-                        return Response({
-                            'refresh': str(token),
-                            'access': str(token.access_token),
-                        })
+                        return Response(token_response(user))
                     else:
                         # Invalid password
                         return Response(
@@ -200,8 +195,4 @@ class SignUpView(generics.CreateAPIView):
         serializer.is_valid(raise_exception=True)
         user = serializer.save()
 
-        token = RefreshToken.for_user(user)
-        return Response({
-            'refresh': str(token),
-            'access': str(token.access_token),
-        }, status=status.HTTP_201_CREATED)
+        return Response(token_response(user), status=status.HTTP_201_CREATED)
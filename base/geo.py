@@ -0,0 +1,107 @@
+"""
+geo.py
+Great-circle distances and travel times.
+
+Distances from one origin to many destinations are haversine distances
+computed in a single NumPy step. Travel times stretch them by ETA_ROAD_FACTOR,
+as roads are longer than the great circle, and divide them by the average
+speed of the ETA_SPEED_PROFILE band the trip starts in.
+"""
+import bisect
+import math
+from datetime import timedelta
+
+import numpy as np
+from django.utils import timezone
+
+from config.settings import ETA_ROAD_FACTOR, ETA_SPEED_PROFILE
+
+# Mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+# Length of one degree of latitude in KM
+KM_PER_DEGREE = 111.32
+
+_BAND_HOURS = sorted(ETA_SPEED_PROFILE)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance between two points.
+
+    Args:
+    lat1, lng1 -- Latitude and longitude of the first point in degrees.
+    lat2, lng2 -- Latitude and longitude of the second point in degrees.
+
+    Returns:
+    float -- Distance in meters.
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def distances(lat, lng, lats, lngs):
+    """
+    Great-circle distances from one point to many.
+
+    Args:
+    lat, lng -- Origin in degrees.
+    lats, lngs -- Arrays of shape (n,) with the destinations in degrees.
+
+    Returns:
+    ndarray -- Distances of shape (n,) in meters.
+    """
+    phi1 = math.radians(lat)
+    phi2 = np.radians(lats)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(np.subtract(lngs, lng))
+    a = np.sin(d_phi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def speed_at(when=None):
+    """
+    Average road speed at a time of day, from ETA_SPEED_PROFILE.
+
+    Args:
+    when -- Aware datetime, now by default.
+
+    Returns:
+    float -- Speed in meters per second.
+    """
+    hour = timezone.localtime(when).hour
+    # Hours before the first band belong to the last band of the previous day
+    band = _BAND_HOURS[bisect.bisect_right(_BAND_HOURS, hour) - 1]
+    return ETA_SPEED_PROFILE[band] / 3.6
+
+
+def travel_times(meters, when=None):
+    """
+    Time needed to drive great-circle distances, for trips starting at `when`.
+
+    Args:
+    meters -- Distance or array of distances in meters.
+    when -- Aware datetime, now by default.
+
+    Returns:
+    float or ndarray -- Travel times in seconds, shaped like `meters`.
+    """
+    return np.multiply(meters, ETA_ROAD_FACTOR) / speed_at(when)
+
+
+def arrival(meters, when=None):
+    """
+    Time a trip of a great-circle distance started at `when` arrives.
+
+    Args:
+    meters -- Distance in meters.
+    when -- Aware datetime, now by default.
+
+    Returns:
+    datetime -- Estimated time of arrival.
+    """
+    when = when or timezone.now()
+    return when + timedelta(seconds=float(travel_times(meters, when)))
@@ -0,0 +1,57 @@
+import time
+
+import numpy as np
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand
+
+from base.geo import distances, haversine, travel_times
+
+
+class Command(BaseCommand):
+    help = 'Benchmark one-to-many NumPy distances against per-object GEOS and haversine calls'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--points',
+            type=int,
+            default=100000,
+            help='Number of destinations'
+        )
+        parser.add_argument(
+            '--area',
+            type=float,
+            default=60,
+            help='Edge length in KM of the square the destinations are spread over'
+        )
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(42)
+        # Centre the destinations on Perinthalmanna
+        lat, lng = 10.976, 76.212
+        span = options['area'] / 111.32 / 2
+        lats = lat + rng.uniform(-span, span, options['points'])
+        lngs = lng + rng.uniform(-span, span, options['points'])
+
+        origin = Point(lng, lat)
+        points = [Point(x, y) for x, y in zip(lngs.tolist(), lats.tolist())]
+        start = time.perf_counter()
+        for point in points:
+            origin.distance(point)
+        geos_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        for d_lat, d_lng in zip(lats.tolist(), lngs.tolist()):
+            haversine(lat, lng, d_lat, d_lng)
+        scalar_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        travel_times(distances(lat, lng, lats, lngs))
+        numpy_ms = (time.perf_counter() - start) * 1000
+
+        self.stdout.write(self.style.NOTICE(f'1 origin x {options["points"]} destinations'))
+        self.stdout.write(f'{"method":>20} {"ms":>9} {"speedup":>9}')
+        for method, elapsed in (('GEOS Point.distance', geos_ms), ('haversine loop', scalar_ms),
+                                ('NumPy distances+ETA', numpy_ms)):
+            self.stdout.write(f'{method:>20} {elapsed:>9.1f} {geos_ms / elapsed:>8.1f}x')
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete!'))
@@ -0,0 +1,101 @@
+"""
+metrics.py
+Process-local counters, gauges and timers shown on the metrics endpoint.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Timer:
+    """
+    Records durations and summarises them as percentiles.
+
+    Only the most recent `size` samples are kept for the percentiles, while the
+    count and total cover every observation.
+    """
+
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0}
+
+        def percentile(p):
+            return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 3)
+
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 3),
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class Registry:
+    """
+    Named metrics of the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def timer(self, name):
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = Timer()
+            return self.timers[name]
+
+    @contextmanager
+    def time(self, name):
+        """
+        Time the body of a with block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timer(name).observe(time.perf_counter() - started)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, func):
+        """
+        Register a callable whose return value is reported under `name`.
+        """
+        self.gauges[name] = func
+
+    def snapshot(self):
+        gauges = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            'counters': dict(self.counters),
+            'gauges': gauges,
+            'timers': {name: timer.summary() for name, timer in list(self.timers.items())},
+        }
+
+
+metrics = Registry()
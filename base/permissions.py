@@ -1,6 +1,6 @@
 from rest_framework import permissions
 
-from driver.models import Driver
+from auth_login.authentication import get_driver_id
 
 
 class IsOwner(permissions.BasePermission):
@@ -50,7 +50,9 @@ class IsOwnObj(permissions.BasePermission):
 class IsDriver(permissions.BasePermission):
     """
     Custom permission to only allow drivers to access the API.
+
+    Users authenticated with StatelessJWTAuthentication are checked against their token claims.
     """
 
     def has_permission(self, request, view):
-        return request.user.is_authenticated and Driver.objects.filter(user=request.user).exists()
+        return request.user.is_authenticated and get_driver_id(request.user) is not None
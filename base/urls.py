@@ -5,9 +5,11 @@ organisation/urls.py
 from django.urls import path, include
 from rest_framework import routers
 
+from .views import MetricsView
 
 router = routers.DefaultRouter()
 
 urlpatterns = [
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('', include(router.urls)),
 ]
@@ -19,6 +19,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 django_asgi_app = get_asgi_application()
 
+from rider.expiry import offer_timers  # noqa: E402
+
+# Offers made before a restart expire without waiting for a new offer to start the timers
+offer_timers.start()
+
 application = TokenAuthMiddleware(ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": URLRouter(
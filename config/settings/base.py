@@ -144,11 +144,27 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 # Define channel layer
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",  # Use an appropriate backend for production
-    },
-}
+# Broker shards (unix:///path or tcp://host:port) started with `python manage.py run_channel_broker`.
+# Without brokers notifications only reach sockets held by the same process.
+CHANNEL_BROKERS = env.list('CHANNEL_BROKERS', default=[])
+if CHANNEL_BROKERS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "notifications.layers.ShardedChannelLayer",
+            "CONFIG": {
+                "shards": [
+                    {"BACKEND": "notifications.layers.BrokerChannelLayer", "CONFIG": {"address": address}}
+                    for address in CHANNEL_BROKERS
+                ],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
 
 
 # Internationalization
@@ -164,6 +180,62 @@ AUTH_USER_MODEL = "auth_login.User"
 
 # MAX Circle Radius for optimal driver search
 MAX_RADIUS = 10  # in KM
+
+# In-memory grid index of available drivers used by the optimal driver search
+DRIVER_INDEX_ENABLED = env.bool('DRIVER_INDEX_ENABLED', default=True)
+DRIVER_INDEX_CELL_SIZE = 1  # in KM
+# Rebuild the index from the database after this many seconds to pick up writes from other processes
+DRIVER_INDEX_TTL = 300  # in seconds
+
+# Driver location pings are buffered in memory and written in bulk every flush interval
+DRIVER_LOCATION_FLUSH_INTERVAL = env.float('DRIVER_LOCATION_FLUSH_INTERVAL', default=2)  # in seconds
+# A ping forces a flush when the oldest buffered position is older than this
+DRIVER_LOCATION_MAX_STALENESS = env.float('DRIVER_LOCATION_MAX_STALENESS', default=10)  # in seconds
+
+# Drivers not heard from for this long are left out of matching and marked unavailable
+# by `python manage.py sweep_stale_drivers`; location pings and socket connects count
+DRIVER_HEARTBEAT_TIMEOUT = env.int('DRIVER_HEARTBEAT_TIMEOUT', default=300)  # in seconds
+
+# Ride dispatch: 'nearest' offers a ride to the DISPATCH_TOP_K closest drivers,
+# 'broadcast' offers it to every available driver within MAX_RADIUS and
+# 'batch' leaves new rides to the batch matcher (manage.py run_matcher)
+DISPATCH_MODE = env.str('DISPATCH_MODE', default='nearest')
+DISPATCH_TOP_K = env.int('DISPATCH_TOP_K', default=5)
+# Search radii tried in order until DISPATCH_TOP_K drivers are found
+DISPATCH_RADIUS_RINGS = [2, 5, MAX_RADIUS]  # in KM
+# Ranked candidates kept per ride so a rejection offers the ride to the next one without a new search
+DISPATCH_CANDIDATE_POOL = 20
+DISPATCH_CANDIDATE_TTL = 300  # in seconds
+# Queue backend that dispatches rides outside the request creating them, see rider/dispatch.py
+DISPATCH_BACKEND = env.str('DISPATCH_BACKEND', default='rider.dispatch.InProcessBackend')
+# Concurrent dispatch jobs of the in-process backend
+DISPATCH_WORKERS = 2
+# Batch matcher: pending rides are collected for DISPATCH_BATCH_WINDOW and assigned together
+DISPATCH_BATCH_WINDOW = env.float('DISPATCH_BATCH_WINDOW', default=1.5)  # in seconds
+DISPATCH_BATCH_SIZE = 5000
+# Nearest drivers considered for each ride when building the cost matrix
+DISPATCH_BATCH_CANDIDATES = 20
+# Pickup ETAs: road distance over great-circle distance, and the average speed
+# in KM/h from each hour of the day (local time) until the next band starts
+ETA_ROAD_FACTOR = env.float('ETA_ROAD_FACTOR', default=1.3)
+ETA_SPEED_PROFILE = {0: 40, 7: 22, 10: 30, 16: 20, 20: 32}
+# Seconds a driver has to answer a ride offer, sent to the driver as the expiry of the offer
+DISPATCH_OFFER_TTL = env.int('DISPATCH_OFFER_TTL', default=30)
+# Dispatch rounds of a ride whose offers lapse before it is marked UNFULFILLED
+DISPATCH_MAX_ATTEMPTS = env.int('DISPATCH_MAX_ATTEMPTS', default=3)
+# Resolution of the offer expiry timer wheel, 0 disables its background thread
+OFFER_EXPIRY_TICK = env.float('OFFER_EXPIRY_TICK', default=1)  # in seconds
+# Serialized ride payloads are cached so an event fanned out to many users is serialized once
+NOTIFICATION_PAYLOAD_TTL = 300  # in seconds
+# Last events of every user kept for sockets reconnecting with ?since=<seq>
+NOTIFICATION_REPLAY_SIZE = env.int('NOTIFICATION_REPLAY_SIZE', default=100)
+NOTIFICATION_REPLAY_TTL = 3600  # in seconds
+# Frames waiting to be written to one socket, a full queue drops its oldest frame ('drop')
+# or closes the socket so the client reconnects and replays what it missed ('disconnect')
+SOCKET_SEND_QUEUE_SIZE = env.int('SOCKET_SEND_QUEUE_SIZE', default=64)
+SOCKET_SEND_OVERFLOW = env.str('SOCKET_SEND_OVERFLOW', default='drop')
+# Users with an open socket are published to the cache for this long and refreshed every third of it
+PRESENCE_TTL = env.int('PRESENCE_TTL', default=60)  # in seconds
 locations = {
     'karinkallathani': {
         'latitude': 10.953835531166668,
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+from rider.expiry import offer_timers  # noqa: E402
+
+# Offers made before a restart expire without waiting for a new offer to start the timers
+offer_timers.start()
@@ -20,11 +20,4 @@ class DriverAdmin(admin.ModelAdmin):
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
-        (
-            'Ride Requests',
-            {
-                'fields': ('ride_requests',),
-                'classes': ('collapse',)
-            }
-        )
     )
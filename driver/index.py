@@ -0,0 +1,162 @@
+"""
+index.py
+In-memory spatial index of available drivers.
+
+Drivers are bucketed into a uniform grid of square cells keyed by (row, col).
+A radius query only visits the cells overlapping the search circle instead of
+computing a distance for every available driver, and computes the distances
+of the drivers in those cells in one NumPy step.
+"""
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from base.geo import KM_PER_DEGREE, distances
+from config.settings import DRIVER_INDEX_CELL_SIZE
+
+logger = logging.getLogger("driver")
+
+
+class DriverGridIndex:
+    """
+    Uniform grid index of driver positions.
+
+    cell_size -- Edge length of a grid cell in KM.
+    """
+
+    def __init__(self, cell_size=1):
+        self.cell_size = cell_size
+        self._degrees = cell_size / KM_PER_DEGREE
+        self._cells = {}
+        self._drivers = {}
+        self._lock = threading.RLock()
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self._drivers)
+
+    def __contains__(self, driver_id):
+        return driver_id in self._drivers
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self._degrees)), int(math.floor(lng / self._degrees))
+
+    def update(self, driver_id, lat, lng):
+        """
+        Insert a driver or move it to a new position.
+        """
+        cell = self._cell(lat, lng)
+        with self._lock:
+            previous = self._drivers.get(driver_id)
+            if previous is not None and previous[2] != cell:
+                self._remove_from_cell(driver_id, previous[2])
+            self._drivers[driver_id] = (lat, lng, cell)
+            self._cells.setdefault(cell, set()).add(driver_id)
+
+    def move(self, driver_id, lat, lng):
+        """
+        Move a driver that is already indexed, ignoring drivers that are not.
+
+        Returns:
+        bool -- Whether the driver was indexed.
+        """
+        with self._lock:
+            if driver_id not in self._drivers:
+                return False
+            self.update(driver_id, lat, lng)
+            return True
+
+    def position(self, driver_id):
+        """
+        Indexed (lat, lng) of a driver, or None if it is not indexed.
+        """
+        entry = self._drivers.get(driver_id)
+        return entry[:2] if entry else None
+
+    def discard(self, driver_id):
+        """
+        Remove a driver from the index if present.
+        """
+        with self._lock:
+            previous = self._drivers.pop(driver_id, None)
+            if previous is not None:
+                self._remove_from_cell(driver_id, previous[2])
+
+    def _remove_from_cell(self, driver_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self._cells[cell]
+
+    def load(self, rows):
+        """
+        Replace the contents of the index.
+
+        Args:
+        rows -- Iterable of (driver_id, lat, lng) tuples.
+        """
+        with self._lock:
+            self._cells = {}
+            self._drivers = {}
+            for driver_id, lat, lng in rows:
+                self.update(driver_id, lat, lng)
+            self.loaded_at = time.monotonic()
+
+    def snapshot(self):
+        """
+        Copy the indexed positions.
+
+        Returns:
+        list -- (driver_id, lat, lng) tuples.
+        """
+        with self._lock:
+            return [(driver_id, lat, lng) for driver_id, (lat, lng, _) in self._drivers.items()]
+
+    def is_stale(self, ttl):
+        """
+        Whether the index was never loaded or was loaded more than `ttl` seconds ago.
+        """
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > ttl
+
+    def query(self, lat, lng, radius):
+        """
+        Find drivers within a radius of a point.
+
+        Only the cells overlapping the bounding box of the search circle are visited.
+
+        Args:
+        lat, lng -- Centre of the search in degrees.
+        radius -- Search radius in meters.
+
+        Returns:
+        list -- (driver_id, distance) tuples ordered by distance in meters.
+        """
+        lat_span = radius / 1000 / KM_PER_DEGREE
+        # Longitude degrees shrink towards the poles, so widen the box at the edge closest to them
+        cos_lat = max(math.cos(math.radians(min(abs(lat) + lat_span, 89.0))), 0.01)
+        lng_span = lat_span / cos_lat
+
+        min_row, min_col = self._cell(lat - lat_span, lng - lng_span)
+        max_row, max_col = self._cell(lat + lat_span, lng + lng_span)
+
+        ids, lats, lngs = [], [], []
+        with self._lock:
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    for driver_id in self._cells.get((row, col), ()):
+                        d_lat, d_lng, _ = self._drivers[driver_id]
+                        ids.append(driver_id)
+                        lats.append(d_lat)
+                        lngs.append(d_lng)
+        if not ids:
+            return []
+        found = distances(lat, lng, np.array(lats), np.array(lngs))
+        order = np.argsort(found, kind='stable')
+        return [(ids[i], float(found[i])) for i in order if found[i] <= radius]
+
+
+driver_index = DriverGridIndex(cell_size=DRIVER_INDEX_CELL_SIZE)
@@ -0,0 +1,145 @@
+"""
+location.py
+Write-behind buffer for driver location pings.
+
+Pings only replace the latest position of the driver in memory and move the
+driver in the matching index. Available drivers missing from the index are
+added to it when their position is flushed. A background thread writes the buffered
+positions to Driver.location with one bulk_update every flush interval, so
+repeated pings of the same driver between flushes cost a single row update.
+The time of the latest ping is written as the heartbeat of the driver.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.contrib.gis.geos import Point
+from django.db import close_old_connections
+from django.utils import timezone
+
+from base.metrics import metrics
+from config.settings import DRIVER_LOCATION_FLUSH_INTERVAL, DRIVER_LOCATION_MAX_STALENESS
+from driver.index import driver_index
+from driver.models import Driver, index_available_drivers
+
+logger = logging.getLogger("driver")
+
+
+class LocationBuffer:
+    """
+    Latest reported position of each driver, waiting to be written to the database.
+
+    flush_interval -- Seconds between background flushes, 0 disables the background thread.
+    max_staleness -- A ping flushes synchronously when the oldest buffered position is older than this.
+    index -- Index moved on every ping so matching sees fresh positions before they are flushed.
+    """
+
+    def __init__(self, flush_interval=DRIVER_LOCATION_FLUSH_INTERVAL, max_staleness=DRIVER_LOCATION_MAX_STALENESS,
+                 index=driver_index):
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.index = index
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._oldest = None
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def ingest(self, driver_id, lat, lng):
+        """
+        Record the position of a driver.
+
+        Args:
+        driver_id -- Id of the Driver.
+        lat, lng -- Reported position in degrees.
+
+        Returns:
+        None
+        """
+        now = time.time()
+        with self._lock:
+            coalesced = driver_id in self._pending
+            self._pending[driver_id] = (lat, lng, now)
+            if self._oldest is None:
+                self._oldest = now
+            stale = now - self._oldest > self.max_staleness
+
+        self.index.move(driver_id, lat, lng)
+        metrics.incr('location.pings')
+        if coalesced:
+            metrics.incr('location.coalesced')
+
+        if self.flush_interval:
+            self._start()
+        if stale:
+            self.flush()
+
+    def get(self, driver_id):
+        """
+        Buffered (lat, lng) of a driver, or None if nothing is waiting to be flushed.
+        """
+        position = self._pending.get(driver_id)
+        return position[:2] if position else None
+
+    def flush(self):
+        """
+        Write every buffered position with a single bulk update.
+
+        Positions that fail to save are put back unless a newer ping replaced them.
+
+        Returns:
+        int -- Number of drivers updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._oldest = None
+        if not pending:
+            return 0
+
+        now = timezone.now()
+        drivers = [
+            Driver(id=driver_id, location=Point(lng, lat), updated_at=now,
+                   last_seen_at=datetime.fromtimestamp(seen, tz=dt_timezone.utc))
+            for driver_id, (lat, lng, seen) in pending.items()
+        ]
+        try:
+            with metrics.time('location.flush'):
+                Driver.objects.bulk_update(drivers, ['location', 'updated_at', 'last_seen_at'], batch_size=500)
+        except Exception as e:
+            logger.error(f"Error flushing {len(pending)} driver locations: {e}")
+            with self._lock:
+                for driver_id, position in pending.items():
+                    self._pending.setdefault(driver_id, position)
+                self._oldest = min(position[2] for position in self._pending.values())
+            return 0
+
+        metrics.incr('location.flushed', len(drivers))
+        try:
+            # Drivers that ping without being indexed become matchable once their position is saved
+            index_available_drivers(list(pending), self.index)
+        except Exception as e:
+            logger.error(f"Error indexing {len(pending)} flushed drivers: {e}")
+        return len(drivers)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='location-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            self.flush()
+
+
+location_buffer = LocationBuffer()
+atexit.register(location_buffer.flush)
+metrics.gauge('location.buffered', lambda: len(location_buffer))
@@ -0,0 +1,74 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.geo import haversine
+from config.settings import MAX_RADIUS, DRIVER_INDEX_CELL_SIZE
+from driver.index import DriverGridIndex
+
+
+class Command(BaseCommand):
+    help = 'Benchmark radius queries on the in-memory driver index against a full scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--counts',
+            nargs='+',
+            type=int,
+            default=[1000, 10000, 100000],
+            help='Driver counts to benchmark'
+        )
+        parser.add_argument(
+            '--queries',
+            type=int,
+            default=200,
+            help='Number of radius queries per driver count'
+        )
+        parser.add_argument(
+            '--area',
+            type=float,
+            default=100,
+            help='Edge length in KM of the square the drivers are spread over'
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        # Centre the synthetic fleet on Perinthalmanna
+        centre_lat, centre_lng = 10.976, 76.212
+        span = options['area'] / 111.32 / 2
+        radius = MAX_RADIUS * 1000
+
+        self.stdout.write(self.style.NOTICE(
+            f'Radius {MAX_RADIUS} km, cell size {DRIVER_INDEX_CELL_SIZE} km, {options["queries"]} queries per run'))
+        self.stdout.write(f'{"drivers":>10} {"index ms/query":>16} {"scan ms/query":>15} {"speedup":>9}')
+
+        for count in options['counts']:
+            drivers = [
+                (driver_id, centre_lat + rng.uniform(-span, span), centre_lng + rng.uniform(-span, span))
+                for driver_id in range(count)
+            ]
+            index = DriverGridIndex(cell_size=DRIVER_INDEX_CELL_SIZE)
+            index.load(drivers)
+            points = [
+                (centre_lat + rng.uniform(-span, span), centre_lng + rng.uniform(-span, span))
+                for _ in range(options['queries'])
+            ]
+
+            start = time.perf_counter()
+            for lat, lng in points:
+                index.query(lat, lng, radius)
+            index_ms = (time.perf_counter() - start) * 1000 / len(points)
+
+            start = time.perf_counter()
+            for lat, lng in points:
+                sorted((
+                    (driver_id, distance) for driver_id, distance in (
+                        (driver_id, haversine(lat, lng, d_lat, d_lng)) for driver_id, d_lat, d_lng in drivers
+                    ) if distance <= radius
+                ), key=lambda item: item[1])
+            scan_ms = (time.perf_counter() - start) * 1000 / len(points)
+
+            self.stdout.write(f'{count:>10} {index_ms:>16.3f} {scan_ms:>15.3f} {scan_ms / index_ms:>8.1f}x')
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete!'))
@@ -0,0 +1,66 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from config.settings import DRIVER_INDEX_CELL_SIZE
+from driver.index import DriverGridIndex
+from driver.location import LocationBuffer
+
+
+class NullIndex:
+    def move(self, driver_id, lat, lng):
+        return False
+
+
+class Command(BaseCommand):
+    help = 'Benchmark ingest throughput of the driver location buffer'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--drivers',
+            type=int,
+            default=10000,
+            help='Number of drivers sending pings'
+        )
+        parser.add_argument(
+            '--pings',
+            type=int,
+            default=200000,
+            help='Total number of pings to ingest'
+        )
+        parser.add_argument(
+            '--flush',
+            action='store_true',
+            help='Also flush the buffered positions to the database (writes to the Driver table)'
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        centre_lat, centre_lng = 10.976, 76.212
+        drivers = options['drivers']
+        pings = [
+            (rng.randrange(drivers), centre_lat + rng.uniform(-0.5, 0.5), centre_lng + rng.uniform(-0.5, 0.5))
+            for _ in range(options['pings'])
+        ]
+
+        index = DriverGridIndex(cell_size=DRIVER_INDEX_CELL_SIZE)
+        index.load((driver_id, centre_lat, centre_lng) for driver_id in range(drivers))
+
+        self.stdout.write(self.style.NOTICE(f'{len(pings)} pings from {drivers} drivers'))
+        self.stdout.write(f'{"index":>10} {"pings/s":>12} {"buffered":>10}')
+        for name, target in (('none', NullIndex()), ('grid', index)):
+            buffer = LocationBuffer(flush_interval=0, max_staleness=float('inf'), index=target)
+            start = time.perf_counter()
+            for driver_id, lat, lng in pings:
+                buffer.ingest(driver_id, lat, lng)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{name:>10} {len(pings) / elapsed:>12.0f} {len(buffer):>10}')
+
+        if options['flush']:
+            start = time.perf_counter()
+            flushed = buffer.flush()
+            elapsed = (time.perf_counter() - start) * 1000
+            self.stdout.write(f'Flushed {flushed} drivers with bulk_update in {elapsed:.1f} ms')
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete!'))
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from config.settings import DRIVER_HEARTBEAT_TIMEOUT
+from driver.services import mark_stale_drivers_offline
+
+
+class Command(BaseCommand):
+    help = 'Mark available drivers who stopped sending heartbeats unavailable'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--timeout',
+            type=int,
+            default=DRIVER_HEARTBEAT_TIMEOUT,
+            help='Seconds of silence after which a driver is marked unavailable'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=60,
+            help='Seconds between sweeps'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single sweep and exit'
+        )
+
+    def handle(self, *args, **options):
+        if options['once']:
+            swept = mark_stale_drivers_offline(options['timeout'])
+            self.stdout.write(self.style.SUCCESS(f'{len(swept)} drivers marked unavailable'))
+            return
+
+        self.stdout.write(self.style.NOTICE(
+            f'Marking drivers silent for {options["timeout"]}s unavailable every {options["interval"]}s...'))
+        while True:
+            started = time.monotonic()
+            mark_stale_drivers_offline(options['timeout'])
+            time.sleep(max(options['interval'] - (time.monotonic() - started), 0))
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('driver', '0002_initial'),
+        ('rider', '0003_rideoffer'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='driver',
+            name='ride_requests',
+        ),
+    ]
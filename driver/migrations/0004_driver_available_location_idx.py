@@ -0,0 +1,17 @@
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('driver', '0003_remove_driver_ride_requests'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='driver',
+            index=django.contrib.postgres.indexes.GistIndex(
+                condition=models.Q(('available', True)), fields=['location'], name='driver_available_location_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('driver', '0004_driver_available_location_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driver',
+            name='last_seen_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        # Existing drivers were last heard from when their row last changed
+        migrations.RunSQL(
+            'UPDATE driver_driver SET last_seen_at = updated_at',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='driver',
+            index=models.Index(
+                condition=models.Q(('available', True)), fields=['last_seen_at'], name='driver_available_seen_idx'),
+        ),
+    ]
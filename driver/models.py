@@ -1,6 +1,27 @@
+from datetime import timedelta
+
 from django.contrib.gis.db import models
+from django.contrib.postgres.indexes import GistIndex
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 
 from auth_login.models import User
+from config.settings import DRIVER_HEARTBEAT_TIMEOUT
+from driver.index import driver_index
+
+
+class DriverQuerySet(models.QuerySet):
+    def available(self):
+        """
+        Available drivers heard from within DRIVER_HEARTBEAT_TIMEOUT.
+
+        Drivers who closed the app without going unavailable stop being matched
+        once they fall silent, before the sweeper marks them unavailable.
+        """
+        return self.filter(
+            available=True, last_seen_at__gte=timezone.now() - timedelta(seconds=DRIVER_HEARTBEAT_TIMEOUT))
 
 
 class Driver(models.Model):
@@ -12,8 +33,59 @@ class Driver(models.Model):
     available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    objects = models.Manager()
-    ride_requests = models.ManyToManyField('rider.Ride', related_name='drivers', blank=True)
+    # Last location ping or socket connect or disconnect of the driver
+    last_seen_at = models.DateTimeField(default=timezone.now)
+    objects = DriverQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.user.full_name}'s {self.model}"
+
+    class Meta:
+        # The driver search only looks at available drivers, see rider.utils.available_drivers_near
+        indexes = [
+            GistIndex(fields=['location'], name='driver_available_location_idx', condition=Q(available=True)),
+            # Stale driver sweep, see driver.services.mark_stale_drivers_offline
+            models.Index(fields=['last_seen_at'], name='driver_available_seen_idx', condition=Q(available=True)),
+        ]
+
+
+@receiver(post_save, sender=Driver)
+def sync_driver_index(sender, instance, **kwargs):
+    """
+    Keep the in-memory driver index in step with saved drivers.
+    """
+    if instance.available and instance.location:
+        driver_index.update(instance.id, instance.location.y, instance.location.x)
+    else:
+        driver_index.discard(instance.id)
+
+
+@receiver(post_delete, sender=Driver)
+def remove_driver_from_index(sender, instance, **kwargs):
+    driver_index.discard(instance.id)
+
+
+def index_available_drivers(driver_ids, index=driver_index):
+    """
+    Add the available drivers among `driver_ids` that are missing from the driver index.
+
+    Location pings and heartbeats are written with UPDATEs, which send no post_save,
+    so drivers left out of the index, such as drivers silent at its last rebuild,
+    are added back here when they are heard from again.
+
+    Args:
+    driver_ids -- Ids of the Drivers.
+    index -- The DriverGridIndex to add them to.
+
+    Returns:
+    int -- Number of drivers added.
+    """
+    missing = [driver_id for driver_id in driver_ids if driver_id not in index]
+    if not missing:
+        return 0
+    drivers = Driver.objects.available().filter(id__in=missing, location__isnull=False).values_list('id', 'location')
+    added = 0
+    for driver_id, location in drivers:
+        index.update(driver_id, location.y, location.x)
+        added += 1
+    return added
@@ -39,4 +39,6 @@ class DriverSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
 
 
-
+class DriverLocationSerializer(serializers.Serializer):
+    latitude = serializers.FloatField(min_value=-90, max_value=90)
+    longitude = serializers.FloatField(min_value=-180, max_value=180)
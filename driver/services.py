@@ -0,0 +1,217 @@
+"""
+services.py
+Driver actions shared by the HTTP views and the notification socket.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from base.geo import arrival, haversine
+from base.metrics import metrics
+from config.settings import DRIVER_HEARTBEAT_TIMEOUT
+from notifications.events import event_messages
+from notifications.utils import send_messages_to_channels
+from rider.dispatch import enqueue_dispatch
+from rider.expiry import offer_timers
+from rider.models import Ride, RideOffer
+from rider.utils import reject_ride_offer, ride_event_key, ride_payload
+from .index import driver_index
+from .location import location_buffer
+from .models import Driver, index_available_drivers, sync_driver_index
+
+logger = logging.getLogger("rider")
+
+
+def driver_rides(driver_id):
+    """
+    Rides a driver can act on: the rides they drive and the rides with a live offer to them.
+
+    Args:
+    driver_id -- Id of the Driver.
+
+    Returns:
+    Queryset -- Ride objects.
+    """
+    offered = RideOffer.objects.live().filter(driver=driver_id).values('ride_id')
+    return Ride.objects.filter(Q(driver=driver_id) | Q(id__in=offered))
+
+
+def accept_ride(ride, driver):
+    """
+    Assign a ride to a driver who accepted its offer.
+
+    The ride and the driver are claimed with conditional UPDATEs, so of several
+    drivers accepting the same ride at once exactly one wins, without locking
+    or reading the rows first.
+
+    Args:
+    ride -- The Ride being accepted.
+    driver -- The Driver accepting it.
+
+    Returns:
+    bool -- False when the ride already has a driver or the driver is not available.
+    """
+    now = timezone.now()
+    eta = pickup_eta(ride, driver, now)
+    with transaction.atomic():
+        claimed = Ride.objects.filter(id=ride.id, status='PENDING', driver__isnull=True).update(
+            driver=driver.id, status='IN_PROGRESS', eta=eta, updated_at=now)
+        if not claimed:
+            logger.warning(f"Ride {ride.id} cannot be accepted, it is no longer pending")
+            return False
+        if not Driver.objects.filter(id=driver.id, available=True).update(available=False, updated_at=now):
+            logger.warning(f"Ride {ride.id} cannot be accepted, driver {driver.id} is not available")
+            transaction.set_rollback(True)
+            return False
+
+        withdrawn = list(RideOffer.objects.active().filter(ride=ride).exclude(
+            driver=driver).values_list('driver__user_id', flat=True))
+        # The other offers of the ride and the other offers to the driver are withdrawn
+        RideOffer.objects.active().filter(Q(ride=ride) | Q(driver=driver)).exclude(
+            ride=ride, driver=driver).update(state=RideOffer.WITHDRAWN)
+        RideOffer.objects.filter(ride=ride, driver=driver).update(state=RideOffer.ACCEPTED)
+
+    ride.driver, ride.status, ride.eta, ride.updated_at = driver, 'IN_PROGRESS', eta, now
+    offer_timers.cancel(ride.id)
+    driver.available = False
+    # UPDATE does not send post_save, so the driver index is updated here
+    sync_driver_index(Driver, driver)
+
+    logger.info(f"Ride {ride.id} accepted by driver {driver.id}")
+    # The rider and the accepting driver are told in the same batch as the drivers whose offer is withdrawn
+    payload = ride_payload(ride)
+    send_messages_to_channels([
+        *event_messages([driver.user_id, ride.rider_id], 'ride.accepted', payload, ride_event_key(ride.id)),
+        *event_messages(withdrawn, 'ride.withdrawn', payload, ride_event_key(ride.id)),
+    ])
+    return True
+
+
+def pickup_eta(ride, driver, when=None):
+    """
+    Estimate when a driver reaches the pickup location of a ride from its latest known position.
+
+    The position is the last buffered ping, else the driver index, else the saved location.
+
+    Args:
+    ride -- The Ride instance.
+    driver -- The Driver instance.
+    when -- Aware datetime the driver sets off, now by default.
+
+    Returns:
+    datetime -- Estimated time of arrival, None without a pickup location or a driver position.
+    """
+    if not ride.pickup_location:
+        return None
+    position = location_buffer.get(driver.id) or driver_index.position(driver.id)
+    if position is None and driver.location:
+        position = driver.location.y, driver.location.x
+    if position is None:
+        return None
+    return arrival(haversine(*position, ride.pickup_location.y, ride.pickup_location.x), when)
+
+
+def complete_ride(ride, driver):
+    """
+    Complete a ride in progress and make its driver available again, with conditional UPDATEs.
+
+    Args:
+    ride -- The Ride being completed.
+    driver -- The Driver of the ride.
+
+    Returns:
+    bool -- False when the ride is not in progress with this driver.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        completed = Ride.objects.filter(id=ride.id, driver=driver.id, status='IN_PROGRESS').update(
+            status='COMPLETED', updated_at=now)
+        if not completed:
+            return False
+        Driver.objects.filter(id=driver.id).update(available=True, updated_at=now, last_seen_at=now)
+
+    ride.status, ride.updated_at = 'COMPLETED', now
+    driver.available = True
+    sync_driver_index(Driver, driver)
+    logger.info(f"Ride {ride.id} completed by driver {driver.id}")
+    return True
+
+
+def reject_ride(ride, driver):
+    """
+    Reject a ride offer and offer the ride to the next candidate driver.
+
+    Args:
+    ride -- The Ride being rejected.
+    driver -- The Driver rejecting it.
+
+    Returns:
+    None
+    """
+    with transaction.atomic():
+        logger.info(f"Rejecting ride {ride.id} for driver {driver.id}")
+        if not reject_ride_offer(ride, driver):
+            logger.info(f"Queueing ride {ride.id} to find another driver")
+            enqueue_dispatch(ride.id)
+
+
+def update_location(driver_id, lat, lng):
+    """
+    Record a location ping of a driver, see driver.location.
+
+    Args:
+    driver_id -- Id of the Driver.
+    lat, lng -- Reported position in degrees.
+
+    Returns:
+    None
+    """
+    location_buffer.ingest(driver_id, lat, lng)
+
+
+def record_heartbeat(driver_id):
+    """
+    Record that a driver was heard from, for socket connects and disconnects.
+
+    Location pings record it when they are flushed, see driver.location. A driver
+    left out of the index while silent is matchable again from its heartbeat.
+
+    Args:
+    driver_id -- Id of the Driver.
+
+    Returns:
+    None
+    """
+    Driver.objects.filter(id=driver_id).update(last_seen_at=timezone.now())
+    index_available_drivers([driver_id])
+
+
+def mark_stale_drivers_offline(timeout=DRIVER_HEARTBEAT_TIMEOUT):
+    """
+    Mark the available drivers not heard from for `timeout` seconds unavailable, in bulk.
+
+    The silent rows are locked until they are marked, rows locked by another
+    transaction, such as a driver accepting a ride, are left for the next sweep.
+
+    Args:
+    timeout -- Seconds of silence after which a driver is marked unavailable.
+
+    Returns:
+    list -- Ids of the drivers marked unavailable.
+    """
+    now = timezone.now()
+    stale = Driver.objects.filter(available=True, last_seen_at__lt=now - timedelta(seconds=timeout))
+    with transaction.atomic():
+        driver_ids = list(stale.select_for_update(skip_locked=True).values_list('id', flat=True))
+        if not driver_ids:
+            return []
+        Driver.objects.filter(id__in=driver_ids).update(available=False, updated_at=now)
+    # UPDATE does not send post_save, so the driver index is updated here
+    for driver_id in driver_ids:
+        driver_index.discard(driver_id)
+    metrics.incr('drivers.swept', len(driver_ids))
+    logger.info(f"Marked {len(driver_ids)} silent drivers unavailable")
+    return driver_ids
@@ -1,11 +1,27 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.test import APITestCase
 
+from auth_login.authentication import ClaimsUser
 from auth_login.models import User
+from auth_login.tokens import RefreshToken
 from config.settings import locations
+from driver.index import DriverGridIndex
+from driver import services
+from driver.location import LocationBuffer
 from driver.models import Driver
-from rider.models import Ride
+from rider.models import Ride, RideOffer
+from rider.utils import check_driver_index, find_optimal_drivers, get_driver_index
 
 
 class DriverViewSetTest(APITestCase):
@@ -96,6 +112,7 @@ class DriverViewSetTest(APITestCase):
         self.assertEqual(User.objects.count(), 1)
 
 
+@override_settings(DISPATCH_BACKEND='rider.dispatch.ImmediateBackend')
 class DriverRideAPIViewTestCase(APITestCase):
     fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
 
@@ -110,11 +127,12 @@ class DriverRideAPIViewTestCase(APITestCase):
         self.ride = Ride.objects.get(name='Ride 2')
 
     def create_ride(self, name='Ride 2'):
-        self.client.post(reverse('ride-list'), {
-            'name': name,
-            'pickup_location': locations['karinkallathani'],
-            'dropoff_location': locations['mannarkkad']
-        }, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('ride-list'), {
+                'name': name,
+                'pickup_location': locations['karinkallathani'],
+                'dropoff_location': locations['mannarkkad']
+            }, format='json')
 
     def test_accept_ride(self):
         response = self.client.post(f'/driver/ride/{self.ride.id}/accept/')
@@ -124,8 +142,10 @@ class DriverRideAPIViewTestCase(APITestCase):
         self.assertEqual(self.ride.driver, self.driver)
         self.assertEqual(self.ride.status, 'IN_PROGRESS')
         self.assertFalse(self.driver.available)
-        for driver in self.ride.drivers.all():
-            self.assertFalse(driver.rejected_rides.filter(id=self.ride.id).exists())
+        self.assertGreaterEqual(self.ride.eta, self.ride.updated_at)
+        self.assertEqual(self.ride.offers.get(driver=self.driver).state, RideOffer.ACCEPTED)
+        self.assertFalse(self.ride.offers.active().exists())
+        self.assertFalse(self.ride.rejected_drivers.exists())
 
     def test_complete_ride(self):
         self.client.force_authenticate(user=self.user)
@@ -147,5 +167,209 @@ class DriverRideAPIViewTestCase(APITestCase):
         self.ride.refresh_from_db()
         self.driver.refresh_from_db()
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertFalse(self.driver.ride_requests.filter(id=self.ride.id).exists())
+        self.assertFalse(self.driver.offers.live().filter(ride=self.ride).exists())
         self.assertTrue(self.ride.rejected_drivers.filter(id=self.driver.id).exists())
+
+    def test_token_of_deleted_driver_is_rejected(self):
+        token = RefreshToken.for_user(self.user).access_token
+        user = ClaimsUser(token)
+        Driver.objects.filter(id=self.driver.id).delete()
+        with self.assertRaises(AuthenticationFailed):
+            user.driver
+        self.client.force_authenticate(user=None)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        with mock.patch('driver.views.DriverRideViewSet.get_object', return_value=self.ride):
+            response = self.client.post(f'/driver/ride/{self.ride.id}/accept/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(DISPATCH_BACKEND='rider.dispatch.ImmediateBackend')
+class ConcurrentAcceptTestCase(TransactionTestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def test_parallel_accepts_have_one_winner(self):
+        ride = Ride.objects.create(
+            rider=User.objects.get(email="rider1@gmail.com"), name='contested',
+            pickup_location=Point(locations['karinkallathani']['longitude'], locations['karinkallathani']['latitude']))
+        drivers = list(Driver.objects.filter(available=True))
+        barrier = threading.Barrier(len(drivers))
+
+        def accept(driver):
+            try:
+                contested = Ride.objects.get(id=ride.id)
+                barrier.wait()
+                return services.accept_ride(contested, driver)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(len(drivers)) as pool:
+            results = list(pool.map(accept, drivers))
+
+        self.assertEqual(results.count(True), 1)
+        winner = drivers[results.index(True)]
+        ride.refresh_from_db()
+        self.assertEqual((ride.driver_id, ride.status), (winner.id, 'IN_PROGRESS'))
+        # Only the winner was made unavailable
+        unavailable = Driver.objects.filter(id__in=[driver.id for driver in drivers], available=False)
+        self.assertEqual(list(unavailable.values_list('id', flat=True)), [winner.id])
+
+
+class DriverGridIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.index = DriverGridIndex(cell_size=1)
+        for driver_id, location in enumerate(locations.values()):
+            self.index.update(driver_id, location['latitude'], location['longitude'])
+
+    def test_query_returns_nearby_drivers_by_distance(self):
+        centre = locations['karinkallathani']
+        results = self.index.query(centre['latitude'], centre['longitude'], 10000)
+        self.assertEqual([driver_id for driver_id, _ in results], [0, 1, 4])
+        self.assertEqual(results[0][1], 0)
+
+    def test_move_and_discard(self):
+        centre = locations['mannarkkad']
+        self.index.update(0, centre['latitude'], centre['longitude'])
+        results = self.index.query(centre['latitude'], centre['longitude'], 1000)
+        self.assertIn(0, [driver_id for driver_id, _ in results])
+        self.index.discard(0)
+        self.assertNotIn(0, self.index)
+        self.assertEqual(len(self.index), len(locations) - 1)
+
+
+class DriverIndexConsistencyTestCase(TestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def test_index_matches_postgis(self):
+        get_driver_index().loaded_at = None
+        for location in locations.values():
+            missing, unexpected = check_driver_index(Point(location['longitude'], location['latitude']))
+            self.assertEqual(missing, set())
+            self.assertEqual(unexpected, set())
+
+    def test_index_follows_driver_saves(self):
+        driver = Driver.objects.get(user__email="driver4@gmail.com")
+        index = get_driver_index()
+        self.assertIn(driver.id, index)
+        driver.available = False
+        driver.save()
+        self.assertNotIn(driver.id, index)
+
+
+class LocationBufferTestCase(APITestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def setUp(self):
+        self.driver = Driver.objects.get(user__email="driver4@gmail.com")
+        self.index = DriverGridIndex(cell_size=1)
+        self.index.update(self.driver.id, self.driver.location.y, self.driver.location.x)
+        self.buffer = LocationBuffer(flush_interval=0, max_staleness=60, index=self.index)
+
+    def test_repeat_pings_are_coalesced(self):
+        start, end = locations['perinthalmanna'], locations['mannarkkad']
+        self.buffer.ingest(self.driver.id, start['latitude'], start['longitude'])
+        self.buffer.ingest(self.driver.id, end['latitude'], end['longitude'])
+        self.assertEqual(len(self.buffer), 1)
+        self.assertEqual(self.buffer.get(self.driver.id), (end['latitude'], end['longitude']))
+        # The index sees the new position before it is written to the database
+        nearby = self.index.query(end['latitude'], end['longitude'], 100)
+        self.assertEqual([driver_id for driver_id, _ in nearby], [self.driver.id])
+
+    def test_flush_writes_latest_location(self):
+        end = locations['mannarkkad']
+        Driver.objects.filter(id=self.driver.id).update(last_seen_at=timezone.now() - timedelta(hours=1))
+        self.buffer.ingest(self.driver.id, end['latitude'], end['longitude'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.driver.refresh_from_db()
+        self.assertAlmostEqual(self.driver.location.y, end['latitude'])
+        self.assertAlmostEqual(self.driver.location.x, end['longitude'])
+        # The ping is the heartbeat of the driver
+        self.assertGreater(self.driver.last_seen_at, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_location_endpoint_accepts_ping(self):
+        self.client.force_authenticate(user=self.driver.user)
+        with mock.patch('driver.services.location_buffer', self.buffer):
+            response = self.client.post(
+                reverse('driver-location'), {'latitude': 10.99, 'longitude': 76.46}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(self.buffer.get(self.driver.id), (10.99, 76.46))
+            response = self.client.post(reverse('driver-location'), {'latitude': 91, 'longitude': 76.46}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_location_ping_with_token_claims_does_not_query(self):
+        token = RefreshToken.for_user(self.driver.user)
+        self.assertEqual((token['role'], token['driver_id']), ('driver', self.driver.id))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token.access_token}')
+        with mock.patch('driver.services.location_buffer', self.buffer), self.assertNumQueries(0):
+            response = self.client.post(
+                reverse('driver-location'), {'latitude': 10.99, 'longitude': 76.46}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.buffer.get(self.driver.id), (10.99, 76.46))
+
+    def test_rider_token_is_not_a_driver(self):
+        token = RefreshToken.for_user(User.objects.get(email="rider1@gmail.com"))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token.access_token}')
+        response = self.client.post(reverse('driver-location'), {'latitude': 10.99, 'longitude': 76.46}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(DISPATCH_BACKEND='rider.dispatch.ImmediateBackend')
+class UnindexedDriverTestCase(TestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def setUp(self):
+        self.driver = Driver.objects.get(user__email="driver4@gmail.com")
+        get_driver_index().loaded_at = None
+        get_driver_index()
+
+    def offered(self, place):
+        with self.captureOnCommitCallbacks(execute=True):
+            ride = Ride.objects.create(rider=User.objects.get(email="rider1@gmail.com"), name='Ping',
+                                       pickup_location=Point(place['longitude'], place['latitude']))
+        return set(ride.offers.live().values_list('driver_id', flat=True))
+
+    def test_driver_without_location_is_offered_rides_after_pinging(self):
+        self.driver.location = None
+        self.driver.save()
+        self.assertNotIn(self.driver.id, get_driver_index())
+
+        place = locations['mannarkkad']
+        buffer = LocationBuffer(flush_interval=0, max_staleness=60)
+        buffer.ingest(self.driver.id, place['latitude'], place['longitude'])
+        self.assertEqual(buffer.flush(), 1)
+        self.assertIn(self.driver.id, get_driver_index())
+        self.assertIn(self.driver.id, self.offered(place))
+
+
+class StaleDriverTestCase(TestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def setUp(self):
+        self.silent = Driver.objects.get(user__email="driver4@gmail.com")
+        Driver.objects.filter(id=self.silent.id).update(last_seen_at=timezone.now() - timedelta(hours=1))
+        get_driver_index().loaded_at = None
+
+    def test_silent_drivers_are_not_matched(self):
+        self.assertFalse(Driver.objects.available().filter(id=self.silent.id).exists())
+        self.assertNotIn(self.silent.id, get_driver_index())
+        ride = Ride.objects.create(rider=User.objects.get(email="rider1@gmail.com"), name='Ghost',
+                                   pickup_location=self.silent.location)
+        self.assertNotIn(self.silent.id, [driver.id for driver in find_optimal_drivers(ride, use_index=False)])
+
+    def test_silent_driver_is_matched_again_after_heartbeat(self):
+        self.assertNotIn(self.silent.id, get_driver_index())
+        services.record_heartbeat(self.silent.id)
+        self.assertIn(self.silent.id, get_driver_index())
+        ride = Ride.objects.create(rider=User.objects.get(email="rider1@gmail.com"), name='Back',
+                                   pickup_location=self.silent.location)
+        self.assertIn(self.silent.id, [driver.id for driver in find_optimal_drivers(ride)])
+
+    def test_sweep_marks_silent_drivers_unavailable(self):
+        available = set(Driver.objects.filter(available=True).values_list('id', flat=True))
+        self.assertEqual(services.mark_stale_drivers_offline(), [self.silent.id])
+        self.silent.refresh_from_db()
+        self.assertFalse(self.silent.available)
+        self.assertEqual(set(Driver.objects.filter(available=True).values_list('id', flat=True)),
+                         available - {self.silent.id})
+        self.assertEqual(services.mark_stale_drivers_offline(), [])
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from .views import DriverViewSet, DriverRideViewSet
+from .views import DriverViewSet, DriverRideViewSet, DriverLocationView
 
 router = DefaultRouter()
 
@@ -13,6 +13,7 @@ urlpatterns = [
         'patch': 'perform_update',
         'delete': 'perform_destroy'
     }), name='driver'),
+    path('location/', DriverLocationView.as_view(), name='driver-location'),
     path('', include(router.urls)),
 
 ]
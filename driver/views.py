@@ -1,22 +1,23 @@
 import logging
 
-from django.db import transaction
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import permissions, status
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import MethodNotAllowed
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from auth_login.authentication import StatelessJWTAuthentication, get_driver_id
+from auth_login.tokens import token_response
 from base.permissions import IsDriver
-from notifications.utils import send_message_to_channel
 from rider.models import Ride
+from rider.pagination import RideCursorPagination
 from rider.serializers import DriverRideSerializer
-from rider.utils import add_ride_to_driver_ride_requests
 from .models import Driver
-from .serializers import DriverSerializer
+from .serializers import DriverSerializer, DriverLocationSerializer
+from . import services
 
 logger = logging.getLogger("rider")
 
@@ -60,15 +61,17 @@ class DriverViewSet(viewsets.ViewSet):
         """
         Create a new Driver instance.
 
+        The response carries new tokens, as the claims of the current ones do not include the driver.
+
         Returns:
-        Response -- Serialized Driver details with HTTP 201 Created status.
+        Response -- Serialized Driver details and tokens with HTTP 201 Created status.
         """
         serializer = self.serializer_class(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
         serializer.save()
 
         logger.info("Driver created for user: %s", request.user)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response({**serializer.data, **token_response(request.user)}, status=status.HTTP_201_CREATED)
 
     def perform_update(self, request):
         """
@@ -107,21 +110,52 @@ class DriverViewSet(viewsets.ViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class DriverLocationView(APIView):
+    """
+    Lightweight ingest of driver location pings.
+
+    Pings are buffered and written to the database in bulk, see driver.location.
+    The driver is read from the token claims, so a ping makes no database query.
+    """
+
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [IsDriver]
+
+    @swagger_auto_schema(
+        request_body=DriverLocationSerializer,
+        responses={202: 'Location accepted', 400: 'Invalid location'},
+    )
+    def post(self, request):
+        """
+        Record the current location of the logged-in Driver.
+
+        Returns:
+        Response -- HTTP 202 Accepted once the location is buffered.
+        """
+        serializer = DriverLocationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        services.update_location(
+            get_driver_id(request.user), serializer.validated_data['latitude'], serializer.validated_data['longitude'])
+        return Response(status=status.HTTP_202_ACCEPTED)
+
+
 class DriverRideViewSet(viewsets.ModelViewSet):
     """
     A viewset for handling DriverRide operations.
 
     queryset -- All Ride objects.
     serializer_class -- The serializer class for DriverRide model.
+    authentication_classes -- The driver is read from the token claims, its row is only loaded to act on a ride.
     permission_classes -- Only drivers are allowed.
-    pagination_class -- PageNumberPagination for listing rides.
+    pagination_class -- Cursor pagination for listing rides, see rider.pagination.
     http_method_names -- Only allow GET and POST methods.
     """
 
     queryset = Ride.objects.all()
     serializer_class = DriverRideSerializer
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsDriver]
-    pagination_class = PageNumberPagination
+    pagination_class = RideCursorPagination
     http_method_names = ['get', 'post']
 
     def get_queryset(self):
@@ -133,9 +167,7 @@ class DriverRideViewSet(viewsets.ModelViewSet):
         """
         if self.request.user.is_anonymous:
             return Ride.objects.none()
-        driver_rides = Ride.objects.filter(driver=self.request.user.driver)
-        ride_requests = self.request.user.driver.ride_requests.all()
-        return driver_rides | ride_requests
+        return services.driver_rides(get_driver_id(self.request.user))
 
     def perform_create(self, serializer):
         """
@@ -175,21 +207,10 @@ class DriverRideViewSet(viewsets.ModelViewSet):
         ride = self.get_object()
         driver = request.user.driver
 
-        if ride.driver or not driver.available:
-            logger.warning("Ride cannot be accepted. Driver not available or already assigned.")
+        if not services.accept_ride(ride, driver):
             return Response({'message': 'Ride cannot be accepted'}, status=status.HTTP_400_BAD_REQUEST)
 
-        with transaction.atomic():
-            driver.available = False
-            driver.save()
-            ride.drivers.clear()
-            driver.ride_requests.clear()
-            send_message_to_channel(f"notification__{driver.user.id}", "Ride Accept")
-            ride.driver = driver
-            ride.status = 'IN_PROGRESS'
-            ride.save()
-
-        logger.info("Ride accepted by driver %s for ride %s", driver.user.full_name, ride.id)
+        logger.info("Ride accepted by driver %s for ride %s", driver.id, ride.id)
         return Response({'message': 'Ride accepted'}, status=status.HTTP_200_OK)
 
     @swagger_auto_schema(
@@ -209,18 +230,11 @@ class DriverRideViewSet(viewsets.ModelViewSet):
         """
         ride = self.get_object()
         driver = request.user.driver
-        ride = driver.rides_as_driver.get(id=ride.id)
-        if ride and ride.status != 'IN_PROGRESS' and ride.pk != pk:
+        if not services.complete_ride(ride, driver):
             logger.warning("Invalid Request to complete ride.")
             return Response({'message': 'Invalid Request'}, status=status.HTTP_400_BAD_REQUEST)
 
-        with transaction.atomic():
-            driver.available = True
-            driver.save()
-            ride.status = 'COMPLETED'
-            ride.save()
-
-        logger.info("Ride completed by driver %s for ride %s", driver.user.full_name, ride.id)
+        logger.info("Ride completed by driver %s for ride %s", driver.id, ride.id)
         return Response({'message': 'Ride completed'}, status=status.HTTP_200_OK)
 
     @swagger_auto_schema(
@@ -233,22 +247,14 @@ class DriverRideViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'], url_path='reject', url_name='reject_ride')
     def reject_ride(self, request, pk=None):
         """
-        Reject a ride request and find an optimal driver for the ride.
+        Reject a ride request and offer the ride to the next candidate driver.
 
         Returns:
         Response -- HTTP 200 on success, HTTP 400 on failure.
         """
-        logger.info(f"Rejecting ride {self.get_object().id}")
         ride = self.get_object()
         driver = request.user.driver
-        with transaction.atomic():
-            logger.info(f"Rejecting ride {ride.id} for {driver.user.full_name}")
-            ride.rejected_drivers.add(driver)
-            ride.save()
-            driver.ride_requests.remove(ride)
-            driver.save()
-            logger.info(f"Finding optimal driver for ride {ride.id}")
-            add_ride_to_driver_ride_requests(ride)
-
-        logger.info("Ride rejected by driver %s for ride %s", driver.user.full_name, ride.id)
+        services.reject_ride(ride, driver)
+
+        logger.info("Ride rejected by driver %s for ride %s", driver.id, ride.id)
         return Response({'message': 'Ride cancelled'}, status=status.HTTP_200_OK)
@@ -0,0 +1,245 @@
+"""
+broker.py
+Standalone message broker serving BrokerChannelLayer clients.
+
+The broker keeps channel queues and group memberships in memory and talks to
+its clients over a Unix socket or TCP with length-prefixed msgpack frames.
+Every web process connects to the same brokers, so a notification sent from
+any process reaches sockets held by every other one. Run one broker per shard
+with `python manage.py run_channel_broker`.
+
+Requests are `[request_id, op, *args]` and replies `[request_id, ok, result]`,
+where `result` is the error code when `ok` is false.
+"""
+import asyncio
+import logging
+import struct
+import time
+from collections import deque
+
+import msgpack
+
+logger = logging.getLogger("notifications")
+
+HEADER = struct.Struct('!I')
+
+
+async def read_frame(reader):
+    """
+    Read one frame, returning None once the peer closed the connection.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        return msgpack.unpackb(await reader.readexactly(HEADER.unpack(header)[0]), raw=False)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def write_frame(writer, frame):
+    payload = msgpack.packb(frame, use_bin_type=True)
+    writer.write(HEADER.pack(len(payload)) + payload)
+
+
+def parse_address(address):
+    """
+    Split a broker address into ('unix', path) or ('tcp', (host, port)).
+
+    Args:
+    address -- unix:///path/to/socket or tcp://host:port
+
+    Returns:
+    tuple -- Transport and its address.
+    """
+    if address.startswith('unix://'):
+        return 'unix', address[len('unix://'):]
+    if address.startswith('tcp://'):
+        host, _, port = address[len('tcp://'):].rpartition(':')
+        return 'tcp', (host, int(port))
+    raise ValueError(f"Invalid broker address {address!r}, expected unix:///path or tcp://host:port")
+
+
+class Broker:
+    """
+    Channel queues and groups of one shard.
+
+    expiry -- Seconds after which an undelivered message is dropped and its channel leaves every group.
+    group_expiry -- Seconds after which a group membership expires.
+    capacity -- Maximum number of queued messages per channel.
+    """
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100):
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.capacity = capacity
+        self.channels = {}
+        self.waiters = {}
+        self.groups = {}
+
+    # Channel operations
+
+    def send(self, channel, message, requeue=False):
+        """
+        Hand a message to a waiting receiver or queue it.
+
+        Returns:
+        bool -- False when the channel is full.
+        """
+        waiters = self.waiters.get(channel)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(message)
+                return True
+        queue = self.channels.setdefault(channel, deque())
+        if requeue:
+            queue.appendleft((time.time() + self.expiry, message))
+            return True
+        if len(queue) >= self.capacity:
+            return False
+        queue.append((time.time() + self.expiry, message))
+        return True
+
+    def send_many(self, channels, message):
+        for channel in channels:
+            self.send(channel, message)
+
+    async def receive(self, channel):
+        queue = self.channels.get(channel)
+        now = time.time()
+        while queue:
+            expires, message = queue.popleft()
+            if not queue:
+                del self.channels[channel]
+            if expires >= now:
+                return message
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(channel, deque()).append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # A message handed over just before the cancellation goes back to the front of the queue
+            if waiter.done() and not waiter.cancelled():
+                self.send(channel, waiter.result(), requeue=True)
+            raise
+        finally:
+            waiters = self.waiters.get(channel)
+            if waiters is not None and not waiters:
+                del self.waiters[channel]
+
+    # Group operations
+
+    def group_add(self, group, channel):
+        self.groups.setdefault(group, {})[channel] = time.time()
+
+    def group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    def group_channels(self, group):
+        return list(self.groups.get(group, ()))
+
+    def group_send(self, group, message):
+        self.send_many(self.group_channels(group), message)
+
+    def flush(self):
+        self.channels = {}
+        self.groups = {}
+
+    def clean_expired(self):
+        """
+        Drop expired messages and memberships.
+
+        Channels whose messages expired are not being read, so they leave every group.
+        """
+        now = time.time()
+        dead = set()
+        for channel, queue in list(self.channels.items()):
+            while queue and queue[0][0] < now:
+                queue.popleft()
+                dead.add(channel)
+            if not queue:
+                del self.channels[channel]
+
+        joined_before = now - self.group_expiry
+        for group, members in list(self.groups.items()):
+            for channel, joined in list(members.items()):
+                if channel in dead or joined < joined_before:
+                    del members[channel]
+            if not members:
+                del self.groups[group]
+
+    # Server
+
+    async def handle(self, reader, writer):
+        """
+        Serve the requests of one client connection.
+        """
+        receives = {}
+
+        async def reply_receive(request_id, channel):
+            try:
+                message = await self.receive(channel)
+            except asyncio.CancelledError:
+                return
+            finally:
+                receives.pop(request_id, None)
+            write_frame(writer, [request_id, True, message])
+
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                request_id, op, *args = frame
+                if op == 'receive':
+                    receives[request_id] = asyncio.create_task(reply_receive(request_id, *args))
+                    continue
+                if op == 'cancel':
+                    task = receives.pop(args[0], None)
+                    if task is not None:
+                        task.cancel()
+                    continue
+
+                ok, result = True, None
+                if op == 'send':
+                    ok = self.send(*args)
+                    result = None if ok else 'full'
+                elif op in ('send_many', 'group_add', 'group_discard', 'group_send', 'flush'):
+                    getattr(self, op)(*args)
+                elif op == 'group_channels':
+                    result = self.group_channels(*args)
+                else:
+                    ok, result = False, 'unknown_op'
+                write_frame(writer, [request_id, ok, result])
+                if writer.transport.get_write_buffer_size() > 1 << 20:
+                    await writer.drain()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Dropping broker client: {e}")
+        finally:
+            for task in receives.values():
+                task.cancel()
+            writer.close()
+
+    async def sweep(self):
+        while True:
+            await asyncio.sleep(min(self.expiry, 10))
+            self.clean_expired()
+
+    async def serve(self, address):
+        """
+        Serve clients on a broker address until cancelled.
+        """
+        transport, location = parse_address(address)
+        if transport == 'unix':
+            server = await asyncio.start_unix_server(self.handle, path=location)
+        else:
+            server = await asyncio.start_server(self.handle, host=location[0], port=location[1])
+        sweeper = asyncio.create_task(self.sweep())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
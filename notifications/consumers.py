@@ -1,44 +1,280 @@
-import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
 
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from auth_login import authentication
+from base.metrics import metrics
+from driver import services
+from driver.models import Driver
+from driver.serializers import DriverLocationSerializer
+from .events import missed_events
+from .frames import JsonFrames, negotiate
+from .outbox import Outbox
+from .presence import presence
+from .utils import notification_group
+
+logger = logging.getLogger("driver")
+
+
+class CommandError(Exception):
+    """
+    A command that cannot be carried out, reported to the client as an error frame.
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def get_driver(driver_id):
+    try:
+        return Driver.objects.select_related('user').get(id=driver_id)
+    except Driver.DoesNotExist:
+        raise CommandError('not_driver', 'Only drivers can send commands')
+
+
+@database_sync_to_async
+def get_driver_id(user):
+    return authentication.get_driver_id(user)
+
+
+@database_sync_to_async
+def record_heartbeat(driver_id):
+    services.record_heartbeat(driver_id)
+
+
+@database_sync_to_async
+def update_location(driver_id, data):
+    serializer = DriverLocationSerializer(data=data)
+    if not serializer.is_valid():
+        raise CommandError('invalid', serializer.errors)
+    services.update_location(driver_id, serializer.validated_data['latitude'], serializer.validated_data['longitude'])
+    return {}
+
+
+@database_sync_to_async
+def accept_ride(driver_id, ride_id):
+    driver = get_driver(driver_id)
+    ride = services.driver_rides(driver.id).filter(id=ride_id).first()
+    if ride is None:
+        raise CommandError('not_found', 'Ride not found')
+    if not services.accept_ride(ride, driver):
+        raise CommandError('conflict', 'Ride cannot be accepted')
+    return {'ride': ride.id, 'status': ride.status}
+
+
+@database_sync_to_async
+def reject_ride(driver_id, ride_id):
+    driver = get_driver(driver_id)
+    ride = services.driver_rides(driver.id).filter(id=ride_id).first()
+    if ride is None:
+        raise CommandError('not_found', 'Ride not found')
+    services.reject_ride(ride, driver)
+    return {'ride': ride.id}
+
 
 class RideConsumer(AsyncWebsocketConsumer):
+    """
+    Notification socket of a user, which drivers also use to send commands.
+
+    Commands are JSON frames `{"type": ..., "id": ...}` where `id` is chosen by
+    the client. Every command is answered with `{"type": "ack", "id": ...}`
+    carrying its result, or `{"type": "error", "id": ..., "code": ..., "message": ...}`.
+
+    location -- `latitude` and `longitude` of the driver.
+    accept -- Accept the offered `ride`.
+    reject -- Reject the offered `ride`.
+
+    Clients confirm notifications pushed by the server with `{"type": "ack", "id": ...}`,
+    which is not answered.
+
+    Clients offering the `ridebook.msgpack` subprotocol get MessagePack binary
+    frames and may send their commands as MessagePack, see notifications.frames.
+
+    Frames are written to the socket from an Outbox by a task of the consumer,
+    see notifications.outbox. When the outbox drops frames a `resync` frame
+    tells the client to reload its rides, and a socket whose outbox overflows
+    with the 'disconnect' policy is closed with OVERFLOW_CLOSE_CODE.
+    """
+
+    OVERFLOW_CLOSE_CODE = 4008
+    RESYNC_KEY = 'resync'
+
+    frames = JsonFrames()
+    outbox = None
+    writer = None
+    closing = False
+    # Last event seq handed to the outbox
+    seq = 0
+
     async def connect(self):
         # Retrieve the user ID from the scope
         user_id = self.scope["user"].id
+        # Known from the token claims, else looked up with the first command
+        self.driver_id = self.scope.get("driver_id")
+        if self.driver_id is not None:
+            await record_heartbeat(self.driver_id)
+        if self.scope["user"].is_authenticated:
+            # Online before the group is joined, an event sent in between is only kept for replay
+            await sync_to_async(presence.join)(user_id)
 
-        # Create a unique channel name for the driver
-        driver_channel_name = f"notification_{user_id}"
-
-        # Add the driver to the group with the unique channel name
+        # Add the socket to the notification group of the user
         await self.channel_layer.group_add(
-            driver_channel_name,
+            notification_group(user_id),
             self.channel_name
         )
 
-        # Accept the WebSocket connection
-        await self.accept()
+        # Accept the WebSocket connection, naming a subprotocol only when the client offered one of ours
+        self.frames, subprotocol = negotiate(self.scope.get("subprotocols"))
+        await self.accept(subprotocol)
+        await self.replay_missed_events()
+        self.outbox = Outbox()
+        self.writer = asyncio.create_task(self.write_frames())
+
+    async def replay_missed_events(self):
+        """
+        Send the events missed since the `since` query parameter from the replay buffer.
+
+        Live events may arrive while replaying, clients drop frames whose seq they already have.
+        When the buffer no longer holds every missed event a `resync` frame tells the
+        client to reload its rides.
+        """
+        since = parse_qs(self.scope.get("query_string", b"").decode()).get("since")
+        if not since or not self.scope["user"].is_authenticated:
+            return
+        try:
+            since = int(since[0])
+        except ValueError:
+            await self.send_frame(
+                {'type': 'error', 'id': None, 'code': 'invalid', 'message': 'since must be an integer'})
+            return
+
+        frames, last, complete = await sync_to_async(missed_events)(self.scope["user"].id, since)
+        self.seq = last
+        for frame in frames:
+            await self.write(self.frames.encode_event(frame))
+        metrics.incr('socket.replayed', len(frames))
+        if not complete:
+            metrics.incr('socket.resyncs')
+            await self.send_frame({'type': 'resync', 'seq': last})
 
     async def disconnect(self, close_code):
         # Clean up: Remove the user from the group when they disconnect
         user_id = self.scope["user"].id
-        driver_channel_name = f"driver_{user_id}"
+        if self.writer is not None:
+            self.writer.cancel()
         await self.channel_layer.group_discard(
-            driver_channel_name,
+            notification_group(user_id),
             self.channel_name
         )
+        if self.scope["user"].is_authenticated:
+            await sync_to_async(presence.leave)(user_id)
+        if self.driver_id is not None:
+            await record_heartbeat(self.driver_id)
 
     async def receive(self, text_data=None, bytes_data=None):
-        if text_data:
-            # Send the received data back to the client
-            await self.send(text_data=json.dumps({'message': text_data}))
-        elif bytes_data:
-            # Handle bytes_data if needed
-            pass
+        try:
+            command = self.frames.decode(text_data if text_data is not None else bytes_data)
+        except ValueError:
+            code, message = ('invalid_msgpack', 'Invalid MessagePack') if text_data is None and self.frames.binary \
+                else ('invalid_json', 'Invalid JSON')
+            await self.send_frame({'type': 'error', 'id': None, 'code': code, 'message': message})
+            return
+        if not isinstance(command, dict):
+            await self.send_frame({'type': 'error', 'id': None, 'code': 'invalid', 'message': 'Expected an object'})
+            return
+
+        request_id = command.get('id')
+        if command.get('type') == 'ack':
+            metrics.incr('socket.acks')
+            return
+        try:
+            result = await self.handle_command(command)
+        except CommandError as e:
+            await self.send_frame({'type': 'error', 'id': request_id, 'code': e.code, 'message': e.message})
+        except Exception as e:
+            logger.error(f"Error handling {command.get('type')} command: {e}")
+            await self.send_frame(
+                {'type': 'error', 'id': request_id, 'code': 'server_error', 'message': 'Server error'})
+        else:
+            await self.send_frame({'type': 'ack', 'id': request_id, **result})
+
+    async def handle_command(self, command):
+        handlers = {
+            'location': self.command_location,
+            'accept': self.command_accept,
+            'reject': self.command_reject,
+        }
+        handler = handlers.get(command.get('type'))
+        if handler is None:
+            raise CommandError('unknown_type', f"Unknown command type {command.get('type')!r}")
+
+        if not self.scope["user"].is_authenticated:
+            raise CommandError('not_authenticated', 'Authentication required')
+        if self.driver_id is None:
+            self.driver_id = await get_driver_id(self.scope["user"])
+            if self.driver_id is None:
+                raise CommandError('not_driver', 'Only drivers can send commands')
+        metrics.incr(f"socket.commands.{command['type']}")
+        return await handler(command)
+
+    async def command_location(self, command):
+        return await update_location(self.driver_id, command)
+
+    async def command_accept(self, command):
+        return await accept_ride(self.driver_id, self.ride_id(command))
+
+    async def command_reject(self, command):
+        return await reject_ride(self.driver_id, self.ride_id(command))
+
+    def ride_id(self, command):
+        ride_id = command.get('ride')
+        if not isinstance(ride_id, int) or isinstance(ride_id, bool):
+            raise CommandError('invalid', 'ride must be an integer id')
+        return ride_id
+
+    async def write(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def write_frames(self):
+        while True:
+            await self.write(await self.outbox.get())
+
+    async def push(self, frame, key=None):
+        """
+        Queue a frame for the socket, closing the socket when its outbox overflows.
+        """
+        if self.closing:
+            return
+        if self.outbox is None:
+            # Frames sent while connecting, before the outbox exists
+            await self.write(frame)
+        elif not self.outbox.put(frame, key):
+            logger.warning(f"Closing the socket of user {self.scope['user'].id}, {len(self.outbox)} frames are waiting")
+            self.closing = True
+            await self.close(code=self.OVERFLOW_CLOSE_CODE)
+        elif self.outbox.dropped:
+            # A single resync frame waits for the client, behind the frames it follows
+            metrics.incr('socket.resyncs')
+            self.outbox.put(self.frames.encode({'type': 'resync', 'seq': self.seq}), self.RESYNC_KEY)
+            self.outbox.dropped = 0
+
+    async def send_frame(self, frame):
+        await self.push(self.frames.encode(frame))
+
+    async def send_event(self, event):
+        self.seq = max(self.seq, event['seq'])
+        await self.push(self.frames.encode_event(event['frame']), event.get('coalesce'))
 
     async def send_message(self, event):
         message = event['text']
-        print("msg to send", message)
         # Handle the message as needed
-        await self.send(text_data=json.dumps({'message': message}))
+        await self.push(self.frames.encode({'message': message}))
@@ -0,0 +1,152 @@
+"""
+events.py
+Structured notification events pushed to user sockets.
+
+An event reaches the socket as one JSON frame:
+
+    {"type": "event", "event": "ride.offer", "seq": 12, "expires_at": "...", "data": {...}}
+
+`seq` increases by one with every event of a user. A gap in it is not a missed
+event: a frame still waiting for a slow socket is superseded by a later event
+about the same ride, see notifications.outbox, and the later frame carries the
+current state of the ride. Clients learn they missed events from a `resync`
+frame, after which they reload their rides, and catch up on the events sent
+while they were disconnected by reconnecting with `?since=`.
+
+`data` is serialized once per payload and spliced into every frame as is, so
+fanning an event out to many users does not serialize it again.
+
+The last NOTIFICATION_REPLAY_SIZE frames of every user are kept in a ring
+buffer in the cache, slot `seq % NOTIFICATION_REPLAY_SIZE`, and replayed to a
+socket that reconnects with `?since=<last seq received>`. Frames of users
+without an open socket are only stored there, see notifications.presence.
+"""
+import json
+
+from django.core.cache import cache
+
+from base.metrics import metrics
+from config.settings import NOTIFICATION_REPLAY_SIZE, NOTIFICATION_REPLAY_TTL
+from .presence import presence
+from .utils import notification_group
+
+
+def seq_key(user_id):
+    return f"notification_seq_{user_id}"
+
+
+def replay_key(user_id, seq):
+    return f"notification_replay_{user_id}_{seq % NOTIFICATION_REPLAY_SIZE}"
+
+
+def next_seq(user_id):
+    """
+    Next sequence number of the events of a user, starting at 1.
+    """
+    try:
+        return cache.incr(seq_key(user_id))
+    except ValueError:
+        # Sequence counters never expire
+        cache.add(seq_key(user_id), 0, timeout=None)
+        return cache.incr(seq_key(user_id))
+
+
+def render_event(event, seq, data, **fields):
+    """
+    JSON frame of an event, without parsing its payload.
+
+    Args:
+    event -- Name of the event, such as 'ride.offer'.
+    seq -- Sequence number of the event for its user.
+    data -- Serialized JSON payload of the event.
+    fields -- Extra top level fields of the frame.
+
+    Returns:
+    str -- The frame sent to the socket.
+    """
+    header = json.dumps({'type': 'event', 'event': event, 'seq': seq, **fields})
+    return f'{header[:-1]}, "data": {data}}}'
+
+
+def split_event(frame):
+    """
+    Header fields and serialized payload of a frame made by render_event.
+
+    Args:
+    frame -- JSON frame of an event.
+
+    Returns:
+    tuple -- (header dict, serialized JSON payload)
+    """
+    header, data = frame.split(', "data": ', 1)
+    return json.loads(header + '}'), data[:-1]
+
+
+def event_messages(user_ids, event, data, coalesce=None, **fields):
+    """
+    Channel layer messages carrying the same event to several users.
+
+    Every frame is stored in the replay buffer of its user, and only users with
+    an open socket get a message.
+
+    Args:
+    user_ids -- Ids of the Users.
+    event, data, fields -- See render_event.
+    coalesce -- Key of the frame in the outbox of the socket, a frame with the same key
+                still waiting there is superseded, see notifications.outbox.
+
+    Returns:
+    list -- (group name, message) pairs for send_messages_to_channels.
+    """
+    user_ids = list(user_ids)
+    online = presence.online(user_ids)
+    messages = []
+    replay = {}
+    for user_id in user_ids:
+        seq = next_seq(user_id)
+        frame = render_event(event, seq, data, **fields)
+        replay[replay_key(user_id, seq)] = (seq, frame)
+        if user_id in online:
+            messages.append((notification_group(user_id), {
+                'type': 'send.event', 'seq': seq, 'frame': frame, 'coalesce': coalesce}))
+    if replay:
+        cache.set_many(replay, NOTIFICATION_REPLAY_TTL)
+    skipped = len(user_ids) - len(messages)
+    if skipped:
+        metrics.incr('notifications.offline_skipped', skipped)
+    return messages
+
+
+def event_message(user_id, event, data, coalesce=None, **fields):
+    """
+    Channel layer message carrying an event to a user, None when the user is offline, see event_messages.
+    """
+    messages = event_messages([user_id], event, data, coalesce, **fields)
+    return messages[0] if messages else None
+
+
+def missed_events(user_id, since):
+    """
+    Frames a user received after `since`, read from the replay buffer.
+
+    Args:
+    user_id -- Id of the User.
+    since -- Last sequence number the client received.
+
+    Returns:
+    tuple -- (frames in order, last sequence number, whether every missed frame was still buffered)
+    """
+    last = cache.get(seq_key(user_id)) or 0
+    if since >= last:
+        return [], last, since == last
+    first = max(since + 1, last - NOTIFICATION_REPLAY_SIZE + 1)
+    keys = {seq: replay_key(user_id, seq) for seq in range(first, last + 1)}
+    stored = cache.get_many(keys.values())
+    frames = []
+    for seq, key in keys.items():
+        entry = stored.get(key)
+        # A slot holding another sequence number was overwritten by a newer event
+        if entry is None or entry[0] != seq:
+            continue
+        frames.append(entry[1])
+    return frames, last, first == since + 1 and len(frames) == len(keys)
@@ -0,0 +1,130 @@
+"""
+frames.py
+Encodings of socket frames, negotiated with the WebSocket subprotocol.
+
+Frames are JSON text unless the client offers the MSGPACK subprotocol
+(`Sec-WebSocket-Protocol: ridebook.msgpack`), in which case they are
+MessagePack binary frames carrying the same maps. In MessagePack frames
+`latitude` and `longitude` are fixed-point integers in units of
+1 / COORDINATE_SCALE degree, about a centimeter, both in frames pushed by the
+server and in commands sent by the client.
+
+Event payloads are packed once per payload and process and spliced into the
+frame of every user, like render_event does with JSON.
+"""
+import json
+from functools import lru_cache
+
+import msgpack
+
+from .events import split_event
+
+JSON = 'ridebook.json'
+MSGPACK = 'ridebook.msgpack'
+
+COORDINATE_SCALE = 10 ** 7
+COORDINATE_KEYS = ('latitude', 'longitude')
+
+
+def to_fixed_point(value):
+    """
+    Copy of a frame with its coordinates scaled to integers.
+    """
+    if isinstance(value, dict):
+        return {
+            key: round(item * COORDINATE_SCALE)
+            if key in COORDINATE_KEYS and isinstance(item, float) else to_fixed_point(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [to_fixed_point(item) for item in value]
+    return value
+
+
+def from_fixed_point(value):
+    """
+    Copy of a frame with its fixed-point coordinates turned back into degrees.
+    """
+    if isinstance(value, dict):
+        return {
+            key: item / COORDINATE_SCALE
+            if key in COORDINATE_KEYS and isinstance(item, int) and not isinstance(item, bool)
+            else from_fixed_point(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [from_fixed_point(item) for item in value]
+    return value
+
+
+@lru_cache(maxsize=1024)
+def packed_payload(data):
+    """
+    MessagePack form of a serialized JSON event payload.
+    """
+    return msgpack.packb(to_fixed_point(json.loads(data)))
+
+
+class JsonFrames:
+    """
+    JSON text frames, the default.
+    """
+
+    subprotocol = JSON
+    binary = False
+
+    def encode(self, frame):
+        return json.dumps(frame)
+
+    def encode_event(self, frame):
+        return frame
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackFrames:
+    """
+    MessagePack binary frames with fixed-point coordinates.
+    """
+
+    subprotocol = MSGPACK
+    binary = True
+
+    def encode(self, frame):
+        return msgpack.packb(to_fixed_point(frame))
+
+    def encode_event(self, frame):
+        header, data = split_event(frame)
+        packer = msgpack.Packer()
+        parts = [packer.pack_map_header(len(header) + 1)]
+        for key, value in header.items():
+            parts.append(packer.pack(key))
+            parts.append(packer.pack(value))
+        parts.append(packer.pack('data'))
+        parts.append(packed_payload(data))
+        return b''.join(parts)
+
+    def decode(self, data):
+        if isinstance(data, str):
+            # Text frames of a MessagePack client are still JSON
+            return json.loads(data)
+        return from_fixed_point(msgpack.unpackb(data))
+
+
+def negotiate(subprotocols):
+    """
+    Frame encoding of a socket, from the subprotocols offered by its client.
+
+    Args:
+    subprotocols -- Subprotocols of the handshake, in the order of preference of the client.
+
+    Returns:
+    tuple -- (JsonFrames or MsgpackFrames, subprotocol to accept, None when the client offered none of ours)
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol == MSGPACK:
+            return MsgpackFrames(), MSGPACK
+        if subprotocol == JSON:
+            return JsonFrames(), JSON
+    return JsonFrames(), None
@@ -0,0 +1,328 @@
+"""
+layers.py
+Channel layers that deliver notifications across processes.
+
+ShardedChannelLayer spreads groups and channels over several child layers
+with a consistent hash ring, so adding a shard only moves a fraction of the
+keys. A child layer implements the usual channel layer API plus
+group_channels and send_many, which the sharded layer uses to fan a group
+message out to members living on other shards.
+
+BrokerChannelLayer is the child used in production: a client of a broker
+process (notifications.broker) reached over a Unix socket or TCP.
+LocalChannelLayer is an in-process child for tests and single process setups.
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import time
+import uuid
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from django.utils.module_loading import import_string
+
+from .broker import read_frame, write_frame, parse_address
+
+logger = logging.getLogger("notifications")
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to nodes.
+
+    nodes -- Sequence of nodes.
+    replicas -- Virtual points per node, more points spread the keys more evenly.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = sorted(
+            (self.hash(f"{index}:{replica}"), index)
+            for index in range(len(self.nodes))
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def get(self, key):
+        position = bisect.bisect(self._hashes, self.hash(key)) % len(self._hashes)
+        return self.nodes[self._indexes[position]]
+
+
+class LocalChannelLayer(InMemoryChannelLayer):
+    """
+    In-memory child layer of ShardedChannelLayer.
+
+    InMemoryChannelLayer scans every channel and group for expired entries on
+    each receive, which is quadratic with many consumers, so scans are limited
+    to one per `clean_interval` seconds.
+    """
+
+    def __init__(self, clean_interval=1, **kwargs):
+        super().__init__(**kwargs)
+        self.clean_interval = clean_interval
+        self._cleaned_at = 0
+
+    def _clean_expired(self):
+        now = time.monotonic()
+        if now - self._cleaned_at >= self.clean_interval:
+            self._cleaned_at = now
+            super()._clean_expired()
+
+    async def group_channels(self, group):
+        self._clean_expired()
+        return list(self.groups.get(group, ()))
+
+    async def send_many(self, channels, message):
+        for channel in channels:
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                pass
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """
+    Channel layer sharding groups and channels across child layers.
+
+    Groups are placed by their name and channels by their non-local part, so all
+    process-specific channels created by one layer instance share a shard.
+
+    shards -- List of {'BACKEND': ..., 'CONFIG': {...}} child layer definitions.
+    replicas -- Virtual points per shard on the hash ring.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, shards, replicas=160, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        if not shards:
+            raise ValueError("ShardedChannelLayer needs at least one shard")
+        self.shards = [import_string(shard['BACKEND'])(**shard.get('CONFIG', {})) for shard in shards]
+        self.ring = HashRing(self.shards, replicas=replicas)
+        self.client_prefix = uuid.uuid4().hex[:12]
+
+    def shard_for_channel(self, channel):
+        return self.ring.get(self.non_local_name(channel))
+
+    def shard_for_group(self, group):
+        return self.ring.get(f"group:{group}")
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self.shard_for_channel(channel).send(channel, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        return await self.shard_for_channel(channel).receive(channel)
+
+    async def new_channel(self, prefix="specific"):
+        return f"{prefix}.{self.client_prefix}!{uuid.uuid4().hex[:12]}"
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self.shard_for_group(group).group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await self.shard_for_group(group).group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        channels = await self.shard_for_group(group).group_channels(group)
+        by_shard = defaultdict(list)
+        for channel in channels:
+            by_shard[self.shard_for_channel(channel)].append(channel)
+        await asyncio.gather(*(shard.send_many(members, message) for shard, members in by_shard.items()))
+
+    async def flush(self):
+        await asyncio.gather(*(shard.flush() for shard in self.shards))
+
+    async def close(self):
+        await asyncio.gather(*(shard.close() for shard in self.shards))
+
+
+class BrokerConnection:
+    """
+    Multiplexed connection to a broker, bound to the event loop that opened it.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count()
+        self.pending = {}
+        self.reader_task = asyncio.create_task(self.read_replies())
+
+    @property
+    def closed(self):
+        return self.reader_task.done()
+
+    async def read_replies(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+                request_id, ok, result = frame
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((ok, result))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Lost broker connection: {e}")
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Broker connection closed"))
+            self.pending.clear()
+            self.writer.close()
+
+    def request(self, op, *args):
+        if self.closed:
+            raise ConnectionError("Broker connection closed")
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        write_frame(self.writer, [request_id, op, *args])
+        return request_id, future
+
+    async def call(self, op, *args):
+        _, future = self.request(op, *args)
+        ok, result = await future
+        if not ok:
+            raise RuntimeError(f"Broker rejected {op}: {result}")
+        return result
+
+    def notify(self, op, *args):
+        """
+        Send a request without waiting for its reply.
+        """
+        if not self.closed:
+            write_frame(self.writer, [next(self.ids), op, *args])
+
+    def cancel(self, request_id):
+        self.pending.pop(request_id, None)
+        self.notify('cancel', request_id)
+
+    async def close(self):
+        self.writer.close()
+        self.reader_task.cancel()
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by a broker process, see notifications.broker.
+
+    address -- unix:///path/to/socket or tcp://host:port of the broker.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, address, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.address = address
+        self.client_prefix = uuid.uuid4().hex[:12]
+        # async_to_sync runs each call on its own event loop and streams cannot be shared between loops,
+        # so every loop gets its own connection, closed and forgotten with the loop
+        self._connections = {}
+
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is None or (connection.done() and (connection.exception() or connection.result().closed)):
+            if loop not in self._connections:
+                self._close_with(loop)
+            # Concurrent callers on the loop wait for the same connection attempt
+            connection = self._connections[loop] = loop.create_task(self.connect())
+        return await asyncio.shield(connection)
+
+    def _close_with(self, loop):
+        """
+        Close the connection of a loop and drop it from the layer when the loop closes.
+        """
+        close = loop.close
+
+        def close_connection():
+            connection = self._connections.pop(loop, None)
+            if connection is not None and connection.done() and not connection.cancelled() \
+                    and not connection.exception() and not loop.is_running() and not loop.is_closed():
+                loop.run_until_complete(connection.result().close())
+            close()
+
+        loop.close = close_connection
+
+    async def connect(self):
+        transport, location = parse_address(self.address)
+        if transport == 'unix':
+            reader, writer = await asyncio.open_unix_connection(location)
+        else:
+            reader, writer = await asyncio.open_connection(*location)
+        return BrokerConnection(reader, writer)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        connection = await self.connection()
+        _, future = connection.request('send', channel, message)
+        ok, _ = await future
+        if not ok:
+            raise ChannelFull(channel)
+
+    async def send_many(self, channels, message):
+        await (await self.connection()).call('send_many', channels, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        connection = await self.connection()
+        request_id, future = connection.request('receive', channel)
+        try:
+            _, message = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The message arrived just before the cancellation, give it back to the broker
+                connection.notify('send', channel, future.result()[1])
+            else:
+                connection.cancel(request_id)
+            raise
+        return message
+
+    async def new_channel(self, prefix="specific"):
+        return f"{prefix}.{self.client_prefix}!{uuid.uuid4().hex[:12]}"
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await (await self.connection()).call('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await (await self.connection()).call('group_discard', group, channel)
+
+    async def group_channels(self, group):
+        return await (await self.connection()).call('group_channels', group)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        await (await self.connection()).call('group_send', group, message)
+
+    async def flush(self):
+        await (await self.connection()).call('flush')
+
+    async def close(self):
+        connection = self._connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None and connection.done() and not connection.exception():
+            await connection.result().close()
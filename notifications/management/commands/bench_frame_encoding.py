@@ -0,0 +1,69 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from notifications.events import render_event
+from notifications.frames import JsonFrames, MsgpackFrames, packed_payload
+
+
+class Command(BaseCommand):
+    help = 'Benchmark encode time and bytes per frame of a ride offer as JSON and MessagePack'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--frames',
+            type=int,
+            default=100000,
+            help='Number of frames encoded with every method'
+        )
+
+    def offer(self):
+        # A ride from Perinthalmanna to Mannarkkad, as sent by ride_payload
+        data = json.dumps({
+            'id': 48213,
+            'status': 'PENDING',
+            'driver': None,
+            'pickup': {'latitude': 10.9760493, 'longitude': 76.2253917},
+            'dropoff': {'latitude': 10.9926728, 'longitude': 76.4604213},
+            'distance': 25842,
+        })
+        return render_event('ride.offer', 1734, data, expires_at='2026-10-18T09:41:27.512904+00:00'), data
+
+    def measure(self, encode, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            frame = encode()
+        return (time.perf_counter() - start) / count * 1e6, len(frame)
+
+    def handle(self, *args, **options):
+        count = options['frames']
+        frame, data = self.offer()
+        message = json.loads(frame)
+        json_frames, msgpack_frames = JsonFrames(), MsgpackFrames()
+
+        def spliced_msgpack():
+            # Every user gets its own header, the payload is packed once per process
+            return msgpack_frames.encode_event(frame)
+
+        def full_msgpack():
+            packed_payload.cache_clear()
+            return msgpack_frames.encode_event(frame)
+
+        def spliced_json():
+            return render_event('ride.offer', 1734, data, expires_at=message['expires_at'])
+
+        results = [
+            ('JSON dumps', self.measure(lambda: json_frames.encode(message), count)),
+            ('JSON spliced', self.measure(spliced_json, count)),
+            ('MessagePack packb', self.measure(lambda: msgpack_frames.encode(message), count)),
+            ('MessagePack uncached', self.measure(full_msgpack, count)),
+            ('MessagePack spliced', self.measure(spliced_msgpack, count)),
+        ]
+
+        self.stdout.write(self.style.NOTICE(f'{count} ride.offer frames'))
+        self.stdout.write(f'{"method":>22} {"us/frame":>9} {"bytes":>6}')
+        for method, (elapsed, size) in results:
+            self.stdout.write(f'{method:>22} {elapsed:>9.2f} {size:>6}')
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete!'))
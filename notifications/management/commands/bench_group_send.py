@@ -0,0 +1,111 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from notifications.layers import ShardedChannelLayer
+
+
+class Command(BaseCommand):
+    help = 'Benchmark group_send fan-out to connected consumers on the sharded channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--consumers',
+            type=int,
+            default=10000,
+            help='Number of consumers in the group'
+        )
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=20,
+            help='Number of group_send calls'
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=2,
+            help='Number of shards'
+        )
+        parser.add_argument(
+            '--backend',
+            choices=['local', 'broker'],
+            default='broker',
+            help='Child layer: in-process memory, or broker processes on Unix sockets'
+        )
+
+    def handle(self, *args, **options):
+        brokers = []
+        directory = tempfile.mkdtemp()
+        if options['backend'] == 'broker':
+            shards = []
+            for index in range(options['shards']):
+                address = f"unix://{os.path.join(directory, f'broker{index}.sock')}"
+                brokers.append(subprocess.Popen([sys.executable, 'manage.py', 'run_channel_broker', address]))
+                shards.append({
+                    'BACKEND': 'notifications.layers.BrokerChannelLayer',
+                    'CONFIG': {'address': address},
+                })
+            for index in range(options['shards']):
+                path = os.path.join(directory, f'broker{index}.sock')
+                while not os.path.exists(path):
+                    time.sleep(0.05)
+        else:
+            shards = [{'BACKEND': 'notifications.layers.LocalChannelLayer'}] * options['shards']
+
+        try:
+            if brokers:
+                # Each process of a deployment holds its own layer, so consumers are spread over a few of them
+                layers = [ShardedChannelLayer(shards=shards) for _ in range(4)]
+            else:
+                layers = [ShardedChannelLayer(shards=shards)]
+            asyncio.run(self.run(layers, options['consumers'], options['messages']))
+        finally:
+            for broker in brokers:
+                broker.terminate()
+                broker.wait()
+
+    async def run(self, layers, consumers, messages):
+        sender = layers[0]
+        channels = []
+        for index in range(consumers):
+            layer = layers[index % len(layers)]
+            channel = await layer.new_channel()
+            await sender.group_add('bench', channel)
+            channels.append((layer, channel))
+
+        latencies = []
+
+        async def consume(layer, channel):
+            for _ in range(messages):
+                message = await layer.receive(channel)
+                latencies.append(time.perf_counter() - message['sent'])
+
+        self.stdout.write(self.style.NOTICE(
+            f'{consumers} consumers over {len(layers)} processes, {len(sender.shards)} shards, '
+            f'{messages} messages'))
+        receivers = [asyncio.create_task(consume(layer, channel)) for layer, channel in channels]
+        await asyncio.sleep(0.5)
+
+        start = time.perf_counter()
+        for _ in range(messages):
+            await sender.group_send('bench', {'type': 'send.message', 'text': 'bench', 'sent': time.perf_counter()})
+        sent = time.perf_counter() - start
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        delivered = len(latencies)
+        self.stdout.write(f'group_send: {sent / messages * 1000:.1f} ms per call')
+        self.stdout.write(f'delivered: {delivered} messages, {delivered / elapsed:.0f} msg/s')
+        self.stdout.write(
+            f'latency: p50 {latencies[delivered // 2] * 1000:.1f} ms, '
+            f'p99 {latencies[min(int(delivered * 0.99), delivered - 1)] * 1000:.1f} ms')
+        for layer in layers:
+            await layer.close()
+        self.stdout.write(self.style.SUCCESS('Benchmark complete!'))
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from auth_login.models import User
+from base.metrics import Timer
+from notifications.middleware import TokenAuthMiddleware
+from notifications.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = 'Benchmark WebSocket handshake latency with token authentication'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--handshakes',
+            type=int,
+            default=1000,
+            help='Number of handshakes per run'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=100,
+            help='Handshakes in flight at once, as in a reconnect storm'
+        )
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=50,
+            help='Number of distinct users connecting'
+        )
+
+    def handle(self, *args, **options):
+        users = list(User.objects.filter(is_active=True)[:options['users']])
+        if not users:
+            raise CommandError('No active users to connect with')
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        application = TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+        self.stdout.write(self.style.NOTICE(
+            f'{options["handshakes"]} handshakes, {options["concurrency"]} concurrent, {len(users)} users'))
+        self.stdout.write(f'{"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"handshakes/s":>14}')
+
+        timer, elapsed = asyncio.run(self.run(application, tokens, options['handshakes'], options['concurrency']))
+        summary = timer.summary()
+        self.stdout.write(
+            f'{summary["p50_ms"]:>10.2f} {summary["p95_ms"]:>10.2f} {summary["p99_ms"]:>10.2f} '
+            f'{options["handshakes"] / elapsed:>14.0f}')
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete!'))
+
+    async def run(self, application, tokens, handshakes, concurrency):
+        timer = Timer(size=handshakes)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def handshake(index):
+            async with semaphore:
+                communicator = WebsocketCommunicator(
+                    application, f'/ws/notifications/?token={tokens[index % len(tokens)]}')
+                started = time.perf_counter()
+                connected, _ = await communicator.connect()
+                timer.observe(time.perf_counter() - started)
+                if connected:
+                    await communicator.disconnect()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(handshake(index) for index in range(handshakes)))
+        return timer, time.perf_counter() - started
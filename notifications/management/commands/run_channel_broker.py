@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+from django.core.management.base import BaseCommand
+
+from notifications.broker import Broker, parse_address
+
+
+class Command(BaseCommand):
+    help = 'Run a channel layer broker shard for BrokerChannelLayer clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'address',
+            help='Address to listen on, unix:///path/to/socket or tcp://host:port'
+        )
+        parser.add_argument(
+            '--expiry',
+            type=int,
+            default=60,
+            help='Seconds before an undelivered message is dropped'
+        )
+        parser.add_argument(
+            '--capacity',
+            type=int,
+            default=100,
+            help='Maximum number of queued messages per channel'
+        )
+
+    def handle(self, *args, **options):
+        transport, location = parse_address(options['address'])
+        if transport == 'unix' and os.path.exists(location):
+            os.unlink(location)
+
+        broker = Broker(expiry=options['expiry'], capacity=options['capacity'])
+        self.stdout.write(self.style.NOTICE(f'Channel broker listening on {options["address"]}'))
+        try:
+            asyncio.run(broker.serve(options['address']))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('Channel broker stopped'))
@@ -1,33 +1,46 @@
+import logging
 from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import AccessToken
 
-from auth_login.models import User
+from auth_login.authentication import ClaimsUser
+from base.metrics import metrics
 
+logger = logging.getLogger("notifications")
 
-@database_sync_to_async
-def get_user(scope):
-    # Get the user from the token in the WebSocket scope
+
+async def get_user(scope):
+    """
+    Get the user of the token in the WebSocket scope.
+
+    The token is verified on every handshake and the user is built from its
+    claims, like auth_login.authentication.StatelessJWTAuthentication does for
+    the API, so a handshake makes no database query. A user deactivated after
+    the token was issued can connect until the access token expires.
+    The driver id claim of the token is stored in scope["driver_id"], see auth_login.tokens.
+
+    Returns:
+    ClaimsUser -- The user of the token, or AnonymousUser.
+    """
     try:
         token_key = parse_qs(scope["query_string"].decode("utf-8"))["token"][0]
         token = AccessToken(token_key)
-        user_id = token.payload.get("user_id")
-
-        if user_id:
-            user = User.objects.get(id=user_id)
-            return user
     except Exception as e:
-        print(e)
+        logger.info(f"Rejected socket token: {e}")
+        return AnonymousUser()
+    if not token.get(api_settings.USER_ID_CLAIM):
         return AnonymousUser()
 
-    return AnonymousUser()
+    scope["driver_id"] = token.get("driver_id")
+    return ClaimsUser(token)
 
 
 class TokenAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         # Add the user to the scope based on the token
-        scope["user"] = await get_user(scope)
+        with metrics.time('socket.auth'):
+            scope["user"] = await get_user(scope)
         return await super().__call__(scope, receive, send)
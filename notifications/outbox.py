@@ -0,0 +1,98 @@
+"""
+outbox.py
+Bounded queue of the frames waiting to be written to a socket.
+
+A consumer hands frames to its outbox and returns to reading the channel
+layer, while a task of its own writes them to the socket. A slow client
+therefore only fills its own outbox, which is capped at SOCKET_SEND_QUEUE_SIZE.
+
+A frame with a coalescing key supersedes the waiting frame with the same key,
+so of several events about one ride only the latest is written, leaving a gap
+in the seq of the events the client receives. When the outbox is full the
+oldest frame is dropped and counted in `dropped`, for which the consumer
+queues a resync frame, or with SOCKET_SEND_OVERFLOW set to 'disconnect' the
+socket is closed and the client catches up from the replay buffer when it
+reconnects.
+"""
+import asyncio
+import itertools
+import weakref
+from collections import OrderedDict
+
+from base.metrics import metrics
+from config.settings import SOCKET_SEND_OVERFLOW, SOCKET_SEND_QUEUE_SIZE
+
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+
+
+class Outbox:
+    """
+    Frames waiting to be written to one socket, oldest first.
+
+    size -- Maximum number of waiting frames.
+    policy -- DROP to drop the oldest frame when full, DISCONNECT to refuse the frame.
+    """
+
+    # Most frames ever waiting in one outbox of this process
+    high_water_mark = 0
+    _live = weakref.WeakSet()
+
+    def __init__(self, size=SOCKET_SEND_QUEUE_SIZE, policy=SOCKET_SEND_OVERFLOW):
+        self.size = size
+        self.policy = policy
+        self.high_water = 0
+        # Frames dropped since the consumer last queued a resync frame
+        self.dropped = 0
+        self._frames = OrderedDict()
+        self._sequence = itertools.count()
+        self._ready = asyncio.Event()
+        Outbox._live.add(self)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        """
+        Queue a frame, replacing the waiting frame with the same key.
+
+        The replacing frame moves to the back of the queue, so frames stay in
+        the order their events happened.
+
+        Args:
+        frame -- Text or bytes to write to the socket.
+        key -- Coalescing key, None for frames that are never superseded.
+
+        Returns:
+        bool -- False when the outbox is full and its policy is DISCONNECT.
+        """
+        key = ('frame', next(self._sequence)) if key is None else ('key', key)
+        if self._frames.pop(key, None) is not None:
+            metrics.incr('socket.send.coalesced')
+        elif len(self._frames) >= self.size:
+            if self.policy == DISCONNECT:
+                metrics.incr('socket.send.overflows')
+                return False
+            self._frames.popitem(last=False)
+            self.dropped += 1
+            metrics.incr('socket.send.dropped')
+
+        self._frames[key] = frame
+        if len(self._frames) > self.high_water:
+            self.high_water = len(self._frames)
+            Outbox.high_water_mark = max(Outbox.high_water_mark, self.high_water)
+        self._ready.set()
+        return True
+
+    async def get(self):
+        """
+        Wait for the oldest frame and take it.
+        """
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._frames.popitem(last=False)[1]
+
+
+metrics.gauge('socket.send.queued', lambda: sum(len(outbox) for outbox in list(Outbox._live)))
+metrics.gauge('socket.send.high_water', lambda: Outbox.high_water_mark)
@@ -0,0 +1,179 @@
+"""
+presence.py
+Registry of the users with an open notification socket.
+
+Every process counts the sockets of each user it serves and publishes the
+users to the cache under keys of its own, with a PRESENCE_TTL expiry
+refreshed by a background thread every third of it. A user is online while a
+process in the registry of processes holds a key for it, so a process closing
+its last socket of a user does not hide the sockets of that user in another
+process. Each process also publishes a summary of its connections, and the
+registry is pruned of the processes whose summary expired, so the users of a
+process that died drop out on their own.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import cache
+
+from base.metrics import metrics
+from config.settings import PRESENCE_TTL
+
+logger = logging.getLogger("notifications")
+
+PROCESSES_KEY = "presence_processes"
+
+
+def user_key(user_id, process_id):
+    return f"presence_user_{user_id}_{process_id}"
+
+
+def process_key(process_id):
+    return f"presence_process_{process_id}"
+
+
+class PresenceRegistry:
+    """
+    Users with an open socket in this process, published to the cache for the whole cluster.
+
+    ttl -- Seconds a published user stays online without being refreshed, 0 disables the background thread.
+    process_id -- Name of this process in the cluster, hostname:pid by default.
+    """
+
+    def __init__(self, ttl=PRESENCE_TTL, process_id=None):
+        self.ttl = ttl
+        self.process_id = process_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._sockets = Counter()
+        self._registered = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def __contains__(self, user_id):
+        return user_id in self._sockets
+
+    def connections(self):
+        """
+        Number of sockets open in this process.
+        """
+        return sum(self._sockets.values())
+
+    def join(self, user_id):
+        """
+        Count a socket of a user opening.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._sockets[user_id] += 1
+            first = self._sockets[user_id] == 1
+        if first:
+            cache.set(user_key(user_id, self.process_id), True, self.ttl or None)
+        if not self._registered:
+            # The users of a process are only read once the process is in the registry
+            self.publish()
+        if self.ttl:
+            self._start()
+
+    def leave(self, user_id):
+        """
+        Count a socket of a user closing, the user leaves this process with its last socket here.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            if self._sockets[user_id] > 1:
+                self._sockets[user_id] -= 1
+                return
+            self._sockets.pop(user_id, None)
+        cache.delete(user_key(user_id, self.process_id))
+
+    def online(self, user_ids):
+        """
+        Users among `user_ids` with an open socket in any process.
+
+        Args:
+        user_ids -- Ids of the Users.
+
+        Returns:
+        set -- Ids of the online users.
+        """
+        processes = set(cache.get(PROCESSES_KEY) or ()) | {self.process_id}
+        keys = {user_key(user_id, process_id): user_id for user_id in user_ids for process_id in processes}
+        return {keys[key] for key in cache.get_many(list(keys))}
+
+    def publish(self):
+        """
+        Refresh the users and the summary of this process and prune dead processes from the registry.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            user_ids = list(self._sockets)
+            connections = sum(self._sockets.values())
+        timeout = self.ttl or None
+        cache.set_many({user_key(user_id, self.process_id): True for user_id in user_ids}, timeout)
+        # A user whose last socket here closed since the snapshot was put back, remove it again
+        with self._lock:
+            left = [user_id for user_id in user_ids if user_id not in self._sockets]
+        if left:
+            cache.delete_many([user_key(user_id, self.process_id) for user_id in left])
+        cache.set(process_key(self.process_id), {'users': len(user_ids), 'connections': connections}, timeout)
+
+        # The registry is only written when processes start or die, an update lost to a process
+        # writing it at the same time is repaired by the next refresh
+        processes = set(cache.get(PROCESSES_KEY) or ())
+        alive = cache.get_many([process_key(process_id) for process_id in processes | {self.process_id}])
+        live = {process_id for process_id in processes | {self.process_id} if process_key(process_id) in alive}
+        if live != processes:
+            cache.set(PROCESSES_KEY, list(live), None)
+        self._registered = True
+
+    def stats(self):
+        """
+        Sockets and online users of the whole cluster.
+
+        A user with sockets in several processes is counted once per process.
+
+        Returns:
+        dict -- Number of `processes`, `users` and `connections`.
+        """
+        processes = cache.get(PROCESSES_KEY) or []
+        summaries = cache.get_many([process_key(process_id) for process_id in processes]).values()
+        return {
+            'processes': len(summaries),
+            'users': sum(summary['users'] for summary in summaries),
+            'connections': sum(summary['connections'] for summary in summaries),
+        }
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='presence', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Error publishing socket presence: {e}")
+            time.sleep(self.ttl / 3)
+
+
+presence = PresenceRegistry()
+metrics.gauge('socket.connections', presence.connections)
+metrics.gauge('socket.online_users', lambda: len(presence))
+metrics.gauge('presence.connections', lambda: presence.stats()['connections'])
+metrics.gauge('presence.online_users', lambda: presence.stats()['users'])
@@ -1,3 +1,489 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+import msgpack
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from auth_login.models import User
+from auth_login.tokens import RefreshToken
+from config.settings import locations
+from driver.location import LocationBuffer
+from driver.models import Driver
+from notifications.broker import Broker
+from notifications.consumers import RideConsumer
+from notifications.events import event_message, event_messages, missed_events, render_event, seq_key
+from notifications.frames import COORDINATE_SCALE, MSGPACK, JsonFrames, MsgpackFrames, negotiate
+from notifications.layers import BrokerChannelLayer, HashRing, ShardedChannelLayer
+from notifications.middleware import get_user
+from notifications.outbox import DISCONNECT, DROP, Outbox
+from notifications.presence import PresenceRegistry, presence, process_key, user_key
+from notifications.utils import notification_group, send_messages_to_channels
+from rider.models import Ride
+
+
+def point(name):
+    return Point(locations[name]['longitude'], locations[name]['latitude'])
+
+
+@override_settings(DISPATCH_BACKEND='rider.dispatch.ImmediateBackend')
+class RideConsumerCommandTestCase(TransactionTestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def setUp(self):
+        self.driver = Driver.objects.select_related('user').get(user__email="driver4@gmail.com")
+        self.rider = User.objects.get(email="rider1@gmail.com")
+        # Dispatch runs when the ride is committed, which is immediately outside a transaction
+        self.ride = Ride.objects.create(
+            name='socket-ride', rider=self.rider,
+            pickup_location=point('karinkallathani'), dropoff_location=point('mannarkkad'))
+        self.assertTrue(self.driver.offers.live().filter(ride=self.ride).exists())
+
+    async def connect(self, user, path='/ws/notifications/', subprotocols=None, accepted=None):
+        communicator = WebsocketCommunicator(RideConsumer.as_asgi(), path, subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, accepted)
+        return communicator
+
+    async def test_accept_command(self):
+        communicator = await self.connect(self.driver.user)
+        await communicator.send_json_to({'type': 'accept', 'id': 'a1', 'ride': self.ride.id})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response, {'type': 'ack', 'id': 'a1', 'ride': self.ride.id, 'status': 'IN_PROGRESS'})
+        # The notification group joined on connect receives the accept notification
+        event = await communicator.receive_json_from()
+        self.assertEqual((event['type'], event['event']), ('event', 'ride.accepted'))
+        self.assertEqual(event['data']['id'], self.ride.id)
+        self.assertEqual(event['data']['driver'], self.driver.id)
+
+        # The second accept conflicts with the first one
+        await communicator.send_json_to({'type': 'accept', 'id': 'a2', 'ride': self.ride.id})
+        response = await communicator.receive_json_from()
+        self.assertEqual((response['type'], response['id'], response['code']), ('error', 'a2', 'conflict'))
+        await communicator.disconnect()
+
+    async def test_reconnect_replays_missed_events(self):
+        # The offer of the ride created in setUp was sent while the driver was offline
+        last = cache.get(seq_key(self.driver.user_id))
+        communicator = await self.connect(self.driver.user, f'/ws/notifications/?since={last - 1}')
+        event = await communicator.receive_json_from()
+        self.assertEqual((event['event'], event['seq'], event['data']['id']), ('ride.offer', last, self.ride.id))
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+        # Nothing is replayed to an up to date client
+        communicator = await self.connect(self.driver.user, f'/ws/notifications/?since={last}')
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_msgpack_frames(self):
+        communicator = await self.connect(
+            self.driver.user, subprotocols=['ridebook.unknown', MSGPACK], accepted=MSGPACK)
+        await communicator.send_to(bytes_data=msgpack.packb({'type': 'accept', 'id': 'a1', 'ride': self.ride.id}))
+        response = msgpack.unpackb(await communicator.receive_from())
+        self.assertEqual(response, {'type': 'ack', 'id': 'a1', 'ride': self.ride.id, 'status': 'IN_PROGRESS'})
+        event = msgpack.unpackb(await communicator.receive_from())
+        self.assertEqual((event['type'], event['event'], event['data']['id']), ('event', 'ride.accepted', self.ride.id))
+        # Coordinates are fixed-point integers
+        self.assertEqual(event['data']['pickup']['latitude'], round(self.ride.pickup_location.y * COORDINATE_SCALE))
+
+        await communicator.send_to(bytes_data=b'\xc1')
+        self.assertEqual(msgpack.unpackb(await communicator.receive_from())['code'], 'invalid_msgpack')
+        await communicator.disconnect()
+
+    async def test_unknown_subprotocols_get_json_frames(self):
+        communicator = await self.connect(self.driver.user, subprotocols=['other'], accepted=None)
+        await communicator.send_json_to({'type': 'reject', 'id': 1, 'ride': self.ride.id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'ack', 'id': 1, 'ride': self.ride.id})
+        await communicator.disconnect()
+
+    async def test_reject_command(self):
+        communicator = await self.connect(self.driver.user)
+        await communicator.send_json_to({'type': 'reject', 'id': 7, 'ride': self.ride.id})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response, {'type': 'ack', 'id': 7, 'ride': self.ride.id})
+        self.assertTrue(await Ride.rejected_drivers.through.objects.filter(
+            ride_id=self.ride.id, driver_id=self.driver.id).aexists())
+        await communicator.disconnect()
+
+    async def test_location_command(self):
+        location_buffer = LocationBuffer(flush_interval=0)
+        communicator = await self.connect(self.driver.user)
+        with mock.patch('driver.services.location_buffer', location_buffer):
+            await communicator.send_json_to({'type': 'location', 'id': 'l1', 'latitude': 10.99, 'longitude': 76.46})
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'ack', 'id': 'l1'})
+            self.assertEqual(location_buffer.get(self.driver.id), (10.99, 76.46))
+
+            await communicator.send_json_to({'type': 'location', 'id': 'l2', 'latitude': 91, 'longitude': 76.46})
+            response = await communicator.receive_json_from()
+            self.assertEqual((response['type'], response['code']), ('error', 'invalid'))
+        await communicator.disconnect()
+
+    async def test_connect_and_disconnect_record_heartbeat(self):
+        silent = timezone.now() - timedelta(hours=1)
+        await Driver.objects.filter(id=self.driver.id).aupdate(last_seen_at=silent)
+        communicator = WebsocketCommunicator(RideConsumer.as_asgi(), '/ws/notifications/')
+        communicator.scope.update(user=self.driver.user, driver_id=self.driver.id)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        connected_at = (await Driver.objects.aget(id=self.driver.id)).last_seen_at
+        self.assertGreater(connected_at, silent)
+
+        await communicator.disconnect()
+        self.assertGreaterEqual((await Driver.objects.aget(id=self.driver.id)).last_seen_at, connected_at)
+
+    async def test_socket_marks_user_online(self):
+        communicator = await self.connect(self.driver.user)
+        self.assertEqual(await sync_to_async(presence.online)([self.driver.user_id]), {self.driver.user_id})
+        await communicator.disconnect()
+        self.assertEqual(await sync_to_async(presence.online)([self.driver.user_id]), set())
+
+    async def test_invalid_commands(self):
+        communicator = await self.connect(self.driver.user)
+        await communicator.send_to(text_data='not json')
+        self.assertEqual((await communicator.receive_json_from())['code'], 'invalid_json')
+        await communicator.send_json_to({'type': 'fly', 'id': 1})
+        self.assertEqual((await communicator.receive_json_from())['code'], 'unknown_type')
+        await communicator.send_json_to({'type': 'accept', 'id': 2, 'ride': 'x'})
+        self.assertEqual((await communicator.receive_json_from())['code'], 'invalid')
+        # Acks of pushed messages are not answered
+        await communicator.send_json_to({'type': 'ack', 'id': 3})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_commands_require_driver(self):
+        communicator = await self.connect(self.rider)
+        await communicator.send_json_to({'type': 'accept', 'id': 1, 'ride': self.ride.id})
+        self.assertEqual((await communicator.receive_json_from())['code'], 'not_driver')
+        await communicator.disconnect()
+
+        communicator = await self.connect(AnonymousUser())
+        await communicator.send_json_to({'type': 'accept', 'id': 1, 'ride': self.ride.id})
+        self.assertEqual((await communicator.receive_json_from())['code'], 'not_authenticated')
+        await communicator.disconnect()
+
+
+class ShardedChannelLayerTestCase(SimpleTestCase):
+    def test_hash_ring_moves_few_keys(self):
+        keys = [f"group_{i}" for i in range(3000)]
+        before = HashRing(range(3))
+        after = HashRing(range(4))
+        counts = [sum(before.get(key) == node for key in keys) for node in range(3)]
+        self.assertGreater(min(counts), 700)
+        moved = sum(before.get(key) != after.get(key) for key in keys)
+        self.assertLess(moved, len(keys) * 0.35)
+
+    async def test_group_send_reaches_every_shard(self):
+        layer = ShardedChannelLayer(shards=[{'BACKEND': 'notifications.layers.LocalChannelLayer'}] * 3)
+        channels = [f"specific.process{i}!consumer" for i in range(12)]
+        self.assertEqual(len({layer.shard_for_channel(channel) for channel in channels}), 3)
+        for channel in channels:
+            await layer.group_add('riders', channel)
+        await layer.group_send('riders', {'type': 'send.message', 'text': 'hello'})
+        for channel in channels:
+            self.assertEqual((await layer.receive(channel))['text'], 'hello')
+
+        await layer.group_discard('riders', channels[0])
+        await layer.group_send('riders', {'type': 'send.message', 'text': 'again'})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channels[0]), 0.1)
+
+    async def test_broker_shards(self):
+        directory = tempfile.mkdtemp()
+        servers, shards = [], []
+        for index in range(2):
+            path = os.path.join(directory, f'broker{index}.sock')
+            servers.append(await asyncio.start_unix_server(Broker().handle, path=path))
+            shards.append(
+                {'BACKEND': 'notifications.layers.BrokerChannelLayer', 'CONFIG': {'address': f'unix://{path}'}})
+        # Two processes, each with its own connections to the brokers
+        sender, receiver = ShardedChannelLayer(shards=shards), ShardedChannelLayer(shards=shards)
+        try:
+            channel = await receiver.new_channel()
+            await receiver.group_add('notification_1', channel)
+            await sender.group_send('notification_1', {'type': 'send.message', 'text': 'Ride request'})
+            self.assertEqual((await receiver.receive(channel))['text'], 'Ride request')
+
+            # A cancelled receive does not swallow the next message
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(receiver.receive(channel), 0.1)
+            await sender.send(channel, {'type': 'send.message', 'text': 'direct'})
+            self.assertEqual((await receiver.receive(channel))['text'], 'direct')
+        finally:
+            await sender.close()
+            await receiver.close()
+            for server in servers:
+                server.close()
+
+    def test_sync_sends_do_not_keep_connections(self):
+        path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_unix_server(Broker().handle, path=path))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        layer = BrokerChannelLayer(f'unix://{path}')
+        try:
+            # Every async_to_sync call runs on a new event loop
+            for _ in range(5):
+                async_to_sync(layer.group_send)('notification_1', {'type': 'send.message', 'text': 'Ride request'})
+            self.assertEqual(len(layer._connections), 0)
+        finally:
+            loop.call_soon_threadsafe(server.close)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+class SendMessagesToChannelsTestCase(SimpleTestCase):
+    def test_failures_are_reported_per_group(self):
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                if group == notification_group('broken'):
+                    raise ConnectionError('broker down')
+                sent.append((group, message['text']))
+
+        with mock.patch('notifications.utils.get_channel_layer', return_value=Layer()):
+            failures = send_messages_to_channels(
+                (notification_group(user_id), 'Ride request') for user_id in ['A1', 'broken', 'B2'])
+
+        self.assertEqual(list(failures), [notification_group('broken')])
+        self.assertIsInstance(failures[notification_group('broken')], ConnectionError)
+        self.assertEqual(
+            sorted(sent), [(notification_group('A1'), 'Ride request'), (notification_group('B2'), 'Ride request')])
+
+
+class EventFrameTestCase(SimpleTestCase):
+    def setUp(self):
+        # Every user has a socket open
+        online = mock.patch('notifications.events.presence.online', side_effect=set)
+        online.start()
+        self.addCleanup(online.stop)
+
+    def test_frame_carries_payload_and_sequence(self):
+        group, message = event_message('U1', 'ride.offer', '{"id": 5}', expires_at='2026-01-01T00:00:00')
+        self.assertEqual(group, notification_group('U1'))
+        self.assertEqual(json.loads(message['frame']), {
+            'type': 'event',
+            'event': 'ride.offer',
+            'seq': message['seq'],
+            'expires_at': '2026-01-01T00:00:00',
+            'data': {'id': 5},
+        })
+        _, following = event_message('U1', 'ride.withdrawn', '{"id": 5}')
+        self.assertEqual(following['seq'], message['seq'] + 1)
+
+    def test_missed_events_are_replayed_from_the_ring_buffer(self):
+        with mock.patch('notifications.events.NOTIFICATION_REPLAY_SIZE', 4):
+            seqs = [event_message('U2', 'ride.offer', f'{{"id": {i}}}')[1]['seq'] for i in range(6)]
+            frames, last, complete = missed_events('U2', seqs[3])
+            self.assertEqual([json.loads(frame)['seq'] for frame in frames], seqs[4:])
+            self.assertEqual(last, seqs[-1])
+            self.assertTrue(complete)
+
+            self.assertEqual(missed_events('U2', seqs[-1]), ([], seqs[-1], True))
+
+            # Only the last four events are kept, the client has to resync
+            frames, last, complete = missed_events('U2', seqs[0])
+            self.assertEqual([json.loads(frame)['seq'] for frame in frames], seqs[2:])
+            self.assertFalse(complete)
+
+
+class FrameEncodingTestCase(SimpleTestCase):
+    def test_json_is_the_default(self):
+        frames, subprotocol = negotiate(None)
+        self.assertIsInstance(frames, JsonFrames)
+        self.assertIsNone(subprotocol)
+        # A subprotocol the client did not offer would fail its handshake
+        frames, subprotocol = negotiate(['other'])
+        self.assertIsInstance(frames, JsonFrames)
+        self.assertIsNone(subprotocol)
+        frames, subprotocol = negotiate(['ridebook.json', MSGPACK])
+        self.assertIsInstance(frames, JsonFrames)
+        self.assertEqual(subprotocol, 'ridebook.json')
+        frames, subprotocol = negotiate(['other', MSGPACK])
+        self.assertIsInstance(frames, MsgpackFrames)
+        self.assertEqual(subprotocol, MSGPACK)
+
+    def test_msgpack_event_matches_json_event(self):
+        data = '{"id": 5, "pickup": {"latitude": 10.9760493, "longitude": 76.2253917}, "distance": 812}'
+        frame = render_event('ride.offer', 3, data, expires_at='2026-01-01T00:00:00')
+        encoded = MsgpackFrames().encode_event(frame)
+        self.assertEqual(msgpack.unpackb(encoded)['data']['pickup'], {'latitude': 109760493, 'longitude': 762253917})
+        self.assertEqual(encoded, MsgpackFrames().encode(json.loads(frame)))
+        self.assertLess(len(encoded), len(frame))
+        self.assertEqual(MsgpackFrames().decode(encoded), json.loads(frame))
+
+    def test_commands_are_decoded_to_degrees(self):
+        command = msgpack.packb({'type': 'location', 'id': 1, 'latitude': 109900000, 'longitude': 764600000})
+        self.assertEqual(MsgpackFrames().decode(command),
+                         {'type': 'location', 'id': 1, 'latitude': 10.99, 'longitude': 76.46})
+        # Text frames of a MessagePack client are JSON
+        self.assertEqual(MsgpackFrames().decode('{"type": "ack", "id": 2}'), {'type': 'ack', 'id': 2})
+
+
+class PresenceTestCase(SimpleTestCase):
+    def setUp(self):
+        self.first = PresenceRegistry(ttl=0, process_id='first')
+        self.second = PresenceRegistry(ttl=0, process_id='second')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_user_is_online_until_its_last_socket_closes(self):
+        self.first.join('P1')
+        self.first.join('P1')
+        self.first.leave('P1')
+        self.assertEqual(self.first.online(['P1', 'P2']), {'P1'})
+        self.first.leave('P1')
+        self.assertEqual(self.first.online(['P1']), set())
+        self.assertEqual((len(self.first), self.first.connections()), (0, 0))
+
+    def test_sockets_of_a_user_in_two_processes(self):
+        self.first.join('P1')
+        self.second.join('P1')
+        # The socket still open in the first process keeps the user online
+        self.second.leave('P1')
+        self.assertEqual(self.second.online(['P1']), {'P1'})
+        self.first.leave('P1')
+        self.assertEqual(self.second.online(['P1']), set())
+
+    def test_users_of_a_dead_process_go_offline(self):
+        self.first.join('P1')
+        self.second.join('P2')
+        # The summary of the second process expires, the next refresh prunes it from the registry
+        cache.delete(process_key('second'))
+        self.first.publish()
+        self.assertEqual(self.first.online(['P1', 'P2']), {'P1'})
+
+    def test_user_leaving_while_publishing_stays_offline(self):
+        self.first.join('P1')
+        set_many = cache.set_many
+
+        def leave_then_set_many(values, timeout):
+            # The last socket closes after the users were read and before they are written
+            if user_key('P1', 'first') in values:
+                self.first.leave('P1')
+            return set_many(values, timeout)
+
+        with mock.patch('notifications.presence.cache.set_many', side_effect=leave_then_set_many):
+            self.first.publish()
+        self.assertEqual(self.first.online(['P1']), set())
+
+    def test_cluster_stats_leave_out_dead_processes(self):
+        self.first.join('P1')
+        self.first.join('P2')
+        self.second.join('P2')
+        self.first.publish()
+        self.second.publish()
+        self.assertEqual(self.first.stats(), {'processes': 2, 'users': 3, 'connections': 3})
+
+        # The summary of a process that stopped refreshing expires
+        cache.delete(process_key('second'))
+        self.first.publish()
+        self.assertEqual(self.first.stats(), {'processes': 1, 'users': 2, 'connections': 2})
+
+    def test_offline_users_are_only_sent_to_replay(self):
+        self.first.join('P1')
+        with mock.patch('notifications.events.presence', self.first):
+            messages = event_messages(['P1', 'P2'], 'ride.offer', '{"id": 5}')
+        self.assertEqual([group for group, _ in messages], [notification_group('P1')])
+        frames, _, _ = missed_events('P2', 0)
+        self.assertEqual(json.loads(frames[-1])['data'], {'id': 5})
+
+
+class SocketUserTestCase(TransactionTestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def test_handshake_does_not_query(self):
+        driver = Driver.objects.get(user__email="driver4@gmail.com")
+        scope = {'query_string': f'token={RefreshToken.for_user(driver.user).access_token}'.encode()}
+        with self.assertNumQueries(0):
+            user = asyncio.run(get_user(scope))
+        self.assertEqual((user.id, user.is_authenticated), (driver.user_id, True))
+        self.assertEqual(scope['driver_id'], driver.id)
+
+    def test_invalid_token_is_anonymous(self):
+        self.assertIsInstance(asyncio.run(get_user({'query_string': b'token=invalid'})), AnonymousUser)
+
+
+class OutboxTestCase(SimpleTestCase):
+    def test_superseded_frames_are_coalesced(self):
+        outbox = Outbox(size=8)
+        outbox.put('offer 5', 'ride_5')
+        outbox.put('offer 6', 'ride_6')
+        outbox.put('ack')
+        outbox.put('withdrawn 5', 'ride_5')
+        # The latest frame of a ride takes the place of the earlier one at the back of the queue
+        frames = asyncio.run(self.drain(outbox))
+        self.assertEqual(frames, ['offer 6', 'ack', 'withdrawn 5'])
+        self.assertEqual(outbox.high_water, 3)
+
+    def test_full_outbox_drops_oldest_frame(self):
+        outbox = Outbox(size=2, policy=DROP)
+        for frame in ('a', 'b', 'c'):
+            self.assertTrue(outbox.put(frame))
+        self.assertEqual(asyncio.run(self.drain(outbox)), ['b', 'c'])
+
+    def test_full_outbox_refuses_frame_to_disconnect(self):
+        outbox = Outbox(size=2, policy=DISCONNECT)
+        self.assertTrue(outbox.put('a'))
+        self.assertTrue(outbox.put('b', 'ride_1'))
+        self.assertFalse(outbox.put('c'))
+        # A superseding frame still fits
+        self.assertTrue(outbox.put('b2', 'ride_1'))
+        self.assertEqual(asyncio.run(self.drain(outbox)), ['a', 'b2'])
+
+    def test_get_waits_for_a_frame(self):
+        async def scenario():
+            outbox = Outbox(size=2)
+            waiting = asyncio.create_task(outbox.get())
+            await asyncio.sleep(0)
+            self.assertFalse(waiting.done())
+            outbox.put('late')
+            return await asyncio.wait_for(waiting, 1)
+
+        self.assertEqual(asyncio.run(scenario()), 'late')
+
+    def test_dropped_frames_queue_a_resync(self):
+        async def scenario():
+            consumer = RideConsumer()
+            consumer.outbox = Outbox(size=2, policy=DROP)
+            for seq in (1, 2, 3):
+                await consumer.send_event({
+                    'seq': seq, 'frame': render_event('ride.accepted', seq, '{}'), 'coalesce': f'ride_{seq}'})
+            return [json.loads(frame) for frame in await self.drain(consumer.outbox)]
+
+        frames = asyncio.run(scenario())
+        # Making room for the resync frame dropped the second event too
+        self.assertEqual([frame['seq'] for frame in frames], [3, 3])
+        self.assertEqual(frames[1], {'type': 'resync', 'seq': 3})
+
+    def test_coalesced_frames_do_not_resync(self):
+        async def scenario():
+            consumer = RideConsumer()
+            consumer.outbox = Outbox(size=2, policy=DROP)
+            for seq, event in ((1, 'ride.offer'), (2, 'ride.withdrawn')):
+                await consumer.send_event({'seq': seq, 'frame': render_event(event, seq, '{}'), 'coalesce': 'ride_5'})
+            return [json.loads(frame) for frame in await self.drain(consumer.outbox)]
+
+        # The gap left by the superseded offer is expected, the client only gets the withdrawal
+        frames = asyncio.run(scenario())
+        self.assertEqual([(frame['type'], frame['seq']) for frame in frames], [('event', 2)])
+
+    @staticmethod
+    async def drain(outbox):
+        return [await outbox.get() for _ in range(len(outbox))]
@@ -1,13 +1,60 @@
+import asyncio
+import logging
+
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
+logger = logging.getLogger("notifications")
+
+
+def notification_group(user_id):
+    """
+    Name of the group every notification socket of a user joins.
+    """
+    return f"notification_{user_id}"
+
 
 def send_message_to_channel(channel_name, message):
+    return send_messages_to_channels([(channel_name, message)])
+
+
+def send_messages_to_channels(batch):
+    """
+    Send many messages in a single sync-to-async hop, concurrently.
+
+    A failed send does not stop the others, every failure is logged and returned.
+
+    Args:
+    batch -- Iterable of (group name, message) pairs, where the message is either
+             a text or a channel layer message such as the events of notifications.events.
+
+    Returns:
+    dict -- Exception of each group whose send failed, empty when all were delivered.
+    """
+    batch = list(batch)
+    if not batch:
+        return {}
     channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        channel_name,
-        {
-            'type': 'send.message',
-            'text': message,
-        }
-    )
+
+    async def send_all():
+        return await asyncio.gather(*(
+            channel_layer.group_send(channel_name, message if isinstance(message, dict) else {
+                'type': 'send.message',
+                'text': message,
+            })
+            for channel_name, message in batch
+        ), return_exceptions=True)
+
+    try:
+        results = async_to_sync(send_all)()
+    except Exception as e:
+        results = [e] * len(batch)
+
+    failures = {
+        channel_name: result
+        for (channel_name, _), result in zip(batch, results)
+        if isinstance(result, Exception)
+    }
+    for channel_name, error in failures.items():
+        logger.error(f"Error sending notification to {channel_name}: {error}")
+    return failures
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Ride
+from .models import Ride, RideOffer
 
 
 # Register your models here.
@@ -26,3 +26,10 @@ class RideAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
+
+
+@admin.register(RideOffer)
+class RideOfferAdmin(admin.ModelAdmin):
+    list_display = ('ride', 'driver', 'rank', 'state', 'offered_at', 'expires_at')
+    list_filter = ('state', 'offered_at')
+    raw_id_fields = ('ride', 'driver')
@@ -0,0 +1,188 @@
+"""
+dispatch.py
+Queue that moves ride dispatch out of the request that creates the ride.
+
+Rides are enqueued once their row is committed and a worker finds drivers and
+sends the offers. The backend is chosen with the DISPATCH_BACKEND setting:
+
+ImmediateBackend -- Dispatches inline, used by the tests.
+InProcessBackend -- asyncio worker on a background thread of the web process, for development.
+RedisBackend -- Redis list shared by every process, consumed by manage.py run_dispatch_worker.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+
+from base.metrics import metrics
+
+logger = logging.getLogger("rider")
+
+
+def enqueue_dispatch(ride_id):
+    """
+    Queue a ride for dispatch once the current transaction commits.
+
+    Args:
+    ride_id -- Id of the Ride to dispatch.
+
+    Returns:
+    None
+    """
+    transaction.on_commit(lambda: get_dispatch_backend().enqueue({
+        'ride_id': ride_id,
+        'enqueued_at': time.time(),
+    }))
+
+
+def run_job(job):
+    """
+    Dispatch the ride of a queued job and record how long each stage took.
+
+    Args:
+    job -- Dict with the `ride_id` and the `enqueued_at` timestamp.
+
+    Returns:
+    None
+    """
+    # rider.models imports this module to enqueue new rides, and rider.utils imports rider.models
+    from rider.models import Ride
+    from rider.utils import offer_ride_to_optimal_drivers
+
+    metrics.timer('dispatch.queue_wait').observe(max(time.time() - job['enqueued_at'], 0))
+    with metrics.time('dispatch.total'):
+        with metrics.time('dispatch.load'):
+            ride = Ride.objects.filter(id=job['ride_id'], status='PENDING').first()
+        if ride is None:
+            logger.info(f"Ride {job['ride_id']} is no longer pending, skipping dispatch")
+            return
+        offer_ride_to_optimal_drivers(ride)
+    metrics.incr('dispatch.jobs')
+
+
+class DispatchBackend:
+    """
+    Base class of dispatch queue backends.
+    """
+
+    def enqueue(self, job):
+        raise NotImplementedError
+
+    def depth(self):
+        """
+        Number of jobs waiting in the queue.
+        """
+        return 0
+
+    def run_forever(self):
+        """
+        Consume jobs in the current process until interrupted.
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not use a separate worker process")
+
+
+class ImmediateBackend(DispatchBackend):
+    def enqueue(self, job):
+        run_job(job)
+
+
+class InProcessBackend(DispatchBackend):
+    """
+    asyncio queue served by DISPATCH_WORKERS workers on an event loop in a daemon thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._queue = None
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            threading.Thread(target=self._run, args=(loop, ready), name='ride-dispatch', daemon=True).start()
+            ready.wait()
+            self._loop = loop
+
+    def _run(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        self._queue = asyncio.Queue()
+        for _ in range(settings.DISPATCH_WORKERS):
+            loop.create_task(self._worker())
+        ready.set()
+        loop.run_forever()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await database_sync_to_async(run_job, thread_sensitive=False)(job)
+            except Exception as e:
+                logger.error(f"Error dispatching ride {job['ride_id']}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def enqueue(self, job):
+        self._start()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, job)
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+class RedisBackend(DispatchBackend):
+    """
+    Redis list shared between processes, using the connection of the default cache.
+    """
+
+    key = 'ride_dispatch_queue'
+
+    def _connection(self):
+        return get_redis_connection('default')
+
+    def enqueue(self, job):
+        self._connection().lpush(self.key, json.dumps(job))
+
+    def depth(self):
+        return self._connection().llen(self.key)
+
+    def run_forever(self):
+        connection = self._connection()
+        while True:
+            item = connection.brpop(self.key, timeout=5)
+            if item is None:
+                continue
+            job = json.loads(item[1])
+            close_old_connections()
+            try:
+                run_job(job)
+            except Exception as e:
+                logger.error(f"Error dispatching ride {job['ride_id']}: {e}")
+
+
+_backends = {}
+
+
+def get_dispatch_backend():
+    """
+    Get the backend configured by DISPATCH_BACKEND, creating it on first use.
+
+    Returns:
+    DispatchBackend -- The dispatch queue backend.
+    """
+    path = settings.DISPATCH_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+metrics.gauge('dispatch.queue_depth', lambda: get_dispatch_backend().depth())
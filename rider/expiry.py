@@ -0,0 +1,178 @@
+"""
+expiry.py
+Expiry of ride offers nobody answered.
+
+Every ride with offers out has a timer on an in-process TimerWheel, due when
+its offers lapse. When it fires the lapsed offers are marked EXPIRED and the
+ride is dispatched again, skipping the drivers who already had it, so the
+search moves on to drivers further away. After DISPATCH_MAX_ATTEMPTS rounds
+the ride is marked UNFULFILLED and the rider is told.
+
+Timers only live in memory. They are restored from the active offers when the
+timer thread starts, which the ASGI and WSGI applications do on startup, so a
+restarted server expires the offers made before it stopped. manage.py
+expire_offers handles lapsed offers from the database when no server runs.
+"""
+import logging
+import threading
+import time
+
+from django.db import connection
+from django.db.models import F, Max
+from django.utils import timezone
+
+from base.metrics import metrics
+from config.settings import DISPATCH_MAX_ATTEMPTS, DISPATCH_OFFER_TTL, OFFER_EXPIRY_TICK
+from notifications.events import event_messages
+from notifications.utils import send_messages_to_channels
+from .dispatch import enqueue_dispatch
+from .models import Ride, RideOffer
+from .timers import TimerWheel
+
+logger = logging.getLogger("rider")
+
+
+def expire_ride_offers(ride_id):
+    """
+    Expire the lapsed offers of a ride, then dispatch it again or give up on it.
+
+    Every step is a conditional UPDATE, so processes handling the same ride at
+    once do not dispatch it twice.
+
+    Args:
+    ride_id -- Id of the Ride.
+
+    Returns:
+    str -- 'redispatched' or 'unfulfilled', None if the ride needs nothing.
+    """
+    RideOffer.objects.filter(ride_id=ride_id).expire()
+    ride = Ride.objects.filter(id=ride_id, status='PENDING', driver__isnull=True).first()
+    if ride is None or ride.offers.live().exists():
+        # Answered, cancelled, or offered again with a later timer
+        return None
+
+    now = timezone.now()
+    if ride.dispatch_attempts + 1 >= DISPATCH_MAX_ATTEMPTS:
+        if not Ride.objects.filter(id=ride.id, status='PENDING', driver__isnull=True).update(
+                status='UNFULFILLED', updated_at=now):
+            return None
+        logger.info(f"Ride {ride.id} unfulfilled after {ride.dispatch_attempts + 1} dispatch rounds")
+        metrics.incr('dispatch.unfulfilled')
+        ride.status = 'UNFULFILLED'
+        # rider.utils imports this module to schedule offers
+        from .utils import ride_event_key, ride_payload
+        send_messages_to_channels(event_messages(
+            [ride.rider_id], 'ride.unfulfilled', ride_payload(ride), ride_event_key(ride.id)))
+        return 'unfulfilled'
+
+    if not Ride.objects.filter(id=ride.id, status='PENDING', dispatch_attempts=ride.dispatch_attempts).update(
+            dispatch_attempts=F('dispatch_attempts') + 1, updated_at=now):
+        return None
+    logger.info(f"Offers of ride {ride.id} lapsed, dispatching it again")
+    metrics.incr('dispatch.redispatched')
+    enqueue_dispatch(ride.id)
+    # Retried even when the new round finds no driver, offers made by it replace this timer
+    offer_timers.schedule(ride.id, time.time() + DISPATCH_OFFER_TTL)
+    return 'redispatched'
+
+
+class OfferTimers:
+    """
+    Offer expiry timers of rides, fired by a background thread.
+
+    tick -- Seconds between turns of the wheel, 0 disables the background thread.
+    """
+
+    def __init__(self, tick=OFFER_EXPIRY_TICK):
+        self.tick = tick
+        self.wheel = TimerWheel(tick or 1, now=time.time())
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def schedule(self, ride_id, deadline):
+        """
+        Expire the offers of a ride at `deadline`, replacing its earlier timer.
+
+        Args:
+        ride_id -- Id of the Ride.
+        deadline -- Unix time in seconds.
+
+        Returns:
+        None
+        """
+        self.wheel.schedule(ride_id, deadline)
+        if self.tick:
+            self._start()
+
+    def cancel(self, ride_id):
+        self.wheel.cancel(ride_id)
+
+    def start(self):
+        """
+        Start the background thread, which restores the timers of the active offers first.
+
+        Returns:
+        None
+        """
+        if self.tick:
+            self._start()
+
+    def restore(self):
+        """
+        Schedule a timer for every ride with active offers in the database.
+
+        Returns:
+        int -- Number of timers restored.
+        """
+        rides = RideOffer.objects.active().values('ride_id').annotate(expires_at=Max('expires_at'))
+        count = 0
+        for row in rides.iterator():
+            self.wheel.schedule(row['ride_id'], row['expires_at'].timestamp())
+            count += 1
+        logger.info(f"Restored {count} offer expiry timers")
+        return count
+
+    def fire(self, now=None):
+        """
+        Handle the rides whose timers are due.
+
+        Returns:
+        int -- Number of timers fired.
+        """
+        expired = self.wheel.advance(time.time() if now is None else now)
+        for ride_id, _ in expired:
+            try:
+                expire_ride_offers(ride_id)
+            except Exception as e:
+                logger.error(f"Error expiring the offers of ride {ride_id}: {e}")
+        if expired:
+            metrics.incr('dispatch.offer_timers.fired', len(expired))
+        return len(expired)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='offer-expiry', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        try:
+            self.restore()
+        except Exception as e:
+            logger.error(f"Error restoring offer expiry timers: {e}")
+        finally:
+            connection.close()
+        while True:
+            time.sleep(self.tick)
+            if self.fire():
+                # Most turns touch no timer, so the thread does not hold a connection between them
+                connection.close()
+
+
+offer_timers = OfferTimers()
+metrics.gauge('dispatch.offer_timers', lambda: len(offer_timers))
@@ -0,0 +1,70 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from config.settings import MAX_RADIUS
+from rider.matching import candidate_pairs, greedy_assignment, solve_assignment
+
+
+class Command(BaseCommand):
+    help = 'Compare the batch matcher with greedy one-ride-at-a-time matching on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rides',
+            nargs='+',
+            type=int,
+            default=[500, 1000, 2000, 4000],
+            help='Pending ride counts to benchmark'
+        )
+        parser.add_argument(
+            '--drivers-per-ride',
+            type=float,
+            default=1.5,
+            help='Number of free drivers per pending ride'
+        )
+        parser.add_argument(
+            '--area',
+            type=float,
+            default=60,
+            help='Edge length in KM of the square rides and drivers are spread over'
+        )
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(42)
+        # Centre the synthetic city on Perinthalmanna
+        centre = np.array([10.976, 76.212])
+        span = options['area'] / 111.32 / 2
+        radius = MAX_RADIUS * 1000
+
+        self.stdout.write(
+            f'{"rides":>7} {"drivers":>8} {"pairs ms":>9} | {"greedy ms":>9} {"matched":>8} {"pickup km":>10} | '
+            f'{"batch ms":>9} {"matched":>8} {"pickup km":>10}')
+
+        for n_rides in options['rides']:
+            n_drivers = int(n_rides * options['drivers_per_ride'])
+            ride_coords = centre + rng.uniform(-span, span, (n_rides, 2))
+            driver_coords = centre + rng.uniform(-span, span, (n_drivers, 2))
+
+            start = time.perf_counter()
+            rides, drivers, costs = candidate_pairs(ride_coords, driver_coords, radius)
+            pairs_ms = (time.perf_counter() - start) * 1000
+            cost = dict(zip(zip(rides.tolist(), drivers.tolist()), costs.tolist()))
+
+            start = time.perf_counter()
+            greedy = greedy_assignment(n_rides, rides, drivers, costs)
+            greedy_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            batch = solve_assignment(n_rides, n_drivers, rides, drivers, costs)
+            batch_ms = (time.perf_counter() - start) * 1000
+
+            greedy_km = sum(cost[pair] for pair in greedy) / 1000
+            batch_km = sum(cost[pair] for pair in batch) / 1000
+            self.stdout.write(
+                f'{n_rides:>7} {n_drivers:>8} {pairs_ms:>9.1f} | '
+                f'{greedy_ms:>9.1f} {len(greedy):>8} {greedy_km:>10.1f} | '
+                f'{batch_ms:>9.1f} {len(batch):>8} {batch_km:>10.1f}')
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete!'))
@@ -0,0 +1,45 @@
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from config.settings import DISPATCH_OFFER_TTL
+from rider.expiry import expire_ride_offers
+from rider.models import RideOffer
+
+
+class Command(BaseCommand):
+    help = 'Expire lapsed ride offers from the database, for rides whose in-process timer was lost'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=DISPATCH_OFFER_TTL,
+            help='Seconds between sweeps'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single sweep and exit'
+        )
+
+    def sweep(self):
+        ride_ids = RideOffer.objects.active().filter(
+            expires_at__lte=timezone.now(),
+        ).values_list('ride_id', flat=True).distinct()
+        return Counter(expire_ride_offers(ride_id) for ride_id in list(ride_ids))
+
+    def handle(self, *args, **options):
+        if options['once']:
+            outcomes = self.sweep()
+            self.stdout.write(self.style.SUCCESS(
+                f'{outcomes["redispatched"]} rides dispatched again, {outcomes["unfulfilled"]} unfulfilled'))
+            return
+
+        self.stdout.write(self.style.NOTICE(f'Expiring lapsed ride offers every {options["interval"]}s...'))
+        while True:
+            started = time.monotonic()
+            self.sweep()
+            time.sleep(max(options['interval'] - (time.monotonic() - started), 0))
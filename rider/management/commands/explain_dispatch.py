@@ -0,0 +1,89 @@
+import random
+
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from auth_login.models import User
+from config.settings import DISPATCH_CANDIDATE_POOL, DISPATCH_RADIUS_RINGS, DISPATCH_TOP_K, MAX_RADIUS
+from driver.models import Driver
+from driver.services import driver_rides
+from rider.models import Ride
+from rider.utils import available_drivers_near, find_optimal_drivers
+
+
+class Command(BaseCommand):
+    help = 'Print EXPLAIN ANALYZE of the driver search queries of ride dispatch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--drivers',
+            type=int,
+            default=0,
+            help='Synthetic available drivers added for the run and rolled back afterwards'
+        )
+        parser.add_argument(
+            '--area',
+            type=float,
+            default=60,
+            help='Edge length in KM of the square the synthetic drivers are spread over'
+        )
+        parser.add_argument(
+            '--latitude',
+            type=float,
+            default=10.976,
+            help='Latitude of the pickup location'
+        )
+        parser.add_argument(
+            '--longitude',
+            type=float,
+            default=76.212,
+            help='Longitude of the pickup location'
+        )
+
+    def seed(self, count, pickup, area):
+        rng = random.Random(42)
+        span = area / 111.32 / 2
+        users = User.objects.bulk_create([
+            User(email=f'explain_driver_{i}@ridebook.test', full_name=f'Explain Driver {i}') for i in range(count)
+        ], batch_size=5000)
+        Driver.objects.bulk_create([
+            # Every tenth driver is busy, so the partial index has rows to leave out
+            Driver(user=user, model='Explain', registration_number=f'EXPLAIN{i}', color='Red', available=i % 10 != 0,
+                   location=Point(pickup.x + rng.uniform(-span, span), pickup.y + rng.uniform(-span, span)))
+            for i, user in enumerate(users)
+        ], batch_size=5000)
+
+    def explain(self, title, queryset):
+        self.stdout.write(self.style.NOTICE(title))
+        self.stdout.write(str(queryset.query))
+        self.stdout.write(queryset.explain(analyze=True, buffers=True))
+        self.stdout.write('')
+
+    def handle(self, *args, **options):
+        pickup = Point(options['longitude'], options['latitude'])
+        with transaction.atomic():
+            if options['drivers']:
+                self.seed(options['drivers'], pickup, options['area'])
+            with connection.cursor() as cursor:
+                # Fresh statistics, so the plans are the ones the tables would get in production
+                cursor.execute(f'ANALYZE {Driver._meta.db_table}')
+            self.stdout.write(self.style.NOTICE(
+                f'{Driver.objects.filter(available=True).count()} available drivers'))
+
+            rider = User.objects.create(email='explain_rider@ridebook.test', full_name='Explain Rider')
+            ride = Ride.objects.create(rider=rider, name='Explain', pickup_location=pickup)
+
+            self.explain(f'Nearest {DISPATCH_TOP_K} drivers within {DISPATCH_RADIUS_RINGS[0]} km',
+                         find_optimal_drivers(ride, DISPATCH_RADIUS_RINGS[0], use_index=False)[:DISPATCH_TOP_K])
+            self.explain(f'Candidate pool of {DISPATCH_CANDIDATE_POOL} drivers within {MAX_RADIUS} km',
+                         find_optimal_drivers(ride, MAX_RADIUS, use_index=False)[:DISPATCH_CANDIDATE_POOL])
+            self.explain(f'Every available driver within {MAX_RADIUS} km',
+                         available_drivers_near(pickup, MAX_RADIUS * 1000).only('id', 'user_id'))
+            driver = Driver.objects.filter(available=True).first()
+            if driver:
+                self.explain('Rides a driver can act on', driver_rides(driver.id))
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS('Explain complete, synthetic rows rolled back'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rider.dispatch import get_dispatch_backend
+
+
+class Command(BaseCommand):
+    help = 'Consume the ride dispatch queue of a multi-process DISPATCH_BACKEND such as RedisBackend'
+
+    def handle(self, *args, **options):
+        backend = get_dispatch_backend()
+        self.stdout.write(self.style.NOTICE(f'Dispatching rides from {backend.__class__.__name__}...'))
+        try:
+            backend.run_forever()
+        except NotImplementedError as e:
+            raise CommandError(str(e))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from config.settings import DISPATCH_BATCH_WINDOW
+from rider.matching import BatchMatcher
+
+
+class Command(BaseCommand):
+    help = 'Run the batch matcher that assigns pending rides to drivers every DISPATCH_BATCH_WINDOW seconds'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window',
+            type=float,
+            default=DISPATCH_BATCH_WINDOW,
+            help='Seconds to collect pending rides between matching rounds'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single matching round and exit'
+        )
+
+    def handle(self, *args, **options):
+        matcher = BatchMatcher()
+        if options['once']:
+            offered = matcher.tick()
+            self.stdout.write(self.style.SUCCESS(f'{offered} rides offered'))
+            return
+
+        self.stdout.write(self.style.NOTICE(f'Matching pending rides every {options["window"]}s...'))
+        while True:
+            started = time.monotonic()
+            matcher.tick()
+            time.sleep(max(options['window'] - (time.monotonic() - started), 0))
@@ -0,0 +1,305 @@
+"""
+matching.py
+Batched global assignment of pending rides to available drivers.
+
+Instead of matching every ride greedily as it is created, the batch matcher
+collects the PENDING rides that have no live offer, builds a ride x driver
+pickup distance matrix with NumPy and solves the assignment for all of them
+at once, so nearby riders no longer compete for the same driver.
+"""
+import logging
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.utils import timezone
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from base.geo import EARTH_RADIUS, KM_PER_DEGREE, travel_times
+from config.settings import MAX_RADIUS, DISPATCH_BATCH_SIZE, DISPATCH_BATCH_CANDIDATES
+from driver.models import Driver
+from notifications.events import event_messages
+from notifications.utils import send_messages_to_channels
+from rider.expiry import offer_timers
+from rider.models import Ride, RideOffer
+from rider.utils import get_driver_index, offer_expiry, ride_event_key, ride_payload, save_offers
+
+logger = logging.getLogger("rider")
+
+# Number of rides whose distances are computed in one vectorized step
+CHUNK_SIZE = 256
+
+
+def haversine_matrix(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distances between every pair of points from two sets.
+
+    Args:
+    lat1, lng1 -- Arrays of shape (n,) in degrees.
+    lat2, lng2 -- Arrays of shape (m,) in degrees.
+
+    Returns:
+    ndarray -- Distances of shape (n, m) in meters.
+    """
+    phi1 = np.radians(lat1)[:, None]
+    phi2 = np.radians(lat2)[None, :]
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(lng2)[None, :] - np.radians(lng1)[:, None]
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def candidate_pairs(ride_coords, driver_coords, radius, limit=DISPATCH_BATCH_CANDIDATES):
+    """
+    Find the nearest drivers within a radius of every ride.
+
+    Rides are processed in latitude-sorted chunks and each chunk is only compared
+    with the drivers inside its latitude band, which keeps the distance matrices small.
+
+    Args:
+    ride_coords -- Array of shape (n, 2) with (lat, lng) pickup locations.
+    driver_coords -- Array of shape (m, 2) with (lat, lng) driver locations.
+    radius -- Search radius in meters.
+    limit -- Maximum number of candidate drivers per ride.
+
+    Returns:
+    tuple -- (rides, drivers, costs) arrays describing the candidate pairs,
+             with row/column indexes into the inputs and distances in meters.
+    """
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+    if not len(ride_coords) or not len(driver_coords):
+        return empty
+
+    driver_order = np.argsort(driver_coords[:, 0])
+    driver_lats = driver_coords[driver_order, 0]
+    lat_span = radius / 1000 / KM_PER_DEGREE
+
+    ride_order = np.argsort(ride_coords[:, 0])
+    rides, drivers, costs = [], [], []
+    for start in range(0, len(ride_order), CHUNK_SIZE):
+        chunk = ride_order[start:start + CHUNK_SIZE]
+        low = np.searchsorted(driver_lats, ride_coords[chunk, 0].min() - lat_span, side='left')
+        high = np.searchsorted(driver_lats, ride_coords[chunk, 0].max() + lat_span, side='right')
+        if low == high:
+            continue
+        band = driver_order[low:high]
+        distances = haversine_matrix(
+            ride_coords[chunk, 0], ride_coords[chunk, 1], driver_coords[band, 0], driver_coords[band, 1])
+
+        if band.size > limit:
+            nearest = np.argpartition(distances, limit - 1, axis=1)[:, :limit]
+        else:
+            nearest = np.broadcast_to(np.arange(band.size), (chunk.size, band.size))
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        within = nearest_distances <= radius
+
+        rides.append(np.repeat(chunk, within.sum(axis=1)))
+        drivers.append(band[nearest[within]])
+        costs.append(nearest_distances[within])
+
+    if not rides:
+        return empty
+    return np.concatenate(rides), np.concatenate(drivers), np.concatenate(costs)
+
+
+def solve_assignment(n_rides, n_drivers, rides, drivers, costs):
+    """
+    Assign drivers to rides minimising the total pickup distance.
+
+    The candidate pairs are split into connected components (groups of rides that
+    share candidate drivers) and each component is solved exactly with the
+    Hungarian method. As many rides as possible are matched first, then the
+    total distance is minimised.
+
+    Args:
+    n_rides -- Number of rides.
+    n_drivers -- Number of drivers.
+    rides, drivers, costs -- Candidate pairs as returned by candidate_pairs.
+
+    Returns:
+    list -- (ride, driver) index pairs.
+    """
+    if not rides.size:
+        return []
+
+    graph = coo_matrix((np.ones(rides.size), (rides, drivers + n_rides)), shape=(n_rides + n_drivers,) * 2)
+    _, labels = connected_components(graph, directed=False)
+
+    # Each candidate pair belongs to the component of its ride
+    pair_labels = labels[rides]
+    order = np.argsort(pair_labels, kind='stable')
+    boundaries = np.flatnonzero(np.diff(pair_labels[order])) + 1
+
+    assignment = []
+    for group in np.split(order, boundaries):
+        group_rides, ride_index = np.unique(rides[group], return_inverse=True)
+        group_drivers, driver_index = np.unique(drivers[group], return_inverse=True)
+
+        if group_rides.size == 1:
+            best = np.argmin(costs[group])
+            assignment.append((int(group_rides[0]), int(group_drivers[driver_index[best]])))
+            continue
+
+        # Any missing pair costs more than every feasible assignment in the component combined
+        infeasible = (costs[group].max() + 1) * (group_rides.size + 1)
+        matrix = np.full((group_rides.size, group_drivers.size), infeasible)
+        matrix[ride_index, driver_index] = costs[group]
+        row_ind, col_ind = linear_sum_assignment(matrix)
+        feasible = matrix[row_ind, col_ind] < infeasible
+        assignment.extend(
+            (int(group_rides[row]), int(group_drivers[col]))
+            for row, col in zip(row_ind[feasible], col_ind[feasible])
+        )
+    return assignment
+
+
+def greedy_assignment(n_rides, rides, drivers, costs):
+    """
+    Assign drivers one ride at a time, each ride taking its nearest free driver.
+
+    This is how rides are matched when every ride is dispatched on its own and
+    serves as the baseline for the batch matcher.
+
+    Args:
+    n_rides -- Number of rides, matched in index order.
+    rides, drivers, costs -- Candidate pairs as returned by candidate_pairs.
+
+    Returns:
+    list -- (ride, driver) index pairs.
+    """
+    order = np.lexsort((costs, rides))
+    starts = np.searchsorted(rides[order], np.arange(n_rides + 1))
+    taken = set()
+    assignment = []
+    for ride in range(n_rides):
+        for pair in order[starts[ride]:starts[ride + 1]]:
+            driver = int(drivers[pair])
+            if driver not in taken:
+                taken.add(driver)
+                assignment.append((ride, driver))
+                break
+    return assignment
+
+
+class BatchMatcher:
+    """
+    Match every undispatched PENDING ride in one pass and offer each ride to its assigned driver.
+
+    radius -- Search radius in KM.
+    batch_size -- Maximum number of rides matched per tick, oldest first.
+    """
+
+    def __init__(self, radius=MAX_RADIUS, batch_size=DISPATCH_BATCH_SIZE):
+        self.radius = radius
+        self.batch_size = batch_size
+
+    def pending_rides(self):
+        """
+        PENDING rides with a pickup location that have no live offer.
+        """
+        return list(Ride.objects.filter(
+            status='PENDING',
+            driver__isnull=True,
+            pickup_location__isnull=False,
+        ).exclude(
+            id__in=RideOffer.objects.live().values('ride_id'),
+        ).order_by('created_at').values_list('id', 'pickup_location')[:self.batch_size])
+
+    def free_drivers(self):
+        """
+        Indexed drivers that are not holding a live offer for a PENDING ride.
+        """
+        busy = set(RideOffer.objects.live().filter(
+            ride__status='PENDING',
+        ).values_list('driver_id', flat=True))
+        return [row for row in get_driver_index().snapshot() if row[0] not in busy]
+
+    def tick(self):
+        """
+        Run one matching round.
+
+        Returns:
+        int -- Number of rides offered to a driver.
+        """
+        started = time.perf_counter()
+        rides = self.pending_rides()
+        if not rides:
+            return 0
+        drivers = self.free_drivers()
+        if not drivers:
+            logger.info(f"Batch matcher: {len(rides)} pending rides but no free drivers")
+            return 0
+
+        ride_ids = np.array([ride_id for ride_id, _ in rides])
+        ride_coords = np.array([(location.y, location.x) for _, location in rides])
+        driver_ids = np.array([driver_id for driver_id, _, _ in drivers])
+        driver_coords = np.array([(lat, lng) for _, lat, lng in drivers])
+
+        pair_rides, pair_drivers, costs = candidate_pairs(ride_coords, driver_coords, self.radius * 1000)
+
+        # Never offer a ride again to a driver who rejected it or let its offer lapse
+        rejected = set(Ride.rejected_drivers.through.objects.filter(
+            ride_id__in=ride_ids.tolist(),
+        ).values_list('ride_id', 'driver_id')) | set(RideOffer.objects.filter(
+            ride_id__in=ride_ids.tolist(),
+        ).values_list('ride_id', 'driver_id'))
+        if rejected:
+            keep = np.array([
+                (int(ride_ids[ride]), int(driver_ids[driver])) not in rejected
+                for ride, driver in zip(pair_rides, pair_drivers)
+            ], dtype=bool)
+            pair_rides, pair_drivers, costs = pair_rides[keep], pair_drivers[keep], costs[keep]
+
+        assignment = solve_assignment(len(ride_ids), len(driver_ids), pair_rides, pair_drivers, costs)
+        solved = time.perf_counter()
+
+        pickup = {(int(ride), int(driver)): cost for ride, driver, cost in zip(pair_rides, pair_drivers, costs)}
+        offered = self.offer([
+            (int(ride_ids[ride]), int(driver_ids[driver]), pickup[ride, driver]) for ride, driver in assignment])
+        logger.info(
+            f"Batch matcher: {offered}/{len(rides)} rides offered to {len(drivers)} free drivers, "
+            f"solved in {(solved - started) * 1000:.1f} ms")
+        return offered
+
+    def offer(self, pairs):
+        """
+        Offer rides to their assigned drivers.
+
+        Assignments to drivers that stopped being available since the index was read are dropped.
+
+        Args:
+        pairs -- (ride_id, driver_id, pickup distance in meters) tuples.
+
+        Returns:
+        int -- Number of offers made.
+        """
+        users = dict(Driver.objects.available().filter(
+            id__in=[driver_id for _, driver_id, _ in pairs],
+        ).values_list('id', 'user_id'))
+        pairs = [pair for pair in pairs if pair[1] in users]
+        expires_at = offer_expiry()
+        offers = [
+            RideOffer(ride_id=ride_id, driver_id=driver_id, expires_at=expires_at)
+            for ride_id, driver_id, _ in pairs
+        ]
+        save_offers(offers)
+        for offer in offers:
+            offer_timers.schedule(offer.ride_id, expires_at.timestamp())
+
+        rides = Ride.objects.in_bulk([offer.ride_id for offer in offers])
+        # Every ride is offered to a single driver, so its ETA is that driver's
+        now = timezone.now()
+        seconds = travel_times(np.array([meters for _, _, meters in pairs]), now)
+        for (ride_id, _, _), travel in zip(pairs, seconds):
+            rides[ride_id].eta, rides[ride_id].updated_at = now + timedelta(seconds=float(travel)), now
+        Ride.objects.bulk_update(rides.values(), ['eta', 'updated_at'])
+        send_messages_to_channels(
+            message
+            for offer in offers
+            for message in event_messages(
+                [users[offer.driver_id]], 'ride.offer', ride_payload(rides[offer.ride_id]),
+                ride_event_key(offer.ride_id), expires_at=expires_at.isoformat())
+        )
+        return len(offers)
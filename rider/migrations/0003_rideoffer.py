@@ -0,0 +1,74 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+OFFER_TTL = 30  # in seconds, the default DISPATCH_OFFER_TTL
+
+
+def copy_ride_requests(apps, schema_editor):
+    """
+    Turn every ride request into an offer, active while its ride is pending.
+    """
+    Driver = apps.get_model('driver', 'Driver')
+    RideOffer = apps.get_model('rider', 'RideOffer')
+    now = django.utils.timezone.now()
+    requests = Driver.ride_requests.through.objects.values_list('ride_id', 'driver_id', 'ride__status')
+    RideOffer.objects.bulk_create([
+        RideOffer(
+            ride_id=ride_id, driver_id=driver_id, offered_at=now, expires_at=now + timedelta(seconds=OFFER_TTL),
+            state='ACTIVE' if status == 'PENDING' else 'WITHDRAWN',
+        )
+        for ride_id, driver_id, status in requests.iterator()
+    ], batch_size=1000)
+
+
+def copy_active_offers(apps, schema_editor):
+    Driver = apps.get_model('driver', 'Driver')
+    RideOffer = apps.get_model('rider', 'RideOffer')
+    RideRequest = Driver.ride_requests.through
+    RideRequest.objects.bulk_create([
+        RideRequest(ride_id=ride_id, driver_id=driver_id)
+        for ride_id, driver_id in RideOffer.objects.filter(state='ACTIVE').values_list('ride_id', 'driver_id')
+    ], batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('driver', '0002_initial'),
+        ('rider', '0002_ride_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RideOffer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField(default=0)),
+                ('offered_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField()),
+                ('state', models.CharField(choices=[('ACTIVE', 'Active'), ('ACCEPTED', 'Accepted'), ('REJECTED', 'Rejected'), ('EXPIRED', 'Expired'), ('WITHDRAWN', 'Withdrawn')], default='ACTIVE', max_length=20)),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='offers', to='driver.driver')),
+                ('ride', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='offers', to='rider.ride')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rideoffer',
+            index=models.Index(condition=models.Q(('state', 'ACTIVE')), fields=['driver', 'expires_at'], name='ride_offer_driver_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rideoffer',
+            index=models.Index(condition=models.Q(('state', 'ACTIVE')), fields=['ride'], name='ride_offer_ride_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rideoffer',
+            index=models.Index(condition=models.Q(('state', 'ACTIVE')), fields=['expires_at'], name='ride_offer_expiry_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='rideoffer',
+            constraint=models.UniqueConstraint(fields=('ride', 'driver'), name='ride_offer_ride_driver_uniq'),
+        ),
+        migrations.RunPython(copy_ride_requests, copy_active_offers),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rider', '0003_rideoffer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='dispatch_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='ride',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('IN_PROGRESS', 'In Progress'), ('COMPLETED', 'Completed'), ('CANCELLED', 'Cancelled'), ('UNFULFILLED', 'Unfulfilled')], default='PENDING', max_length=20),
+        ),
+    ]
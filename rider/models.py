@@ -1,22 +1,74 @@
 import logging
 
 from django.contrib.gis.db import models
+from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 
 from auth_login.models import User
+from base.geo import haversine
 from driver.models import Driver
-from rider.utils import add_ride_to_driver_ride_requests
+from notifications.events import event_messages
+from notifications.utils import send_messages_to_channels
+from rider.dispatch import enqueue_dispatch
 
 logger = logging.getLogger("rider")
 
 
+class RideQuerySet(models.QuerySet):
+    def cancel_pending(self):
+        """
+        Cancel the PENDING rides of the queryset and withdraw their active offers.
+
+        Rides and offers are updated by one statement, an UPDATE of the rides whose
+        RETURNING rows drive the UPDATE of their offers, however many rides there
+        are. Like accept_ride it takes no lock before writing: a ride accepted
+        meanwhile is no longer PENDING when the UPDATE reaches it and is left
+        alone. The drivers whose offers are withdrawn are told in one batch.
+
+        Returns:
+        list -- The cancelled Rides.
+        """
+        # rider.utils and rider.expiry import this module
+        from .expiry import offer_timers
+        from .utils import ride_event_key, ride_payload
+
+        now = timezone.now()
+        selected, params = self.values('id').query.sql_with_params()
+        rides = list(Ride.objects.raw(f"""
+            WITH cancelled AS (
+                UPDATE {Ride._meta.db_table} SET status = 'CANCELLED', updated_at = %s
+                WHERE status = 'PENDING' AND id IN ({selected})
+                RETURNING *
+            ), withdrawn AS (
+                UPDATE {RideOffer._meta.db_table} AS offer SET state = %s
+                FROM cancelled, {Driver._meta.db_table} AS driver
+                WHERE offer.ride_id = cancelled.id AND offer.driver_id = driver.id AND offer.state = %s
+                RETURNING offer.ride_id, driver.user_id
+            )
+            SELECT cancelled.*,
+                   ARRAY(SELECT user_id FROM withdrawn WHERE withdrawn.ride_id = cancelled.id) AS withdrawn_user_ids
+            FROM cancelled
+        """, [now, *params, RideOffer.WITHDRAWN, RideOffer.ACTIVE]))
+
+        messages = []
+        for ride in rides:
+            offer_timers.cancel(ride.id)
+            if ride.withdrawn_user_ids:
+                messages += event_messages(
+                    ride.withdrawn_user_ids, 'ride.withdrawn', ride_payload(ride), ride_event_key(ride.id))
+        send_messages_to_channels(messages)
+        return rides
+
+
 class Ride(models.Model):
     STATUS_CHOICES = [
         ('PENDING', 'Pending'),
         ('IN_PROGRESS', 'In Progress'),
         ('COMPLETED', 'Completed'),
         ('CANCELLED', 'Cancelled'),
+        ('UNFULFILLED', 'Unfulfilled'),
     ]
     # name for testing purposes
     name = models.CharField(max_length=255, default='Ride')
@@ -27,33 +79,121 @@ class Ride(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    objects = models.Manager()
     eta = models.DateTimeField(blank=True, null=True)
     rejected_drivers = models.ManyToManyField(Driver, related_name='rejected_rides', blank=True)
+    # Dispatch rounds whose offers lapsed without an answer, see rider.expiry
+    dispatch_attempts = models.PositiveSmallIntegerField(default=0)
+    objects = RideQuerySet.as_manager()
 
     def distance(self):
+        """
+        Great-circle distance from the pickup to the dropoff location in meters, 0 without both.
+        """
         if self.pickup_location and self.dropoff_location:
-            return self.pickup_location.distance(self.dropoff_location) * 100
+            return haversine(
+                self.pickup_location.y, self.pickup_location.x, self.dropoff_location.y, self.dropoff_location.x)
         return 0
 
     def __str__(self):
         return f"Ride {self.id} - {self.rider.full_name} to {self.driver.user.full_name if self.driver else None} "
 
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        # Keyset pagination of the rides of a rider or a driver, see rider.pagination
+        indexes = [
+            models.Index(fields=['rider', 'created_at', 'id'], name='ride_rider_created_idx'),
+            models.Index(fields=['driver', 'created_at', 'id'], name='ride_driver_created_idx'),
+            models.Index(fields=['rider', 'updated_at', 'id'], name='ride_rider_updated_idx'),
+            models.Index(fields=['driver', 'updated_at', 'id'], name='ride_driver_updated_idx'),
+        ]
 
     def cancel(self):
-        self.status = 'CANCELLED'
-        self.drivers.clear()
-        self.save()
+        """
+        Cancel the ride if it is still pending, see RideQuerySet.cancel_pending.
+
+        Returns:
+        bool -- False when the ride was accepted or cancelled in the meantime.
+        """
+        cancelled = Ride.objects.filter(id=self.id).cancel_pending()
+        if not cancelled:
+            return False
+        self.status, self.updated_at = 'CANCELLED', cancelled[0].updated_at
+        return True
 
     @property
     def can_cancel(self):
         return self.status == 'PENDING'
 
 
+class RideOfferQuerySet(models.QuerySet):
+    def active(self):
+        """
+        Offers still waiting for an answer, including the ones past their expiry that were not expired yet.
+        """
+        return self.filter(state=RideOffer.ACTIVE)
+
+    def live(self):
+        """
+        Offers the driver can still answer.
+        """
+        return self.active().filter(expires_at__gt=timezone.now())
+
+    def expire(self):
+        """
+        Mark every active offer past its expiry as expired, with a single UPDATE.
+
+        Returns:
+        int -- Number of offers expired.
+        """
+        return self.active().filter(expires_at__lte=timezone.now()).update(state=RideOffer.EXPIRED)
+
+
+class RideOffer(models.Model):
+    """
+    A ride offered to a driver.
+
+    A driver has at most one offer per ride. Offering a ride to the same driver
+    again reactivates it. Active offers are covered by partial indexes, so listing the
+    live offers of a driver and expiring offers are index range scans.
+    """
+    ACTIVE = 'ACTIVE'
+    ACCEPTED = 'ACCEPTED'
+    REJECTED = 'REJECTED'
+    EXPIRED = 'EXPIRED'
+    WITHDRAWN = 'WITHDRAWN'
+    STATE_CHOICES = [
+        (ACTIVE, 'Active'),
+        (ACCEPTED, 'Accepted'),
+        (REJECTED, 'Rejected'),
+        (EXPIRED, 'Expired'),
+        (WITHDRAWN, 'Withdrawn'),
+    ]
+    ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='offers')
+    driver = models.ForeignKey(Driver, on_delete=models.CASCADE, related_name='offers')
+    # Position of the driver among the candidates of the ride, 0 for the nearest
+    rank = models.PositiveSmallIntegerField(default=0)
+    offered_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=ACTIVE)
+    objects = RideOfferQuerySet.as_manager()
+
+    def __str__(self):
+        return f"Offer of ride {self.ride_id} to driver {self.driver_id} ({self.state})"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ride', 'driver'], name='ride_offer_ride_driver_uniq'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['driver', 'expires_at'], condition=Q(state='ACTIVE'), name='ride_offer_driver_active_idx'),
+            models.Index(fields=['ride'], condition=Q(state='ACTIVE'), name='ride_offer_ride_active_idx'),
+            models.Index(fields=['expires_at'], condition=Q(state='ACTIVE'), name='ride_offer_expiry_idx'),
+        ]
+
+
 @receiver(post_save, sender=Ride)
 def handle_ride_creation(sender, instance, created, **kwargs):
     if created:
-        logger.info(f"Ride {instance.id} created for {instance.rider.full_name}")
-        add_ride_to_driver_ride_requests(instance)
+        logger.info(f"Ride {instance.id} created for rider {instance.rider_id}")
+        enqueue_dispatch(instance.id)
@@ -12,8 +12,8 @@ class RideSerializer(serializers.ModelSerializer):
     class Meta:
         model = Ride
         fields = ['id', 'name', 'rider', 'driver', 'pickup_location', 'dropoff_location',
-                  'status', 'created_at', 'updated_at']
-        read_only_fields = ['id', 'created_at', 'updated_at', 'status', 'rider', 'driver']
+                  'status', 'eta', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'status', 'eta', 'rider', 'driver']
 
     def validate_location_data(self, location_data):
         if 'latitude' not in location_data or 'longitude' not in location_data:
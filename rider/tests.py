@@ -1,14 +1,34 @@
+import json
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APITestCase
 
 from auth_login.models import User
-from config.settings import locations
+from base.geo import arrival, distances, haversine, travel_times
+from config.settings import DISPATCH_MAX_ATTEMPTS, locations
 from driver.models import Driver
-from .models import Ride
+from rider.expiry import OfferTimers, expire_ride_offers
+from rider.matching import candidate_pairs, greedy_assignment, solve_assignment
+from rider.timers import TimerWheel
+from rider.utils import (
+    cache_candidates, find_nearest_drivers, find_optimal_drivers, get_driver_index, offer_ride_to_drivers,
+    reject_ride_offer, ride_payload,
+)
+from .models import Ride, RideOffer
 
 
 
 
+@override_settings(DISPATCH_BACKEND='rider.dispatch.ImmediateBackend')
 class RideViewSetTestCase(APITestCase):
     fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
 
@@ -22,9 +42,38 @@ class RideViewSetTestCase(APITestCase):
     def test_list_rides(self):
         response = self.client.get(reverse('ride-list'))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
         self.assertEqual(response.data['results'][0]['name'], 'Ride 1')
 
+    def test_list_rides_by_cursor(self):
+        for i in range(2, 6):
+            Ride.objects.create(rider=self.user, name=f'Ride {i}', pickup_location='POINT(1.234 1.234)',
+                                dropoff_location='POINT(2.234 2.234)')
+        names = []
+        url = reverse('ride-list')
+        with mock.patch('rider.pagination.RideCursorPagination.page_size', 2):
+            while url:
+                # A page never counts the rides of the rider
+                with self.assertNumQueries(1):
+                    response = self.client.get(url)
+                names += [ride['name'] for ride in response.data['results']]
+                url = response.data['next']
+        self.assertEqual(names, ['Ride 5', 'Ride 4', 'Ride 3', 'Ride 2', 'Ride 1'])
+
+    def test_list_rides_changed_since(self):
+        ride = Ride.objects.get(name='Ride 1')
+        response = self.client.get(reverse('ride-list'), {'since': ride.updated_at.isoformat()})
+        self.assertEqual(response.data['results'], [])
+
+        since = ride.updated_at
+        ride.cancel()
+        response = self.client.get(reverse('ride-list'), {'since': since.isoformat()})
+        self.assertEqual([(r['name'], r['status']) for r in response.data['results']], [('Ride 1', 'CANCELLED')])
+
+        response = self.client.get(reverse('ride-list'), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
     def test_create_ride(self):
         response = self.client.post(reverse('ride-list'), {
             'name': 'Ride 2',
@@ -35,21 +84,20 @@ class RideViewSetTestCase(APITestCase):
         self.assertEqual(Ride.objects.count(), 2)
 
     def test_cancel_ride(self):
-        response = self.client.post(reverse('ride-list'), {
-            'name': 'Ride 2',
-            'pickup_location': locations['karinkallathani'],
-            'dropoff_location': locations['mannarkkad']
-        }, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('ride-list'), {
+                'name': 'Ride 2',
+                'pickup_location': locations['karinkallathani'],
+                'dropoff_location': locations['mannarkkad']
+            }, format='json')
         self.assertEqual(response.status_code, 201)
         self.assertEqual(Ride.objects.count(), 2)
         ride = Ride.objects.get(name='Ride 2')
-        drivers = ride.drivers.all()
         response = self.client.post(reverse('ride-cancel', kwargs={'pk': ride.id}))
         self.assertEqual(response.status_code, 200)
         ride.refresh_from_db()
         self.assertEqual(ride.status, 'CANCELLED')
-        for driver in drivers:
-            self.assertEqual(driver.ride_requests.filter(id=ride.id).exists(), False)
+        self.assertFalse(ride.offers.active().exists())
 
     def test_pending_ride_auto_cancel(self):
         response = self.client.post(reverse('ride-list'), {
@@ -78,11 +126,13 @@ class RideViewSetTestCase(APITestCase):
         self.assertEqual(Ride.objects.filter(status='PENDING').count(), 1)
 
     def test_ride_allocation(self):
-        response = self.client.post(reverse('ride-list'), {
-            'name': 'Ride 1',
-            'pickup_location': locations['perinthalmanna'],
-            'dropoff_location': locations['mannarkkad']
-        }, format='json')
+        # Rides are dispatched once the ride row is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('ride-list'), {
+                'name': 'Ride 1',
+                'pickup_location': locations['perinthalmanna'],
+                'dropoff_location': locations['mannarkkad']
+            }, format='json')
 
         target_drivers = [
             'driver2@gmail.com',
@@ -90,7 +140,294 @@ class RideViewSetTestCase(APITestCase):
         ]
         self.assertEqual(response.status_code, 201)
         for driver in target_drivers:
-            self.assertEqual(Driver.objects.get(user__email=driver).ride_requests.filter(name='Ride 1').exists(),
+            self.assertEqual(Driver.objects.get(user__email=driver).offers.live().filter(ride__name='Ride 1').exists(),
                              True)
         for driver in Driver.objects.exclude(user__email__in=target_drivers):
-            self.assertEqual(driver.ride_requests.filter(name='Ride 1').exists(), False)
+            self.assertEqual(driver.offers.live().filter(ride__name='Ride 1').exists(), False)
+
+    def test_dispatch_waits_for_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('ride-list'), {
+                'name': 'Ride 6',
+                'pickup_location': locations['perinthalmanna'],
+                'dropoff_location': locations['mannarkkad']
+            }, format='json')
+            self.assertEqual(response.status_code, 201)
+            ride = Ride.objects.get(name='Ride 6')
+            self.assertFalse(ride.offers.exists())
+
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertTrue(ride.offers.live().exists())
+
+    def test_nearest_drivers_ranked_by_distance(self):
+        ride = Ride.objects.create(rider=self.user, name='Ranked', pickup_location=Point(
+            locations['perinthalmanna']['longitude'], locations['perinthalmanna']['latitude']))
+
+        nearest = find_nearest_drivers(ride, limit=1)
+        self.assertEqual([driver.user.email for driver in nearest], ['driver2@gmail.com'])
+
+        # Only one driver is inside the first ring, so the search widens to find a second
+        nearest = find_nearest_drivers(ride, limit=2)
+        self.assertEqual([driver.user.email for driver in nearest], ['driver2@gmail.com', 'driver1@gmail.com'])
+
+    def test_postgis_search_ranks_like_the_index(self):
+        ride = Ride.objects.create(rider=self.user, name='Ranked', pickup_location=Point(
+            locations['perinthalmanna']['longitude'], locations['perinthalmanna']['latitude']))
+        postgis = list(find_optimal_drivers(ride, use_index=False))
+        self.assertTrue(postgis)
+        self.assertEqual([driver.id for driver in postgis], [driver.id for driver in find_optimal_drivers(ride)])
+        # Nearest first, with the distance kept for the ETA
+        distances = [driver.distance.m for driver in postgis]
+        self.assertEqual(distances, sorted(distances))
+
+
+class EtaTestCase(SimpleTestCase):
+    def test_distance_is_in_meters(self):
+        pickup, dropoff = locations['karinkallathani'], locations['mannarkkad']
+        ride = Ride(pickup_location=Point(pickup['longitude'], pickup['latitude']),
+                    dropoff_location=Point(dropoff['longitude'], dropoff['latitude']))
+        self.assertAlmostEqual(ride.distance(), 15819, delta=1)
+        self.assertEqual(Ride(pickup_location=ride.pickup_location).distance(), 0)
+
+    def test_one_to_many_distances_match_haversine(self):
+        lats, lngs = np.array([10.95, 11.2, -33.9]), np.array([76.2, 76.5, 151.2])
+        expected = [haversine(10.9, 76.3, lat, lng) for lat, lng in zip(lats, lngs)]
+        np.testing.assert_allclose(distances(10.9, 76.3, lats, lngs), expected)
+
+    def test_travel_time_depends_on_time_of_day(self):
+        night = timezone.make_aware(datetime(2026, 1, 1, 2))
+        rush = timezone.make_aware(datetime(2026, 1, 1, 8))
+        self.assertGreater(travel_times(10000, rush), travel_times(10000, night))
+        self.assertEqual(arrival(0, night), night)
+
+
+class BatchMatchingTestCase(SimpleTestCase):
+    def setUp(self):
+        # Two riders close together, the first one is also close to the driver the second one needs
+        self.rides = np.array([[10.9, 76.300], [10.9, 76.310]])
+        self.drivers = np.array([[10.9, 76.306], [10.9, 76.290]])
+        self.pairs = candidate_pairs(self.rides, self.drivers, 10000)
+
+    def test_batch_assignment_minimises_total_pickup_distance(self):
+        greedy = greedy_assignment(2, *self.pairs)
+        batch = solve_assignment(2, 2, *self.pairs)
+        self.assertEqual(sorted(greedy), [(0, 0), (1, 1)])
+        self.assertEqual(sorted(batch), [(0, 1), (1, 0)])
+
+    def test_rides_without_drivers_in_range_are_left_unassigned(self):
+        rides = np.vstack([self.rides, [[11.5, 76.3]]])
+        batch = solve_assignment(3, 2, *candidate_pairs(rides, self.drivers, 10000))
+        self.assertEqual(len(batch), 2)
+        self.assertNotIn(2, [ride for ride, _ in batch])
+
+
+class OfferQueryCountTestCase(TestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def add_drivers(self, count):
+        centre = locations['karinkallathani']
+        users = User.objects.bulk_create([
+            User(email=f'bulk{count}_{i}@gmail.com', full_name=f'Bulk Driver {i}') for i in range(count)
+        ])
+        Driver.objects.bulk_create([
+            Driver(user=user, model='Bulk', registration_number=f'BULK{i}', color='Red',
+                   location=Point(centre['longitude'] + i * 0.0001, centre['latitude']))
+            for i, user in enumerate(users)
+        ])
+        # bulk_create skips the signals that keep the index in sync
+        get_driver_index().loaded_at = None
+        get_driver_index()
+
+    def test_offer_query_count_does_not_depend_on_driver_count(self):
+        rider = User.objects.get(email='rider1@gmail.com')
+        centre = locations['karinkallathani']
+        for count in (3, 30):
+            self.add_drivers(count)
+            ride = Ride.objects.create(rider=rider, name=f'Bulk {count}',
+                                       pickup_location=Point(centre['longitude'], centre['latitude']))
+            # One query to find the candidates and one INSERT for all offers
+            with self.assertNumQueries(2):
+                offered = offer_ride_to_drivers(ride, find_optimal_drivers(ride))
+            self.assertGreaterEqual(offered, count)
+            self.assertEqual(ride.offers.live().count(), offered)
+
+    def test_offer_payload_is_serialized_once(self):
+        rider = User.objects.get(email='rider1@gmail.com')
+        self.add_drivers(10)
+        pickup, dropoff = locations['karinkallathani'], locations['mannarkkad']
+        ride = Ride.objects.create(rider=rider, name='Payload',
+                                   pickup_location=Point(pickup['longitude'], pickup['latitude']),
+                                   dropoff_location=Point(dropoff['longitude'], dropoff['latitude']))
+        drivers = find_optimal_drivers(ride)
+        with mock.patch('rider.utils.json.dumps', wraps=json.dumps) as dumps:
+            offer_ride_to_drivers(ride, drivers)
+            offer_ride_to_drivers(ride, drivers)
+        self.assertEqual(dumps.call_count, 1)
+        payload = json.loads(ride_payload(ride))
+        self.assertEqual(payload['pickup'], pickup)
+        self.assertAlmostEqual(payload['distance'], 15819, delta=1)
+
+
+class RejectRedispatchTestCase(TestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def setUp(self):
+        centre = locations['karinkallathani']
+        self.ride = Ride.objects.create(rider=User.objects.get(email='rider1@gmail.com'), name='Reject',
+                                        pickup_location=Point(centre['longitude'], centre['latitude']))
+        self.candidates = find_nearest_drivers(self.ride, limit=3)
+        offer_ride_to_drivers(self.ride, self.candidates[:1])
+        cache_candidates(self.ride, self.candidates, 1)
+
+    def test_reject_offers_next_cached_candidate(self):
+        first, second = self.candidates[:2]
+        # Record the rejection, update the offer and insert the next one, no driver search
+        with self.assertNumQueries(3):
+            self.assertTrue(reject_ride_offer(self.ride, first))
+        self.assertEqual(list(self.ride.offers.live().values_list('driver_id', 'rank')), [(second.id, 1)])
+        self.assertEqual(self.ride.offers.get(driver=first).state, RideOffer.REJECTED)
+        self.assertTrue(self.ride.rejected_drivers.filter(id=first.id).exists())
+
+    def test_reject_falls_back_to_full_search_when_candidates_run_out(self):
+        for candidate in self.candidates[:-1]:
+            self.assertTrue(reject_ride_offer(self.ride, candidate))
+        self.assertFalse(reject_ride_offer(self.ride, self.candidates[-1]))
+        self.assertFalse(self.ride.offers.live().exists())
+
+    def test_expired_offers_are_bulk_expired_and_reoffered(self):
+        self.ride.offers.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertFalse(self.ride.offers.live().exists())
+        self.assertEqual(RideOffer.objects.expire(), 1)
+        self.assertEqual(self.ride.offers.get().state, RideOffer.EXPIRED)
+
+        # Offering the ride to the same driver again reactivates the offer
+        offer_ride_to_drivers(self.ride, self.candidates[:1])
+        self.assertEqual(list(self.ride.offers.live().values_list('driver_id', flat=True)), [self.candidates[0].id])
+
+
+class TimerWheelTestCase(SimpleTestCase):
+    def test_timers_fire_in_deadline_order(self):
+        wheel = TimerWheel(tick=1, slots=4, levels=2, now=0)
+        for key, deadline in (('late', 100), ('soon', 2), ('mid', 9), ('cancelled', 5)):
+            wheel.schedule(key, deadline, deadline)
+        self.assertTrue(wheel.cancel('cancelled'))
+        self.assertEqual(wheel.advance(1), [])
+        self.assertEqual(wheel.advance(10), [('soon', 2), ('mid', 9)])
+        # Beyond the range of the wheel the timer is parked and placed again as it turns
+        self.assertEqual(wheel.advance(99), [])
+        self.assertEqual(wheel.advance(100), [('late', 100)])
+        self.assertEqual(len(wheel), 0)
+
+    def test_rescheduling_replaces_the_timer(self):
+        wheel = TimerWheel(tick=1, now=0)
+        wheel.schedule('ride', 5)
+        wheel.schedule('ride', 50)
+        self.assertEqual(wheel.advance(10), [])
+        self.assertEqual(wheel.advance(50), [('ride', None)])
+
+    def test_offer_timers_fire_due_rides(self):
+        timers = OfferTimers(tick=0)
+        timers.schedule(1, 10)
+        timers.schedule(2, time.time() + 60)
+        with mock.patch('rider.expiry.expire_ride_offers') as expire:
+            self.assertEqual(timers.fire(), 1)
+        expire.assert_called_once_with(1)
+        self.assertEqual(len(timers), 1)
+
+    def test_start_restores_timers_without_a_new_offer(self):
+        OfferTimers(tick=0).start()
+        timers = OfferTimers(tick=60)
+        # The thread stops at its first turn of the wheel
+        with mock.patch.object(timers, 'restore', return_value=0) as restore, \
+                mock.patch('rider.expiry.time.sleep', side_effect=SystemExit):
+            timers.start()
+            timers._thread.join(5)
+        restore.assert_called_once_with()
+
+
+@override_settings(DISPATCH_BACKEND='rider.dispatch.ImmediateBackend')
+class OfferExpiryTestCase(TestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def setUp(self):
+        centre = locations['karinkallathani']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ride = Ride.objects.create(rider=User.objects.get(email='rider1@gmail.com'), name='Lapsed',
+                                            pickup_location=Point(centre['longitude'], centre['latitude']))
+
+    def lapse(self):
+        self.ride.offers.active().update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_lapsed_ride_is_dispatched_again_then_unfulfilled(self):
+        first = set(self.ride.offers.live().values_list('driver_id', flat=True))
+        self.assertTrue(first)
+
+        outcomes = []
+        for _ in range(DISPATCH_MAX_ATTEMPTS):
+            self.lapse()
+            with self.captureOnCommitCallbacks(execute=True):
+                outcomes.append(expire_ride_offers(self.ride.id))
+            if len(outcomes) == 1:
+                # The new round skips the drivers who let their offer lapse
+                self.assertEqual(set(self.ride.offers.filter(
+                    state=RideOffer.EXPIRED).values_list('driver_id', flat=True)), first)
+                self.assertFalse(first & set(self.ride.offers.live().values_list('driver_id', flat=True)))
+
+        self.assertEqual(outcomes, ['redispatched'] * (DISPATCH_MAX_ATTEMPTS - 1) + ['unfulfilled'])
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.status, 'UNFULFILLED')
+        self.assertFalse(self.ride.offers.active().exists())
+
+    def test_dispatch_sets_pickup_eta(self):
+        self.ride.refresh_from_db()
+        self.assertGreaterEqual(self.ride.eta, self.ride.created_at)
+
+    def test_answered_ride_is_left_alone(self):
+        self.ride.cancel()
+        self.lapse()
+        self.assertIsNone(expire_ride_offers(self.ride.id))
+        self.ride.refresh_from_db()
+        self.assertEqual((self.ride.status, self.ride.dispatch_attempts), ('CANCELLED', 0))
+
+
+class CancelPendingTestCase(TestCase):
+    fixtures = ['auth_login/fixtures/auth_login.json', 'driver/fixtures/driver.json', ]
+
+    def setUp(self):
+        self.rider = User.objects.get(email='rider1@gmail.com')
+        self.drivers = list(Driver.objects.all()[:3])
+
+    def book(self, count):
+        centre = locations['karinkallathani']
+        for i in range(count):
+            # Not dispatched, the offers are made here
+            ride = Ride.objects.create(rider=self.rider, name=f'Tap {i}',
+                                       pickup_location=Point(centre['longitude'], centre['latitude']))
+            offer_ride_to_drivers(ride, self.drivers)
+
+    def test_query_count_is_constant(self):
+        queries = []
+        for count in (1, 4):
+            self.book(count)
+            with mock.patch('rider.models.send_messages_to_channels') as send, \
+                    mock.patch('notifications.events.presence.online', side_effect=set), \
+                    CaptureQueriesContext(connection) as captured:
+                cancelled = Ride.objects.filter(rider=self.rider).cancel_pending()
+            queries.append(len(captured))
+            self.assertEqual(len(cancelled), count)
+            # Every driver of every ride is told in one batch
+            send.assert_called_once()
+            self.assertEqual(len(send.call_args.args[0]), count * len(self.drivers))
+
+        # Rides and offers are updated by a single statement
+        self.assertEqual(queries, [1, 1])
+        self.assertFalse(Ride.objects.filter(rider=self.rider, status='PENDING').exists())
+        self.assertFalse(RideOffer.objects.active().filter(ride__rider=self.rider).exists())
+
+    def test_nothing_pending(self):
+        self.book(1)
+        Ride.objects.update(status='COMPLETED')
+        with mock.patch('rider.models.send_messages_to_channels') as send:
+            self.assertEqual(Ride.objects.filter(rider=self.rider).cancel_pending(), [])
+        send.assert_not_called()
@@ -0,0 +1,128 @@
+"""
+timers.py
+Hierarchical timer wheel.
+
+Each level of the wheel is a ring of `slots` buckets. A bucket of level 0 spans
+one tick, a bucket of level n spans slots**n ticks. A timer is placed on the
+lowest level whose ring still reaches its deadline, and when the wheel turns
+into a bucket of a higher level the timers in it are moved down to finer
+buckets. Scheduling and cancelling a timer are dict operations on a bucket,
+so they cost O(1) however many timers are pending.
+"""
+import math
+import threading
+
+
+class TimerWheel:
+    """
+    Timers keyed by an id, each firing once after its deadline.
+
+    tick -- Seconds spanned by a bucket of the lowest level.
+    slots -- Buckets per level.
+    levels -- Number of levels, deadlines beyond tick * slots**levels are parked
+              on the last level and placed again as the wheel turns.
+    now -- Time the wheel starts at, in seconds.
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4, now=0.0):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = int(now // tick)
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, deadline, value=None):
+        """
+        Fire `key` once `deadline` has passed, replacing its earlier timer.
+
+        Args:
+        key -- Hashable id of the timer.
+        deadline -- Time in seconds, on the clock passed to advance.
+        value -- Returned with the key when the timer fires.
+
+        Returns:
+        None
+        """
+        expires = max(math.ceil(deadline / self.tick), self.current + 1)
+        with self._lock:
+            self._remove(key)
+            self._place(key, expires, value)
+
+    def cancel(self, key):
+        """
+        Remove the timer of `key`.
+
+        Returns:
+        bool -- False if no timer was pending for it.
+        """
+        with self._lock:
+            return self._remove(key)
+
+    def advance(self, now):
+        """
+        Turn the wheel up to `now` and pop the timers that expired.
+
+        Args:
+        now -- Current time in seconds.
+
+        Returns:
+        list -- (key, value) of the expired timers, in deadline order.
+        """
+        target = int(now // self.tick)
+        expired = []
+        with self._lock:
+            while self.current < target:
+                self.current += 1
+                # Move the timers of every higher level bucket the wheel enters down, coarsest first
+                for level in range(self.levels - 1, 0, -1):
+                    span = self.slots ** level
+                    if self.current % span == 0:
+                        self._cascade(level, (self.current // span) % self.slots)
+                bucket = self._wheels[0][self.current % self.slots]
+                self._wheels[0][self.current % self.slots] = {}
+                for key, (expires, value) in bucket.items():
+                    if expires <= self.current:
+                        del self._timers[key]
+                        expired.append((key, value))
+                    else:
+                        self._place(key, expires, value)
+        return expired
+
+    def _place(self, key, expires, value):
+        delta = expires - self.current
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1):
+                break
+        else:
+            # Park beyond the range of the wheel, the timer is placed again when its bucket comes up
+            expires_in_range = self.current + self.slots ** self.levels - 1
+            level = self.levels - 1
+            slot = (expires_in_range // self.slots ** level) % self.slots
+            self._wheels[level][slot][key] = (expires, value)
+            self._timers[key] = (level, slot)
+            return
+        slot = (expires // self.slots ** level) % self.slots
+        self._wheels[level][slot][key] = (expires, value)
+        self._timers[key] = (level, slot)
+
+    def _cascade(self, level, slot):
+        bucket = self._wheels[level][slot]
+        self._wheels[level][slot] = {}
+        for key, (expires, value) in bucket.items():
+            self._place(key, expires, value)
+
+    def _remove(self, key):
+        position = self._timers.pop(key, None)
+        if position is None:
+            return False
+        level, slot = position
+        del self._wheels[level][slot][key]
+        return True
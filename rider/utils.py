@@ -1,22 +1,50 @@
 # utils.py
+import json
 import logging
+from datetime import timedelta
 
-from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.db.models.functions import Distance, GeometryDistance
+from django.contrib.gis.measure import D
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 
-from config.settings import MAX_RADIUS
+from base.geo import arrival
+from base.metrics import metrics
+from config.settings import (
+    MAX_RADIUS, DRIVER_INDEX_ENABLED, DRIVER_INDEX_TTL, DISPATCH_MODE, DISPATCH_TOP_K, DISPATCH_RADIUS_RINGS,
+    DISPATCH_CANDIDATE_POOL, DISPATCH_CANDIDATE_TTL, DISPATCH_OFFER_TTL, NOTIFICATION_PAYLOAD_TTL,
+)
+from driver.index import driver_index
 from driver.models import Driver
-from notifications.utils import send_message_to_channel
+from notifications.events import event_messages
+from notifications.presence import presence
+from notifications.utils import send_messages_to_channels
+from .expiry import offer_timers
+from .models import Ride, RideOffer
 
 logger = logging.getLogger("rider")
 
+# Haversine distances in the index are spherical while PostGIS uses the spheroid,
+# so the index search is padded and PostGIS makes the final radius check.
+INDEX_RADIUS_SLACK = 1.01
 
-def add_ride_to_driver_ride_requests(ride):
+
+def offer_ride_to_optimal_drivers(ride):
     """
-    Add a ride to the ride requests of optimal drivers.
+    Offer a ride to optimal drivers.
 
     If the ride has a pickup location, find optimal drivers for that location
-    and add the ride to their ride requests.
+    and offer them the ride. In the 'nearest' dispatch mode only
+    the DISPATCH_TOP_K closest drivers get the ride, otherwise every driver
+    within MAX_RADIUS does. In the 'batch' mode rides are left for the batch
+    matcher in rider.matching.
+
+    In the 'nearest' mode the ranked candidates beyond the first DISPATCH_TOP_K
+    are cached so a rejection can move on to the next one without a new search.
+    Candidates with an open socket are ranked before the others.
+
+    The ride's eta is set to when the closest driver offered the ride would reach it.
 
     Args:
     ride -- The Ride instance.
@@ -24,48 +52,293 @@ def add_ride_to_driver_ride_requests(ride):
     Returns:
     None
     """
+    if DISPATCH_MODE == 'batch':
+        logger.info(f"Ride {ride.id} left for the batch matcher")
+        return
+
     if ride.pickup_location:
         logger.info(f"Finding optimal driver for ride {ride.id}")
-        optimal_driver = find_optimal_drivers(ride)
-        logger.info(f"Optimal drivers for ride {ride.id}: {optimal_driver.count() if optimal_driver else 0}")
+        with metrics.time('dispatch.find'):
+            if DISPATCH_MODE == 'nearest':
+                candidates = prefer_online(find_nearest_drivers(ride, DISPATCH_CANDIDATE_POOL))
+                optimal_driver = candidates[:DISPATCH_TOP_K]
+                cache_candidates(ride, candidates, len(optimal_driver))
+            else:
+                optimal_driver = list(find_optimal_drivers(ride))
+            logger.info(f"Optimal drivers for ride {ride.id}: {len(optimal_driver)}")
+
+        if optimal_driver:
+            set_pickup_eta(ride, min(driver.distance.m for driver in optimal_driver))
 
-        for driver in optimal_driver:
-            driver.ride_requests.add(ride)
-            logger.info(f"Ride {ride.id} added to driver {driver.id} ride requests")
-            try:
-                send_message_to_channel(f"notification__{driver.user.id}", "Ride request")
-                logger.info(f"Notification sent to driver {driver.id} for ride {ride.id}")
-            except Exception as e:
-                logger.error(f"Error sending notification to driver {driver.id} for ride {ride.id}: {e}")
+        with metrics.time('dispatch.offer'):
+            offer_ride_to_drivers(ride, optimal_driver)
+
+
+def prefer_online(drivers):
+    """
+    Order drivers with an open socket before the others, keeping the order within both groups.
+
+    Args:
+    drivers -- Driver instances.
 
+    Returns:
+    list -- The same Driver instances.
+    """
+    online = presence.online(driver.user_id for driver in drivers)
+    return sorted(drivers, key=lambda driver: driver.user_id not in online)
+
+
+def offer_ride_to_drivers(ride, drivers, rank=0):
+    """
+    Offer a ride to several drivers and notify them.
+
+    All offers are written with a single INSERT and all notifications go out in
+    one batch, so the number of queries does not depend on the number of drivers.
+
+    Args:
+    ride -- The Ride instance.
+    drivers -- Driver instances ordered by rank, only their `id` and `user_id` are used.
+    rank -- Rank of the first driver among the candidates of the ride.
 
-def find_optimal_drivers(ride):
+    Returns:
+    int -- Number of drivers the ride was offered to.
+    """
+    expires_at = offer_expiry()
+    offers = [
+        RideOffer(ride_id=ride.id, driver_id=driver.id, rank=rank + position, expires_at=expires_at)
+        for position, driver in enumerate(drivers)
+    ]
+    save_offers(offers)
+    # Without any driver the timer still fires, to dispatch the ride again or give up on it
+    offer_timers.schedule(ride.id, expires_at.timestamp())
+    logger.info(f"Ride {ride.id} offered to {len(offers)} drivers")
+
+    messages = event_messages(
+        [driver.user_id for driver in drivers], 'ride.offer', ride_payload(ride), ride_event_key(ride.id),
+        expires_at=expires_at.isoformat())
+    failures = send_messages_to_channels(messages)
+    logger.info(f"Notifications sent to {len(messages) - len(failures)}/{len(offers)} drivers for ride {ride.id}")
+    return len(offers)
+
+
+def set_pickup_eta(ride, meters):
+    """
+    Store when a driver at a distance from a ride's pickup location would reach it.
+
+    Args:
+    ride -- The Ride instance.
+    meters -- Great-circle distance of the driver to the pickup location.
+
+    Returns:
+    None
+    """
+    ride.updated_at = timezone.now()
+    ride.eta = arrival(meters, ride.updated_at)
+    Ride.objects.filter(id=ride.id).update(eta=ride.eta, updated_at=ride.updated_at)
+
+
+def save_offers(offers):
+    """
+    Insert ride offers with a single query, reactivating the earlier offers of the same ride to the same driver.
+
+    Args:
+    offers -- Unsaved RideOffer instances.
+
+    Returns:
+    None
+    """
+    RideOffer.objects.bulk_create(
+        offers, update_conflicts=True, unique_fields=['ride', 'driver'],
+        update_fields=['rank', 'offered_at', 'expires_at', 'state'])
+
+
+def offer_expiry():
+    """
+    Time until which a ride offer made now can be answered.
+    """
+    return timezone.now() + timedelta(seconds=DISPATCH_OFFER_TTL)
+
+
+def point_payload(point):
+    return {'latitude': point.y, 'longitude': point.x} if point else None
+
+
+def ride_payload(ride):
+    """
+    Serialized ride sent with notification events, cached per ride and state.
+
+    Args:
+    ride -- The Ride instance.
+
+    Returns:
+    str -- JSON object with the ride id, status, driver, pickup and dropoff
+           coordinates and the trip distance in meters.
+    """
+    key = f"ride_payload_{ride.id}_{ride.status}_{ride.driver_id}"
+    payload = cache.get(key)
+    if payload is None:
+        distance = round(ride.distance()) if ride.pickup_location and ride.dropoff_location else None
+        payload = json.dumps({
+            'id': ride.id,
+            'status': ride.status,
+            'driver': ride.driver_id,
+            'pickup': point_payload(ride.pickup_location),
+            'dropoff': point_payload(ride.dropoff_location),
+            'distance': distance,
+        })
+        cache.set(key, payload, NOTIFICATION_PAYLOAD_TTL)
+    return payload
+
+
+def ride_event_key(ride_id):
+    """
+    Coalescing key of the events about a ride, the latest one supersedes those still waiting for a socket.
+    """
+    return f"ride_{ride_id}"
+
+
+def candidates_cache_key(ride_id):
+    return f"ride_candidates_{ride_id}"
+
+
+def candidates_position_key(ride_id):
+    return f"ride_candidates_position_{ride_id}"
+
+
+def cache_candidates(ride, candidates, offered):
+    """
+    Cache the ranked candidate drivers of a ride for DISPATCH_CANDIDATE_TTL seconds.
+
+    Args:
+    ride -- The Ride instance.
+    candidates -- Driver instances ordered by distance.
+    offered -- Number of leading candidates the ride was already offered to.
+
+    Returns:
+    None
+    """
+    cache.set_many({
+        candidates_cache_key(ride.id): [(driver.id, driver.user_id) for driver in candidates],
+        candidates_position_key(ride.id): offered,
+    }, DISPATCH_CANDIDATE_TTL)
+
+
+def next_cached_candidate(ride):
+    """
+    Take the next candidate of a ride that has not been offered the ride yet.
+
+    The position in the list is advanced with an atomic cache increment, so
+    concurrent rejections never hand out the same candidate twice. Candidates
+    that left the driver index since the list was cached are skipped.
+
+    Args:
+    ride -- The Ride instance.
+
+    Returns:
+    tuple -- (unsaved Driver with only `id` and `user_id` set, its rank), or None
+             if the list expired or ran out.
+    """
+    candidates = cache.get(candidates_cache_key(ride.id))
+    if candidates is None:
+        return None
+    while True:
+        try:
+            position = cache.incr(candidates_position_key(ride.id)) - 1
+        except ValueError:
+            return None
+        if position >= len(candidates):
+            return None
+        driver_id, user_id = candidates[position]
+        if not DRIVER_INDEX_ENABLED or driver_id in driver_index:
+            return Driver(id=driver_id, user_id=user_id), position
+
+
+def reject_ride_offer(ride, driver):
+    """
+    Record a driver's rejection of a ride and offer the ride to the next cached candidate.
+
+    This costs one INSERT into the rejected drivers, one UPDATE of the offer and
+    one INSERT for the new offer, without searching for drivers again.
+
+    Args:
+    ride -- The Ride instance.
+    driver -- The Driver rejecting the ride.
+
+    Returns:
+    bool -- False if no cached candidate was left and the caller should dispatch
+            the ride again with a full search.
+    """
+    Driver.rejected_rides.through.objects.bulk_create(
+        [Driver.rejected_rides.through(ride_id=ride.id, driver_id=driver.id)], ignore_conflicts=True)
+    RideOffer.objects.filter(ride_id=ride.id, driver_id=driver.id).update(state=RideOffer.REJECTED)
+
+    if ride.status != 'PENDING':
+        return True
+    candidate = next_cached_candidate(ride)
+    if candidate is None:
+        logger.info(f"No cached candidates left for ride {ride.id}")
+        return False
+    candidate, rank = candidate
+    offer_ride_to_drivers(ride, [candidate], rank)
+    logger.info(f"Ride {ride.id} offered to next candidate driver {candidate.id}")
+    return True
+
+
+def find_nearest_drivers(ride, limit=DISPATCH_TOP_K):
+    """
+    Find the drivers closest to a ride's pickup location.
+
+    The search starts with the smallest radius in DISPATCH_RADIUS_RINGS and only
+    widens to the next ring while fewer than `limit` drivers are found.
+
+    Args:
+    ride -- The Ride instance.
+    limit -- Maximum number of drivers to return.
+
+    Returns:
+    list -- Up to `limit` Driver instances ordered by distance.
+    """
+    drivers = []
+    for radius in DISPATCH_RADIUS_RINGS:
+        drivers = list(find_optimal_drivers(ride, radius)[:limit])
+        if len(drivers) >= limit:
+            break
+    logger.info(f"Nearest drivers for ride {ride.id} within {radius} km: {len(drivers)}")
+    return drivers
+
+
+def find_optimal_drivers(ride, radius=MAX_RADIUS, use_index=True):
     """
     Find optimal drivers for a ride based on the pickup location.
 
     Optimal drivers are those who are available, have a location, and are within
-    a certain distance from the ride's pickup location.
+    a certain distance from the ride's pickup location. Candidates come from the
+    in-memory driver index and PostGIS only confirms their distance; without the
+    index PostGIS searches the partial GiST index of available drivers.
 
     Args:
     ride -- The Ride instance.
+    radius -- Search radius in KM.
+    use_index -- Whether to take the candidates from the in-memory driver index.
 
     Returns:
-    Queryset -- Queryset of optimal Driver instances.
+    Queryset -- Queryset of optimal Driver instances ordered by distance, with
+                only their `id` and `user_id` loaded.
     """
     pickup_location = ride.pickup_location
     logger.info(f"Finding optimal driver for pickup location {pickup_location}")
     try:
-        optimal_driver = Driver.objects.filter(
-            available=True,
-            location__isnull=False,
-        ).exclude(
+        optimal_driver = available_drivers_near(pickup_location, radius * 1000)
+        nearby_driver_ids = find_nearby_driver_ids(pickup_location, radius * 1000) if use_index else None
+        if nearby_driver_ids is not None:
+            # Only compute geography distances for drivers the grid index found nearby
+            optimal_driver = optimal_driver.filter(id__in=nearby_driver_ids)
+        optimal_driver = optimal_driver.exclude(
             id__in=ride.rejected_drivers.all()
-        ).annotate(
-            distance=Distance('location', pickup_location),
-        ).filter(
-            distance__lte=MAX_RADIUS*1000,  # Filter drivers within 10 km
-        )
-        logger.info(f"Optimal drivers found for pickup location {pickup_location}: {optimal_driver}")
+        ).exclude(
+            id__in=RideOffer.objects.filter(ride=ride).values('driver_id'),  # Drivers already offered this ride
+        ).only('id', 'user_id')
+        logger.info(f"Optimal driver query built for pickup location {pickup_location} within {radius} km")
 
         return optimal_driver
     except ObjectDoesNotExist:
@@ -74,3 +347,86 @@ def find_optimal_drivers(ride):
     except Exception as e:
         logger.error(f"Error finding optimal driver for pickup location {pickup_location}: {e}")
         return Driver.objects.none()
+
+
+def available_drivers_near(location, radius):
+    """
+    Available drivers within a radius of a location, nearest first.
+
+    The ST_DWithin predicate and the KNN (<->) ordering can both use the partial
+    GiST index on the location of available drivers, so PostGIS only visits the
+    drivers near the location and computes the distances of the rows it returns.
+
+    Args:
+    location -- The Point to search around.
+    radius -- Search radius in meters.
+
+    Returns:
+    Queryset -- Driver instances annotated with their `distance` to the location.
+    """
+    return Driver.objects.available().filter(
+        location__dwithin=(location, D(m=radius)),
+    ).annotate(
+        distance=Distance('location', location),
+    ).order_by(GeometryDistance('location', location))
+
+
+def get_driver_index():
+    """
+    Get the in-memory driver index, rebuilding it from the database when it is stale.
+
+    Returns:
+    DriverGridIndex -- The process-wide driver index.
+    """
+    if driver_index.is_stale(DRIVER_INDEX_TTL):
+        drivers = Driver.objects.available().filter(location__isnull=False).values_list('id', 'location')
+        driver_index.load((driver_id, location.y, location.x) for driver_id, location in drivers)
+        logger.info(f"Driver index rebuilt with {len(driver_index)} drivers")
+    return driver_index
+
+
+def find_nearby_driver_ids(location, radius):
+    """
+    Find the ids of available drivers near a location using the in-memory index.
+
+    Args:
+    location -- The Point to search around.
+    radius -- Search radius in meters.
+
+    Returns:
+    list -- Driver ids ordered by distance, or None if the index is disabled or
+            unavailable and the caller should fall back to a PostGIS scan.
+    """
+    if not DRIVER_INDEX_ENABLED:
+        return None
+    try:
+        nearby = get_driver_index().query(location.y, location.x, radius * INDEX_RADIUS_SLACK)
+    except Exception as e:
+        logger.error(f"Driver index lookup failed for location {location}, falling back to PostGIS: {e}")
+        return None
+    return [driver_id for driver_id, _ in nearby]
+
+
+def check_driver_index(location, radius=MAX_RADIUS * 1000):
+    """
+    Compare the in-memory index against PostGIS for a search around a location.
+
+    Args:
+    location -- The Point to search around.
+    radius -- Search radius in meters.
+
+    Returns:
+    tuple -- (missing, unexpected) sets of driver ids. `missing` are drivers PostGIS
+             finds but the index does not, `unexpected` are drivers only the index finds.
+    """
+    index = get_driver_index()
+
+    def postgis_ids(search_radius):
+        return set(available_drivers_near(location, search_radius).values_list('id', flat=True))
+
+    def index_ids(search_radius):
+        return {driver_id for driver_id, _ in index.query(location.y, location.x, search_radius)}
+
+    missing = postgis_ids(radius) - index_ids(radius * INDEX_RADIUS_SLACK)
+    unexpected = index_ids(radius) - postgis_ids(radius * INDEX_RADIUS_SLACK)
+    return missing, unexpected
@@ -5,10 +5,10 @@ from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
 from rider.models import Ride
+from rider.pagination import RideCursorPagination
 from rider.serializers import RideSerializer
 
 logger = logging.getLogger("auth")
@@ -21,14 +21,14 @@ class RideViewSet(viewsets.ModelViewSet):
     queryset -- All Ride objects.
     serializer_class -- The serializer class for Ride model.
     permission_classes -- Only authenticated users are allowed.
-    pagination_class -- PageNumberPagination for listing rides.
+    pagination_class -- Cursor pagination for listing rides, see rider.pagination.
     http_method_names -- Only allow GET and POST methods.
     """
 
     queryset = Ride.objects.all()
     serializer_class = RideSerializer
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = PageNumberPagination
+    pagination_class = RideCursorPagination
     http_method_names = ['get', 'post']
 
     def get_queryset(self):
@@ -53,10 +53,8 @@ class RideViewSet(viewsets.ModelViewSet):
         None
         """
         # Cancel any pending rides for the current user
-        rides = Ride.objects.filter(rider=self.request.user, status='PENDING')
-        logger.info(f"Cancelling pending rides for rider {self.request.user}: {rides}")
-        for ride in rides:
-            ride.cancel()
+        cancelled = Ride.objects.filter(rider=self.request.user).cancel_pending()
+        logger.info(f"Cancelled {len(cancelled)} pending rides for rider {self.request.user.id}")
 
         # Save the new ride instance with the current user as the rider
         serializer.save(rider=self.request.user)
@@ -80,11 +78,9 @@ class RideViewSet(viewsets.ModelViewSet):
         """
         ride = self.get_object()
 
-        if not ride.can_cancel:
+        if not ride.cancel():
             logger.warning(f"Ride {ride.id} cannot be cancelled.")
             return Response({'message': 'Ride cannot be cancelled'}, status=status.HTTP_400_BAD_REQUEST)
 
-        ride.cancel()
-
         logger.info(f"Ride {ride.id} cancelled by rider {request.user}")
         return Response({'message': 'Ride cancelled'}, status=status.HTTP_200_OK)